@@ -4,10 +4,63 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # IIKO API Configuration
-IIKO_API_BASE_URL = "https://madlen-group-so.iiko.it/resto/api"
+# Для замеров без сервера ресторана можно указать локальный заменитель (src/iiko_stub_server.py)
+IIKO_API_BASE_URL = os.getenv("IIKO_API_BASE_URL", "https://madlen-group-so.iiko.it/resto/api")
 IIKO_API_LOGIN = os.getenv("IIKO_API_LOGIN", "Tanat")
 IIKO_API_PASSWORD = os.getenv("IIKO_API_PASSWORD", "7c4a8d09ca3762af61e59520943dc26494f8941b")
 
+# Кэш токена IIKO API: файл для общего токена нескольких процессов (пусто - только в памяти)
+IIKO_TOKEN_CACHE_FILE = os.getenv("IIKO_TOKEN_CACHE_FILE", "")
+# Срок, после которого токен обновляется заранее (0 - только по ответу 401/403)
+IIKO_TOKEN_TTL_SECONDS = int(os.getenv("IIKO_TOKEN_TTL_SECONDS", "2700"))
+
+# HTTP-транспорт IIKO API (общий пул keep-alive соединений)
+IIKO_HTTP_POOL_CONNECTIONS = int(os.getenv("IIKO_HTTP_POOL_CONNECTIONS", "4"))
+IIKO_HTTP_POOL_MAXSIZE = int(os.getenv("IIKO_HTTP_POOL_MAXSIZE", "16"))
+IIKO_HTTP_CONNECT_TIMEOUT = float(os.getenv("IIKO_HTTP_CONNECT_TIMEOUT", "10"))
+IIKO_HTTP_READ_TIMEOUT = float(os.getenv("IIKO_HTTP_READ_TIMEOUT", "120"))
+# OLAP-отчеты считаются на сервере дольше остальных запросов
+IIKO_HTTP_OLAP_READ_TIMEOUT = float(os.getenv("IIKO_HTTP_OLAP_READ_TIMEOUT", "600"))
+# Разбиение OLAP-запросов по продажам на окна
+IIKO_OLAP_WINDOW_DAYS = int(os.getenv("IIKO_OLAP_WINDOW_DAYS", "7"))
+IIKO_OLAP_MAX_PARALLEL = int(os.getenv("IIKO_OLAP_MAX_PARALLEL", "4"))
+IIKO_OLAP_MAX_WINDOW_ROWS = int(os.getenv("IIKO_OLAP_MAX_WINDOW_ROWS", "200000"))
+# Инкрементальная синхронизация продаж: перекрытие с водяным знаком подразделения
+# (поздно закрытые и исправленные чеки) и глубина первой загрузки подразделения
+SALES_SYNC_OVERLAP_HOURS = float(os.getenv("SALES_SYNC_OVERLAP_HOURS", "6"))
+SALES_SYNC_INITIAL_DAYS = int(os.getenv("SALES_SYNC_INITIAL_DAYS", "7"))
+# Размер окна (дни) возобновляемой загрузки истории продаж
+SALES_BACKFILL_WINDOW_DAYS = int(os.getenv("SALES_BACKFILL_WINDOW_DAYS", "7"))
+# Инкрементальная синхронизация списаний: окно исправлений перед водяным знаком
+# (часы), глубина первой загрузки и размер окна запроса к API (дни)
+WRITEOFF_SYNC_CORRECTION_HOURS = float(os.getenv("WRITEOFF_SYNC_CORRECTION_HOURS", "24"))
+WRITEOFF_SYNC_INITIAL_DAYS = int(os.getenv("WRITEOFF_SYNC_INITIAL_DAYS", "7"))
+WRITEOFF_SYNC_WINDOW_DAYS = int(os.getenv("WRITEOFF_SYNC_WINDOW_DAYS", "7"))
+# Одновременных запросов цен при синхронизации всех подразделений
+PRICE_SYNC_MAX_PARALLEL = int(os.getenv("PRICE_SYNC_MAX_PARALLEL", "4"))
+# Сколько последних месяцев продаж держат B-tree индекс по close_time (более старые - BRIN)
+SALES_PARTITION_BTREE_MONTHS = int(os.getenv("SALES_PARTITION_BTREE_MONTHS", "2"))
+# Ограничение нагрузки на сервер IIKO: запросов в секунду по классам эндпоинтов
+# (формат "класс=rps,..."; 0 - без ограничения)
+IIKO_RATE_LIMITS = {
+    name.strip(): float(rate)
+    for name, rate in (
+        item.split('=', 1)
+        for item in os.getenv("IIKO_RATE_LIMITS", "reference=5,documents=2,prices=1,olap=0.5,auth=1").split(',')
+        if '=' in item
+    )
+}
+# Максимум одновременно выполняемых запросов процесса (0 - без ограничения)
+IIKO_RATE_MAX_IN_FLIGHT = int(os.getenv("IIKO_RATE_MAX_IN_FLIGHT", "4"))
+# Повторы при 429/5xx/409 с экспоненциальной задержкой и jitter
+IIKO_RATE_MAX_RETRIES = int(os.getenv("IIKO_RATE_MAX_RETRIES", "3"))
+IIKO_RATE_BACKOFF_BASE = float(os.getenv("IIKO_RATE_BACKOFF_BASE", "1"))
+IIKO_RATE_BACKOFF_MAX = float(os.getenv("IIKO_RATE_BACKOFF_MAX", "60"))
+# Емкость очередей между стадиями конвейера синхронизации (элементов: порций строк, батчей, документов)
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# Максимум одновременных запросов асинхронного клиента
+IIKO_ASYNC_MAX_CONCURRENCY = int(os.getenv("IIKO_ASYNC_MAX_CONCURRENCY", "8"))
+
 # Database Configuration
 DATABASE_CONFIG = {
     'host': os.getenv('DB_HOST', 'localhost'),
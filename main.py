@@ -32,8 +32,28 @@ def main():
                       help='Какие сущности синхронизировать')
     parser.add_argument('--start-date', help='Начальная дата для продаж в формате YYYY-MM-DD')
     parser.add_argument('--end-date', help='Конечная дата для продаж в формате YYYY-MM-DD')
-    parser.add_argument('--department-id', help='ID подразделения для синхронизации цен')
+    parser.add_argument('--department-id', help='ID подразделения для синхронизации цен (по умолчанию все)')
+    parser.add_argument('--max-parallel', type=int,
+                      help='Одновременных запросов цен для всех подразделений (по умолчанию PRICE_SYNC_MAX_PARALLEL)')
     parser.add_argument('--price-type', default='BASE', help='Тип цен для синхронизации (по умолчанию BASE)')
+    parser.add_argument('--sales-mode', choices=['incremental', 'range'],
+                      help='Режим синхронизации продаж: incremental - от водяных знаков подразделений '
+                           '(по умолчанию без дат), range - за период --start-date/--end-date')
+    parser.add_argument('--overlap-hours', type=float,
+                      help='Перекрытие с водяным знаком продаж в часах (по умолчанию SALES_SYNC_OVERLAP_HOURS)')
+    parser.add_argument('--writeoffs-mode', choices=['incremental', 'range'],
+                      help='Режим синхронизации списаний: incremental - от водяного знака '
+                           '(по умолчанию без дат), range - за период --start-date/--end-date')
+    parser.add_argument('--correction-hours', type=float,
+                      help='Окно исправлений списаний перед водяным знаком в часах '
+                           '(по умолчанию WRITEOFF_SYNC_CORRECTION_HOURS)')
+    parser.add_argument('--resume', action='store_true',
+                      help='Продолжить прерванную загрузку продаж или списаний за тот же период '
+                           'с первого незавершенного окна')
+    parser.add_argument('--reload', action='store_true',
+                      help='Перезагрузить продажи за период целиком (полные месяцы - подменой партиции)')
+    parser.add_argument('--full-refresh', action='store_true',
+                      help='Полная загрузка складов и подразделений без учета сохраненной ревизии')
     parser.add_argument('--analyze', action='store_true',
                       help='Только проанализировать структуру данных')
     
@@ -56,12 +76,20 @@ def main():
             if args.entity in ['stores', 'all']:
                 logger.info("Синхронизация складов...")
                 store_synchronizer = StoreSynchronizer()
-                store_synchronizer.sync_stores()
+                store_synchronizer.sync_stores(full_refresh=args.full_refresh)
                 
             if args.entity in ['sales', 'all']:
                 logger.info("Синхронизация продаж...")
                 sales_synchronizer = SalesSynchronizer()
-                sales_synchronizer.sync_sales(args.start_date, args.end_date)
+                sales_mode = args.sales_mode or ('range' if args.start_date or args.end_date else 'incremental')
+                if sales_mode == 'incremental':
+                    sales_synchronizer.sync_sales_incremental(overlap_hours=args.overlap_hours)
+                else:
+                    # Загрузка за период идет по окнам с чекпоинтами (sync_checkpoints)
+                    end_date = args.end_date or datetime.now().strftime('%Y-%m-%d')
+                    start_date = args.start_date or end_date
+                    sales_synchronizer.backfill_sales(start_date, end_date, resume=args.resume,
+                                                      clear_existing=args.reload)
             
             if args.entity in ['accounts', 'all']:
                 logger.info("Синхронизация счетов...")
@@ -69,7 +97,11 @@ def main():
             
             if args.entity in ['writeoffs', 'all']:
                 logger.info("Синхронизация документов списания...")
-                synchronizer.sync_writeoff_documents(args.start_date, args.end_date)
+                writeoffs_mode = args.writeoffs_mode or ('range' if args.start_date or args.end_date else 'incremental')
+                if writeoffs_mode == 'incremental':
+                    synchronizer.sync_writeoff_documents_incremental(correction_hours=args.correction_hours)
+                else:
+                    synchronizer.sync_writeoff_documents(args.start_date, args.end_date, resume=args.resume)
             
             if args.entity in ['departments', 'all']:
                 logger.info("Синхронизация подразделений...")
@@ -77,14 +109,9 @@ def main():
                 from config.config import CONNECTION_STRING
                 api_client = IikoApiClient()
                 dept_synchronizer = DepartmentSynchronizer(api_client, CONNECTION_STRING)
-                dept_synchronizer.sync_departments()
+                dept_synchronizer.sync_departments(full_refresh=args.full_refresh)
             
             if args.entity == 'prices':
-                if not args.department_id:
-                    logger.error("Для синхронизации цен необходимо указать --department-id")
-                    return
-                    
-                logger.info(f"Синхронизация цен для подразделения {args.department_id}...")
                 from src.api_client import IikoApiClient
                 from src.price_synchronizer import PriceSynchronizer
                 from config.config import CONNECTION_STRING
@@ -95,7 +122,14 @@ def main():
                 
                 api_client = IikoApiClient()
                 price_synchronizer = PriceSynchronizer(api_client, CONNECTION_STRING)
-                price_synchronizer.sync_prices(args.department_id, start_date, end_date, args.price_type)
+                if args.department_id:
+                    logger.info(f"Синхронизация цен для подразделения {args.department_id}...")
+                    price_synchronizer.sync_prices(args.department_id, start_date, end_date, args.price_type)
+                else:
+                    # Без --department-id - все подразделения параллельно (PRICE_SYNC_MAX_PARALLEL)
+                    logger.info("Синхронизация цен всех подразделений...")
+                    price_synchronizer.sync_all_prices(start_date, end_date, args.price_type,
+                                                       max_parallel=args.max_parallel)
                 
             logger.info("Синхронизация завершена успешно")
             
@@ -0,0 +1,22 @@
+-- Создание таблицы sync_state для хранения состояния инкрементальной синхронизации
+-- (последняя ревизия справочников, водяные знаки и т.п.)
+CREATE TABLE IF NOT EXISTS sync_state (
+    id SERIAL PRIMARY KEY,
+    entity_type VARCHAR(50) NOT NULL,
+    scope VARCHAR(100) NOT NULL DEFAULT '',
+    revision BIGINT,
+    watermark TIMESTAMP,
+    details JSON,
+    
+    -- Временные метки
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    
+    CONSTRAINT unique_sync_state UNIQUE (entity_type, scope)
+);
+
+-- Комментарии к таблице
+COMMENT ON TABLE sync_state IS 'Состояние инкрементальной синхронизации';
+COMMENT ON COLUMN sync_state.entity_type IS 'Тип сущности (stores, departments, ...)';
+COMMENT ON COLUMN sync_state.scope IS 'Область состояния (например, ID подразделения); пустая строка - вся сущность';
+COMMENT ON COLUMN sync_state.revision IS 'Последняя полученная ревизия IIKO';
+COMMENT ON COLUMN sync_state.watermark IS 'Водяной знак по времени';
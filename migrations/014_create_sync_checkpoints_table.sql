@@ -0,0 +1,32 @@
+-- Создание таблицы sync_checkpoints для возобновляемых загрузок истории (backfill)
+CREATE TABLE IF NOT EXISTS sync_checkpoints (
+    id SERIAL PRIMARY KEY,
+    job_id VARCHAR(100) NOT NULL,
+    entity_type VARCHAR(50) NOT NULL,
+    window_start DATE NOT NULL,
+    window_end DATE NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    rows_count INTEGER,
+    duration_seconds FLOAT,
+    error_message TEXT,
+    
+    -- Временные метки
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    
+    CONSTRAINT unique_sync_checkpoint UNIQUE (job_id, window_start)
+);
+
+-- Индекс для поиска незавершенных окон
+CREATE INDEX IF NOT EXISTS idx_sync_checkpoints_job_status ON sync_checkpoints(job_id, status);
+
+-- Комментарии к таблице
+COMMENT ON TABLE sync_checkpoints IS 'Окна загрузки истории и их состояние';
+COMMENT ON COLUMN sync_checkpoints.job_id IS 'Идентификатор загрузки (сущность и период)';
+COMMENT ON COLUMN sync_checkpoints.window_start IS 'Начало окна (включительно)';
+COMMENT ON COLUMN sync_checkpoints.window_end IS 'Конец окна (не включается)';
+COMMENT ON COLUMN sync_checkpoints.status IS 'pending, running, done, failed';
+COMMENT ON COLUMN sync_checkpoints.rows_count IS 'Количество полученных из API строк';
+COMMENT ON COLUMN sync_checkpoints.duration_seconds IS 'Длительность загрузки окна';
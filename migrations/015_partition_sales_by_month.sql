@@ -0,0 +1,79 @@
+-- Перевод таблицы sales на помесячные партиции по close_time
+--
+-- Ключи секционированной таблицы должны включать ключ секционирования, поэтому
+-- первичный ключ становится (id, close_time), а unique_sale_item дополняется close_time.
+-- Это меняет ключ дедупликации: повторно закрытый чек больше не совпадает с прежней строкой,
+-- прежние закрытия удаляет синхронизатор по ID заказа (миграция 021).
+-- Продажи без close_time (незакрытые заказы) в партиции попасть не могут: они переносятся
+-- в таблицу sales_without_close_time, их количество выводится сообщением.
+-- Партиции новых месяцев создаются синхронизатором автоматически (src/sales_partitions.py),
+-- перевод старых партиций на BRIN выполняется при синхронизации.
+-- Повторный запуск на уже секционированной таблице ничего не меняет.
+-- После проверки данных таблицу sales_legacy можно удалить: DROP TABLE sales_legacy;
+
+BEGIN;
+
+DO $$
+DECLARE
+    month DATE;
+    partition TEXT;
+    skipped BIGINT;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'sales'::regclass) THEN
+        RAISE NOTICE 'Таблица sales уже секционирована, миграция пропущена';
+        RETURN;
+    END IF;
+
+    ALTER TABLE sales RENAME TO sales_legacy;
+    ALTER TABLE sales_legacy RENAME CONSTRAINT sales_pkey TO sales_legacy_pkey;
+    ALTER TABLE sales_legacy DROP CONSTRAINT IF EXISTS unique_sale_item;
+    DROP INDEX IF EXISTS idx_sales_order_num;
+    DROP INDEX IF EXISTS idx_sales_close_time;
+    DROP INDEX IF EXISTS idx_sales_dish_code;
+    DROP INDEX IF EXISTS idx_sales_department_id;
+    DROP INDEX IF EXISTS idx_sales_store_id;
+
+    CREATE TABLE sales (LIKE sales_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (close_time);
+    ALTER TABLE sales ALTER COLUMN close_time SET NOT NULL;
+
+    -- Партиции месяцев с данными, а также текущего и следующего месяца
+    FOR month IN
+        SELECT DISTINCT date_trunc('month', close_time)::date FROM sales_legacy WHERE close_time IS NOT NULL
+        UNION
+        SELECT date_trunc('month', now())::date
+        UNION
+        SELECT (date_trunc('month', now()) + INTERVAL '1 month')::date
+    LOOP
+        partition := 'sales_' || to_char(month, 'YYYY_MM');
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF sales FOR VALUES FROM (%L) TO (%L)',
+                       partition, month, (month + INTERVAL '1 month')::date);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (close_time)', partition || '_close_time_idx', partition);
+    END LOOP;
+
+    INSERT INTO sales SELECT * FROM sales_legacy WHERE close_time IS NOT NULL;
+
+    -- Строки без close_time переносятся в отдельную таблицу, а не теряются вместе с sales_legacy
+    CREATE TABLE IF NOT EXISTS sales_without_close_time (LIKE sales_legacy INCLUDING DEFAULTS);
+    INSERT INTO sales_without_close_time SELECT * FROM sales_legacy WHERE close_time IS NULL;
+    GET DIAGNOSTICS skipped = ROW_COUNT;
+    IF skipped > 0 THEN
+        RAISE NOTICE 'Продаж без close_time перенесено в sales_without_close_time: %', skipped;
+    END IF;
+
+    ALTER TABLE sales ADD PRIMARY KEY (id, close_time);
+    ALTER TABLE sales ADD CONSTRAINT unique_sale_item
+        UNIQUE (order_num, fiscal_cheque_number, dish_code, cash_register_number, close_time);
+    ALTER TABLE sales ADD FOREIGN KEY (store_id) REFERENCES stores(id) ON DELETE SET NULL;
+END $$;
+
+-- Индекс по close_time создается на каждой партиции отдельно (B-tree или BRIN)
+CREATE INDEX IF NOT EXISTS idx_sales_order_num ON sales(order_num);
+CREATE INDEX IF NOT EXISTS idx_sales_dish_code ON sales(dish_code);
+CREATE INDEX IF NOT EXISTS idx_sales_department_id ON sales(department_id);
+CREATE INDEX IF NOT EXISTS idx_sales_store_id ON sales(store_id);
+
+COMMENT ON TABLE sales IS 'Таблица чеков и продаж (партиции по месяцам close_time)';
+
+COMMIT;
+
+ANALYZE sales;
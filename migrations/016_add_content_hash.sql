@@ -0,0 +1,17 @@
+-- Миграция: отпечаток содержимого строки (content_hash) для пропуска неизмененных записей
+-- Синхронизация сравнивает отпечаток данных из API с сохраненным и не переписывает
+-- строку, если они совпадают (нет лишних версий строк, WAL и работы для VACUUM).
+-- Для существующих строк отпечаток пустой и заполняется при следующей синхронизации.
+ALTER TABLE products ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+ALTER TABLE sales ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+ALTER TABLE accounts ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+ALTER TABLE writeoff_documents ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+ALTER TABLE prices ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+ALTER TABLE incoming_invoices ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+
+COMMENT ON COLUMN products.content_hash IS 'MD5 данных продукта из API (включая связи и модификаторы)';
+COMMENT ON COLUMN sales.content_hash IS 'MD5 данных строки продажи из API';
+COMMENT ON COLUMN accounts.content_hash IS 'MD5 данных счета из API';
+COMMENT ON COLUMN writeoff_documents.content_hash IS 'MD5 данных документа списания из API (включая позиции)';
+COMMENT ON COLUMN prices.content_hash IS 'MD5 данных цены из API';
+COMMENT ON COLUMN incoming_invoices.content_hash IS 'MD5 данных накладной из API (включая позиции)';
@@ -0,0 +1,7 @@
+-- Миграция: признак удаления склада
+-- Склады сливаются с таблицей на месте (без очистки), поэтому удаленные в IIKO склады
+-- не удаляются физически (на них ссылаются документы), а помечаются deleted = true:
+-- по признаку deleted из ленты изменений или при полной загрузке, если склада нет в ответе.
+ALTER TABLE stores ADD COLUMN IF NOT EXISTS deleted BOOLEAN NOT NULL DEFAULT FALSE;
+
+COMMENT ON COLUMN stores.deleted IS 'Склад удален в IIKO';
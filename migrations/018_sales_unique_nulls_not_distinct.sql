@@ -0,0 +1,29 @@
+-- Миграция: уникальный ключ продаж с NULLS NOT DISTINCT (PostgreSQL 15+)
+--
+-- Продажи сливаются через INSERT ... ON CONFLICT по unique_sale_item. В ключе есть колонки,
+-- допускающие NULL (fiscal_cheque_number, dish_code, cash_register_number), а обычный UNIQUE
+-- не считает NULL равными: ON CONFLICT для таких строк не срабатывал, и каждая синхронизация
+-- добавляла их заново. Перед заменой ограничения накопленные дубли удаляются
+-- (остается последняя синхронизированная строка).
+
+BEGIN;
+
+-- Продажи: дубли по ключу с учетом NULL
+DELETE FROM sales s
+USING (
+    SELECT id, close_time,
+           row_number() OVER (
+               PARTITION BY order_num, fiscal_cheque_number, dish_code, cash_register_number, close_time
+               ORDER BY synced_at DESC NULLS LAST, id DESC
+           ) AS rn
+    FROM sales
+) d
+WHERE s.id = d.id AND s.close_time = d.close_time AND d.rn > 1;
+
+ALTER TABLE sales DROP CONSTRAINT IF EXISTS unique_sale_item;
+ALTER TABLE sales ADD CONSTRAINT unique_sale_item
+    UNIQUE NULLS NOT DISTINCT (order_num, fiscal_cheque_number, dish_code, cash_register_number, close_time);
+
+COMMIT;
+
+ANALYZE sales;
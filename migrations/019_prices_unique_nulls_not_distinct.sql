@@ -0,0 +1,39 @@
+-- Миграция: уникальный ключ цен с NULLS NOT DISTINCT (PostgreSQL 15+)
+--
+-- Цены сливаются через INSERT ... ON CONFLICT по unique_price_entry. product_size_id допускает NULL,
+-- а обычный UNIQUE не считает NULL равными: ON CONFLICT для цен без размера не срабатывал, и каждая
+-- синхронизация добавляла их заново. Перед заменой ограничения накопленные дубли удаляются
+-- (остается последняя синхронизированная строка).
+
+BEGIN;
+
+-- Цены: дубли по ключу с учетом NULL
+DELETE FROM prices p
+USING (
+    SELECT id,
+           row_number() OVER (
+               PARTITION BY department_id, product_id, product_size_id, price_type, date_from, date_to
+               ORDER BY synced_at DESC NULLS LAST, id DESC
+           ) AS rn
+    FROM prices
+) d
+WHERE p.id = d.id AND d.rn > 1;
+
+-- Ограничение из миграции 010 создано без имени, удаляем все уникальные ограничения таблицы
+DO $$
+DECLARE
+    constraint_name TEXT;
+BEGIN
+    FOR constraint_name IN
+        SELECT conname FROM pg_constraint WHERE conrelid = 'prices'::regclass AND contype = 'u'
+    LOOP
+        EXECUTE format('ALTER TABLE prices DROP CONSTRAINT %I', constraint_name);
+    END LOOP;
+END $$;
+
+ALTER TABLE prices ADD CONSTRAINT unique_price_entry
+    UNIQUE NULLS NOT DISTINCT (department_id, product_id, product_size_id, price_type, date_from, date_to);
+
+COMMIT;
+
+ANALYZE prices;
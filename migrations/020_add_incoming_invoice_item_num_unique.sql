@@ -0,0 +1,23 @@
+-- Миграция: уникальный номер позиции приходной накладной
+-- Позиции измененных накладных сверяются с БД по (invoice_id, num) и сливаются через
+-- INSERT ... ON CONFLICT вместо удаления и повторной вставки всех позиций накладной.
+-- Перед добавлением ограничения удаляются повторы номера (остается последняя вставленная позиция).
+
+BEGIN;
+
+UPDATE incoming_invoice_items SET num = 0 WHERE num IS NULL;
+
+DELETE FROM incoming_invoice_items i
+USING (
+    SELECT id, row_number() OVER (PARTITION BY invoice_id, num ORDER BY id DESC) AS rn
+    FROM incoming_invoice_items
+) d
+WHERE i.id = d.id AND d.rn > 1;
+
+ALTER TABLE incoming_invoice_items ALTER COLUMN num SET NOT NULL;
+ALTER TABLE incoming_invoice_items
+    ADD CONSTRAINT unique_incoming_invoice_item_num UNIQUE (invoice_id, num);
+
+COMMIT;
+
+COMMENT ON COLUMN incoming_invoice_items.num IS 'Номер позиции в накладной';
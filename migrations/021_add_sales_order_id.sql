@@ -0,0 +1,10 @@
+-- Миграция: ID заказа в продажах
+-- Номера заказов и фискальные номера повторяются между кассовыми сменами, а время закрытия
+-- входит в ключ unique_sale_item, поэтому повторно закрытый чек сверяется с прежними строками
+-- по ID заказа из OLAP (UniqOrderId.Id): строки заказа с другим временем закрытия удаляются.
+-- Индекс на секционированной таблице создается и на всех ее партициях.
+ALTER TABLE sales ADD COLUMN IF NOT EXISTS order_id UUID;
+
+CREATE INDEX IF NOT EXISTS idx_sales_order_id ON sales (order_id);
+
+COMMENT ON COLUMN sales.order_id IS 'ID заказа IIKO (UniqOrderId.Id), общий для всех закрытий заказа';
@@ -1,34 +1,216 @@
 import requests
 import json
+import threading
 from typing import Dict, Any, Optional
-from config.config import IIKO_API_BASE_URL, IIKO_API_LOGIN, IIKO_API_PASSWORD
+from requests.adapters import HTTPAdapter
+from src.token_manager import get_token_manager
+from src.rate_limiter import endpoint_class, get_rate_limiter
+from src.olap_fields import OlapRowNormalizer, SALES_FIELDS
+from config.config import (
+    IIKO_API_BASE_URL, IIKO_API_LOGIN, IIKO_API_PASSWORD,
+    IIKO_HTTP_POOL_CONNECTIONS, IIKO_HTTP_POOL_MAXSIZE,
+    IIKO_HTTP_CONNECT_TIMEOUT, IIKO_HTTP_READ_TIMEOUT, IIKO_HTTP_OLAP_READ_TIMEOUT,
+    IIKO_OLAP_WINDOW_DAYS, IIKO_OLAP_MAX_PARALLEL, IIKO_OLAP_MAX_WINDOW_ROWS
+)
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def _max_revision(current: Optional[int], value: Optional[str]) -> Optional[int]:
+    """Максимум из текущей ревизии и ревизии из ответа (если она передана)"""
+    try:
+        revision = int(value)
+    except (TypeError, ValueError):
+        return current
+    return revision if current is None else max(current, revision)
+
+
+class SalesWindowTooLarge(Exception):
+    """Окно OLAP-отчета превысило допустимое число строк и должно быть разделено"""
+
+
+def get_http_session() -> requests.Session:
+    """Общая для процесса HTTP-сессия с пулом keep-alive соединений к IIKO API"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=IIKO_HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=IIKO_HTTP_POOL_MAXSIZE,
+                    pool_block=True
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    'Accept-Encoding': 'gzip, deflate',
+                    'Connection': 'keep-alive'
+                })
+                _http_session = session
+    return _http_session
+
+
+def close_http_session():
+    """Закрытие общего пула соединений (при завершении процесса)"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
 
 class IikoApiClient:
-    def __init__(self):
+    # Строк в одной порции между потоками загрузки окон продаж и потребителем
+    SALES_QUEUE_CHUNK_ROWS = 1000
+    
+    def __init__(self, http_session: Optional[requests.Session] = None):
         self.base_url = IIKO_API_BASE_URL
         self.token = None
+        # Все клиенты по умолчанию используют общий пул соединений
+        self.http = http_session or get_http_session()
+        self.timeout = (IIKO_HTTP_CONNECT_TIMEOUT, IIKO_HTTP_READ_TIMEOUT)
+        # Токен общий для всех клиентов процесса (и, при настройке, для нескольких процессов)
+        self.token_manager = get_token_manager(self.base_url, IIKO_API_LOGIN, self._login, self._logout)
+        self.rate_limiter = get_rate_limiter()
+    
+    def _request(self, method: str, url: str, timeout=None, retry_auth: bool = True, **kwargs) -> requests.Response:
+        """Выполнение HTTP-запроса через общий пул соединений
         
-    def authenticate(self) -> str:
-        """Получение токена авторизации"""
+        Если сервер отверг токен (401/403), токен прозрачно обновляется
+        и запрос повторяется один раз.
+        
+        :param timeout: Таймаут вызова (connect, read); по умолчанию из конфигурации
+        :param retry_auth: Обновлять токен и повторять запрос при 401/403
+        """
+        response = self._send(method, url, timeout=timeout or self.timeout, **kwargs)
+        
+        stale_token = self.token
+        if retry_auth and response.status_code in (401, 403) and stale_token and self._uses_token(kwargs, stale_token):
+            response.close()
+            self.token = self.token_manager.refresh(stale_token)
+            kwargs = self._replace_token(kwargs, stale_token, self.token)
+            response = self._send(method, url, timeout=timeout or self.timeout, **kwargs)
+        
+        return response
+    
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Отправка запроса через общий ограничитель нагрузки на сервер
+        
+        Запрос ждет бюджета своего класса эндпоинтов и свободного слота. При
+        429/5xx/409 запрос повторяется с экспоненциальной задержкой и jitter.
+        Слот потокового ответа (stream=True) освобождается при response.close().
+        """
+        name = endpoint_class(url)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(name)
+            try:
+                response = self.http.request(method, url, **kwargs)
+            except Exception:
+                self.rate_limiter.release()
+                raise
+            
+            if self.rate_limiter.should_retry(response.status_code, attempt):
+                response.close()
+                self.rate_limiter.release()
+                self.rate_limiter.backoff(name, attempt, response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+            
+            if response.status_code < 400:
+                self.rate_limiter.on_success(name)
+            
+            if kwargs.get('stream'):
+                self._release_on_close(response)
+            else:
+                self.rate_limiter.release()
+            return response
+    
+    def _release_on_close(self, response: requests.Response):
+        """Освобождение слота ограничителя при закрытии потокового ответа (однократно)"""
+        close = response.close
+        released = False
+        
+        def close_and_release():
+            nonlocal released
+            try:
+                close()
+            finally:
+                if not released:
+                    released = True
+                    self.rate_limiter.release()
+        
+        response.close = close_and_release
+    
+    def rate_limit_stats(self) -> Dict[str, Dict[str, float]]:
+        """Счетчики ограничителя: запросы, время ожидания бюджета и слотов, повторы"""
+        return self.rate_limiter.stats()
+    
+    @staticmethod
+    def _uses_token(kwargs: dict, token: str) -> bool:
+        """Передается ли токен в параметрах или заголовках запроса"""
+        params = kwargs.get('params') or {}
+        headers = kwargs.get('headers') or {}
+        return token in params.values() or any(token in str(value) for value in headers.values())
+    
+    @staticmethod
+    def _replace_token(kwargs: dict, old_token: str, new_token: str) -> dict:
+        """Копия аргументов запроса с замененным токеном"""
+        kwargs = dict(kwargs)
+        if kwargs.get('params'):
+            kwargs['params'] = {key: new_token if value == old_token else value
+                                for key, value in kwargs['params'].items()}
+        if kwargs.get('headers'):
+            kwargs['headers'] = {key: str(value).replace(old_token, new_token)
+                                 for key, value in kwargs['headers'].items()}
+        return kwargs
+        
+    def _login(self) -> str:
+        """Вход в IIKO API (/auth), возвращает новый токен"""
         auth_url = f"{self.base_url}/auth"
         params = {
             'login': IIKO_API_LOGIN,
             'pass': IIKO_API_PASSWORD
         }
         
-        response = requests.get(auth_url, params=params)
+        response = self._request('GET', auth_url, params=params, retry_auth=False)
         response.raise_for_status()
         
-        self.token = response.text.strip().strip('"')
+        return response.text.strip().strip('"')
+    
+    def _logout(self, token: str):
+        """Освобождение токена (/logout), чтобы не занимать слот лицензии"""
+        logout_url = f"{self.base_url}/logout"
+        # Выход выполняется и при завершении процесса, когда общий пул уже может быть
+        # очищен финализаторами urllib3 (ожидание соединения с pool_block зависло бы),
+        # поэтому используется отдельное одноразовое соединение
+        with requests.Session() as http:
+            response = http.get(logout_url, params={'key': token}, timeout=self.timeout)
+        response.raise_for_status()
+    
+    def authenticate(self) -> str:
+        """Получение токена авторизации (переиспользуется кэшированный токен процесса)"""
+        self.token = self.token_manager.get_token()
         return self.token
     
-    def get_products(self, include_deleted: bool = False) -> list:
-        """Получение списка продуктов (пагинация в IIKO API не работает корректно)"""
+    def _ensure_token(self) -> str:
+        """Актуальный токен перед запросом (общий кэш, обновление по истечении срока)"""
+        return self.authenticate()
+    
+    def logout(self):
+        """Явное освобождение токена процесса"""
+        self.token_manager.logout()
+        self.token = None
+    
+    def iter_products(self, include_deleted: bool = False):
+        """Потоковое получение продуктов: записи отдаются по одной по мере чтения ответа"""
         import logging
+        from src.json_stream import iter_json_array
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         products_url = f"{self.base_url}/v2/entities/products/list"
         headers = {
@@ -41,78 +223,96 @@ class IikoApiClient:
         
         logger.info("Загрузка всех продуктов из API...")
         
-        response = requests.get(products_url, params=params, headers=headers)
+        response = self._request('GET', products_url, params=params, headers=headers, stream=True)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
-        response.raise_for_status()
-        
-        products_data = response.json()
-        
-        # Проверяем уникальность ID
-        product_ids = [p.get('id') for p in products_data if p.get('id')]
-        unique_ids = set(product_ids)
-        
-        if len(product_ids) != len(unique_ids):
-            duplicates_count = len(product_ids) - len(unique_ids)
-            logger.warning(f"Обнаружены дубликаты ID: {duplicates_count} дубликатов из {len(product_ids)} товаров")
-        
-        logger.info(f"Загружено {len(products_data)} продуктов, уникальных ID: {len(unique_ids)}")
-        
-        return products_data
+        try:
+            response.raise_for_status()
+            
+            # Для проверки уникальности храним только ID, а не сами продукты
+            total_count = 0
+            unique_ids = set()
+            
+            for product in iter_json_array(response.iter_content(chunk_size=65536)):
+                total_count += 1
+                if product.get('id'):
+                    unique_ids.add(product['id'])
+                yield product
+        finally:
+            response.close()
+        
+        if total_count != len(unique_ids):
+            logger.warning(f"Обнаружены дубликаты ID: {total_count - len(unique_ids)} дубликатов из {total_count} товаров")
+        
+        logger.info(f"Загружено {total_count} продуктов, уникальных ID: {len(unique_ids)}")
+    
+    def get_products(self, include_deleted: bool = False) -> list:
+        """Получение списка продуктов (пагинация в IIKO API не работает корректно)"""
+        return list(self.iter_products(include_deleted))
     
     def get_stores(self) -> list:
         """Получение списка складов"""
+        return self.get_stores_since(-1)[0]
+    
+    def get_stores_since(self, revision_from: int = -1) -> tuple:
+        """Получение складов, измененных после указанной ревизии
+        
+        :param revision_from: Ревизия, после которой нужны изменения (-1 - все склады)
+        :return: (список складов, максимальная ревизия ответа или None)
+        """
         import logging
-        import xml.etree.ElementTree as ET
-        from io import StringIO
+        from src.xml_stream import iter_xml_records
         
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         stores_url = f"{self.base_url}/corporation/stores"
         params = {
             'key': self.token,
-            'revisionFrom': -1
+            'revisionFrom': revision_from
         }
         
-        logger.info(f"Загрузка списка складов...")
+        logger.info(f"Загрузка списка складов (revisionFrom={revision_from})...")
         
-        response = requests.get(stores_url, params=params)
+        response = self._request('GET', stores_url, params=params, stream=True)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
-        response.raise_for_status()
-        
-        # Парсинг XML-ответа
+        # Потоковый парсинг XML-ответа
         try:
-            xml_data = response.text
-            root = ET.fromstring(xml_data)
+            response.raise_for_status()
             
             stores_data = []
-            for store_elem in root.findall('./corporateItemDto'):
+            root_attrib = {}
+            revision = None
+            for fields in iter_xml_records(response.iter_content(chunk_size=65536), 'corporateItemDto',
+                                           root_attrib=root_attrib):
+                revision = _max_revision(revision, fields.get('revision'))
                 store_data = {
-                    'id': store_elem.findtext('id'),
-                    'parentId': store_elem.findtext('parentId'),
-                    'code': store_elem.findtext('code'),
-                    'name': store_elem.findtext('name'),
-                    'type': store_elem.findtext('type')
+                    'id': fields.get('id'),
+                    'parentId': fields.get('parentId'),
+                    'code': fields.get('code'),
+                    'name': fields.get('name'),
+                    'type': fields.get('type'),
+                    'deleted': fields.get('deleted') == 'true'
                 }
                 stores_data.append(store_data)
                 
-            logger.info(f"Загружено {len(stores_data)} складов")
-            return stores_data
+            revision = _max_revision(revision, root_attrib.get('revision'))
+            logger.info(f"Загружено {len(stores_data)} складов, ревизия: {revision}")
+            return stores_data, revision
             
         except Exception as e:
             logger.error(f"Ошибка при парсинге XML-ответа: {e}")
-            logger.debug(f"Полученный XML: {response.text[:1000]}...")
             raise
+        finally:
+            response.close()
     
     def analyze_products_structure(self) -> Dict[str, set]:
         """Анализ структуры данных продуктов"""
-        products_data = self.get_products()
+        products_data = self.iter_products()
         
         # Собираем все уникальные ключи
         all_keys = set()
@@ -133,20 +333,34 @@ class IikoApiClient:
             'nested_structures': nested_structures
         }
     
-    def get_sales(self, start_date=None, end_date=None) -> list:
-        """Получение данных о продажах
+    def iter_sales(self, start_date=None, end_date=None, department_ids: Optional[list] = None,
+                   window_days: Optional[int] = None, max_parallel: Optional[int] = None,
+                   split_departments: bool = True):
+        """Потоковое получение данных о продажах
+        
+        OLAP-ответ разбирается по мере чтения из сокета, нормализованные записи
+        отдаются по одной, поэтому память не зависит от длины периода.
+        
+        Длинный период автоматически делится на окна по window_days дней (и, если
+        переданы department_ids, по подразделениям), которые загружаются параллельно.
+        Окно, завершившееся ошибкой или превысившее IIKO_OLAP_MAX_WINDOW_ROWS строк,
+        делится пополам и загружается заново.
         
         :param start_date: Начальная дата в формате YYYY-MM-DD
-        :param end_date: Конечная дата в формате YYYY-MM-DD
-        :return: Список продаж
+        :param end_date: Конечная дата в формате YYYY-MM-DD (не включается)
+        :param department_ids: ID подразделений для разбиения по фильтру Department.Id
+        :param window_days: Размер окна в днях (по умолчанию IIKO_OLAP_WINDOW_DAYS)
+        :param max_parallel: Максимум одновременных запросов (по умолчанию IIKO_OLAP_MAX_PARALLEL)
+        :param split_departments: Отдельный запрос на каждое подразделение; False - один фильтр
+            на все department_ids (окно делится по подразделениям только при ошибке)
+        :return: Итератор по записям о продажах
         """
         import logging
         from datetime import datetime, timedelta
         
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
         
         # Если даты не указаны, берем последние 7 дней
         if not end_date:
@@ -161,6 +375,154 @@ class IikoApiClient:
             end_date_obj = dt.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
             end_date = end_date_obj.strftime('%Y-%m-%d')
         
+        window_days = window_days or IIKO_OLAP_WINDOW_DAYS
+        range_start = datetime.strptime(start_date, '%Y-%m-%d').date()
+        range_end = datetime.strptime(end_date, '%Y-%m-%d').date()
+        
+        stats = {'loaded': 0, 'skipped_storned': 0, 'skipped_returns': 0}
+        
+        if (range_end - range_start).days <= 1 and not department_ids:
+            # Один день - один запрос, строки отдаются прямо из сокета
+            yield from self._iter_sales_window(start_date, end_date, None, stats)
+        else:
+            # Начальное разбиение: окна по датам x подразделения
+            if not department_ids:
+                department_groups = [None]
+            elif split_departments:
+                department_groups = [(department_id,) for department_id in department_ids]
+            else:
+                department_groups = [tuple(department_ids)]
+            windows = []
+            window_start = range_start
+            while window_start < range_end:
+                window_end = min(window_start + timedelta(days=window_days), range_end)
+                for group in department_groups:
+                    windows.append((window_start, window_end, group))
+                window_start = window_end
+            
+            logger.info(f"Загрузка продаж с {start_date} по {end_date} разбита на {len(windows)} окон")
+            yield from self._iter_sales_windows(windows, max_parallel or IIKO_OLAP_MAX_PARALLEL, stats)
+        
+        logger.info(f"Загружено {stats['loaded']} записей о продажах")
+        logger.info(f"Статистика фильтрации: пропущено отмененных чеков: {stats['skipped_storned']}, пропущено возвратов: {stats['skipped_returns']}")
+    
+    def _iter_sales_windows(self, windows: list, max_parallel: int, stats: dict):
+        """Параллельная загрузка окон OLAP-отчета с дроблением неудачных окон
+        
+        Одновременно в работе не больше max_parallel окон. Потоки загрузки передают
+        строки порциями по SALES_QUEUE_CHUNK_ROWS через очередь на 2 * max_parallel
+        порций и ждут, пока потребитель ее разберет, поэтому в памяти находится не больше
+        3 * max_parallel * SALES_QUEUE_CHUNK_ROWS строк независимо от размера окон.
+        
+        Строки окна, прерванного ошибкой, уже могли быть отданы: при повторной загрузке
+        его частей они придут еще раз (запись продаж идет upsert по ключу, повтор безопасен).
+        """
+        import logging
+        import threading
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import timedelta
+        from queue import Queue, Full
+        
+        logger = logging.getLogger(__name__)
+        
+        results = Queue(maxsize=2 * max_parallel)
+        stopped = threading.Event()
+        
+        class Cancelled(Exception):
+            pass
+        
+        def put(message):
+            # Ожидание места в очереди с проверкой остановки потребителя
+            while True:
+                if stopped.is_set():
+                    raise Cancelled()
+                try:
+                    results.put(message, timeout=0.1)
+                    return
+                except Full:
+                    continue
+        
+        def fetch(window):
+            window_start, window_end, group = window
+            window_stats = {'loaded': 0, 'skipped_storned': 0, 'skipped_returns': 0}
+            stream = self._iter_sales_window(
+                window_start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d'),
+                list(group) if group else None, window_stats, max_rows=IIKO_OLAP_MAX_WINDOW_ROWS
+            )
+            try:
+                rows = []
+                for row in stream:
+                    rows.append(row)
+                    if len(rows) >= self.SALES_QUEUE_CHUNK_ROWS:
+                        put(('rows', window, rows))
+                        rows = []
+                if rows:
+                    put(('rows', window, rows))
+                put(('done', window, window_stats))
+            except Cancelled:
+                pass
+            except Exception as e:
+                try:
+                    put(('error', window, e))
+                except Cancelled:
+                    pass
+            finally:
+                # Закрывает ответ API, если загрузка прервана
+                stream.close()
+        
+        def split(window):
+            """Деление окна пополам: по датам, а однодневного окна - по подразделениям"""
+            window_start, window_end, group = window
+            days = (window_end - window_start).days
+            if days > 1:
+                middle = window_start + timedelta(days=days // 2)
+                return [(window_start, middle, group), (middle, window_end, group)]
+            if group and len(group) > 1:
+                middle = len(group) // 2
+                return [(window_start, window_end, group[:middle]), (window_start, window_end, group[middle:])]
+            return None
+        
+        waiting = deque(windows)
+        executor = ThreadPoolExecutor(max_workers=max_parallel)
+        try:
+            running = 0
+            while waiting or running:
+                while waiting and running < max_parallel:
+                    executor.submit(fetch, waiting.popleft())
+                    running += 1
+                
+                kind, window, payload = results.get()
+                if kind == 'rows':
+                    yield from payload
+                elif kind == 'done':
+                    running -= 1
+                    for key, value in payload.items():
+                        stats[key] += value
+                else:
+                    running -= 1
+                    parts = split(window)
+                    if not parts:
+                        logger.error(f"Не удалось загрузить окно продаж {window[0]} - {window[1]}: {payload}")
+                        raise payload
+                    logger.warning(f"Окно продаж {window[0]} - {window[1]} не загружено ({payload}), делим на части")
+                    waiting.extendleft(reversed(parts))
+        finally:
+            # Потоки, ожидающие места в очереди, завершаются без записи
+            stopped.set()
+            executor.shutdown(wait=True)
+    
+    def _iter_sales_window(self, start_date: str, end_date: str, department_ids: Optional[list],
+                           stats: dict, max_rows: Optional[int] = None):
+        """Потоковая загрузка одного окна OLAP-отчета по продажам
+        
+        :param max_rows: Порог строк, после которого загрузка прерывается с SalesWindowTooLarge
+        """
+        import logging
+        from src.json_stream import iter_json_array
+        
+        logger = logging.getLogger(__name__)
+        
         sales_url = f"{self.base_url}/v2/reports/olap"
         
         headers = {
@@ -171,11 +533,53 @@ class IikoApiClient:
             'key': self.token
         }
         
-        # Формируем тело запроса в соответствии с OLAP API
+        request_body = self._sales_request_body(start_date, end_date, department_ids)
+        
+        logger.info(f"Загрузка продаж с {start_date} по {end_date}" +
+                    (f" для {len(department_ids)} подразделений" if department_ids else "") + "...")
+        logger.debug(f"Request body: {json.dumps(request_body, indent=2)}")
+        
+        response = self._request('POST', sales_url, params=params, headers=headers, json=request_body,
+                                 timeout=(IIKO_HTTP_CONNECT_TIMEOUT, IIKO_HTTP_OLAP_READ_TIMEOUT), stream=True)
+        response_status = response.status_code
+        logger.info(f"Получен ответ от API со статусом: {response_status}")
+        
+        try:
+            if response.status_code == 409:
+                logger.error(f"API returned 409 Conflict. Response: {response.text}")
+            
+            response.raise_for_status()
+            
+            # Преобразуем данные из OLAP в колонки модели Sale; карта полей компилируется один раз на ответ
+            normalizer = OlapRowNormalizer(SALES_FIELDS)
+            first_row = True
+            rows_count = 0
+            for row in iter_json_array(response.iter_content(chunk_size=65536), key='data'):
+                # Выводим первую строку для отладки
+                if first_row:
+                    first_row = False
+                    logger.debug(f"Sample raw sales data row keys: {list(row.keys())}")
+                    logger.debug(f"Sample raw sales data first row: {row}")
+                
+                rows_count += 1
+                if max_rows and rows_count > max_rows:
+                    raise SalesWindowTooLarge(f"Окно {start_date} - {end_date} содержит больше {max_rows} строк")
+                
+                sale_item = self._normalize_sales_row(row, stats, normalizer)
+                if sale_item is not None:
+                    stats['loaded'] += 1
+                    yield sale_item
+        finally:
+            response.close()
+    
+    @staticmethod
+    def _sales_request_body(start_date: str, end_date: str, department_ids: Optional[list] = None) -> dict:
+        """Тело OLAP-запроса по продажам в соответствии с OLAP API"""
         request_body = {
             "reportType": "SALES",
             "groupByRowFields": [
                 "OrderNum",
+                "UniqOrderId.Id",
                 "Department", 
                 "DishName",
                 "DishCode",
@@ -207,7 +611,9 @@ class IikoApiClient:
                     "filterType": "DateRange",
                     "periodType": "CUSTOM",
                     "from": start_date,
-                    "to": end_date
+                    "to": end_date,
+                    "includeLow": True,
+                    "includeHigh": False
                 },
                 "OrderDeleted": {
                     "filterType": "IncludeValues",
@@ -226,102 +632,49 @@ class IikoApiClient:
             }
         }
         
-        logger.info(f"Загрузка продаж с {start_date} по {end_date}...")
-        logger.debug(f"Request body: {json.dumps(request_body, indent=2)}")
+        if department_ids:
+            request_body["filters"]["Department.Id"] = {
+                "filterType": "IncludeValues",
+                "values": list(department_ids)
+            }
         
-        response = requests.post(sales_url, params=params, headers=headers, json=request_body)
-        response_status = response.status_code
-        logger.info(f"Получен ответ от API со статусом: {response_status}")
+        return request_body
+    
+    def get_sales(self, start_date=None, end_date=None, department_ids: Optional[list] = None) -> list:
+        """Получение данных о продажах
         
-        if response.status_code == 409:
-            logger.error(f"API returned 409 Conflict. Response: {response.text}")
+        :param start_date: Начальная дата в формате YYYY-MM-DD
+        :param end_date: Конечная дата в формате YYYY-MM-DD
+        :param department_ids: ID подразделений для разбиения по фильтру Department.Id
+        :return: Список продаж (словари с колонками модели Sale)
+        """
+        return list(self.iter_sales(start_date, end_date, department_ids))
+    
+    @staticmethod
+    def _normalize_sales_row(row: dict, stats: dict, normalizer: OlapRowNormalizer) -> Optional[dict]:
+        """Приведение строки OLAP-отчета к колонкам модели Sale
         
-        response.raise_for_status()
+        :return: Запись о продаже или None, если строка отфильтрована
+        """
+        sale_item = normalizer(row)
         
-        sales_data = response.json()
+        # Пропускаем отмененные чеки и возвраты
+        if sale_item['storned']:
+            stats['skipped_storned'] += 1
+            return None
         
-        if isinstance(sales_data, dict) and 'data' in sales_data:
-            sales_data = sales_data['data']
-            
-        # Преобразуем данные из OLAP в формат, который ожидает синхронизатор
-        formatted_sales = []
-        skipped_storned = 0
-        skipped_returns = 0
-        
-        if isinstance(sales_data, list) and sales_data:
-            # Выводим первую строку для отладки
-            if sales_data:
-                logger.info(f"Sample raw sales data row keys: {list(sales_data[0].keys())}")
-                logger.info(f"Sample raw sales data first row: {sales_data[0]}")
-                
-            for row in sales_data:
-                # Проверка флагов для отмены чека
-                dish_return_sum = None
-                is_storned = False
-                
-                # Проверим на отмененный чек и возврат
-                for key, value in row.items():
-                    if key.endswith('DishReturnSum'):
-                        try:
-                            dish_return_sum = int(value) if value else 0
-                        except (ValueError, TypeError):
-                            dish_return_sum = 0
-                    elif key.endswith('Storned') and value and value.upper() == 'TRUE':
-                        is_storned = True
-                
-                # Пропускаем отмененные чеки и возвраты
-                if is_storned:
-                    logger.debug(f"Skipping storned check with flag Storned=TRUE")
-                    skipped_storned += 1
-                    continue
-                
-                if dish_return_sum and dish_return_sum > 0:
-                    logger.debug(f"Skipping return item with DishReturnSum = {dish_return_sum}")
-                    skipped_returns += 1
-                    continue
-                
-                sale_item = {}
-                store_name = None
-                
-                # Сначала найдем имя склада, проверяя все ключи
-                for key, value in row.items():
-                    if key.endswith('Store.Name'):
-                        store_name = value
-                        break
-                
-                # Теперь обработаем все поля
-                for key, value in row.items():
-                    # Удаляем префиксы с номерами колонок из OLAP результата
-                    clean_key = key.split('.')[-1]  # Берем только часть после последней точки
-                    
-                    # Особые случаи
-                    if key.endswith('CashRegisterName.Number'):
-                        sale_item["CashRegisterName.Number"] = value
-                    elif key.endswith('CashRegisterName.CashRegisterSerialNumber'):
-                        sale_item["CashRegisterName.CashRegisterSerialNumber"] = value
-                    elif key.endswith('Department.Id'):
-                        sale_item["Department.Id"] = value
-                    elif key.endswith('OrderIncrease.Type'):
-                        sale_item["OrderIncrease.Type"] = value
-                    else:
-                        sale_item[clean_key] = value
-                
-                # Добавляем имя склада, если нашли
-                if store_name:
-                    sale_item["Store.Name"] = store_name
-                formatted_sales.append(sale_item)
+        if sale_item['dish_return_sum'] and sale_item['dish_return_sum'] > 0:
+            stats['skipped_returns'] += 1
+            return None
         
-        logger.info(f"Загружено {len(formatted_sales)} записей о продажах")
-        logger.info(f"Статистика фильтрации: пропущено отмененных чеков: {skipped_storned}, пропущено возвратов: {skipped_returns}")
-        return formatted_sales
+        return sale_item
     
     def get_accounts(self, include_deleted: bool = False) -> list:
         """Получение списка счетов"""
         import logging
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         accounts_url = f"{self.base_url}/v2/entities/accounts/list"
         headers = {
@@ -334,7 +687,7 @@ class IikoApiClient:
         
         logger.info(f"Загрузка списка счетов...")
         
-        response = requests.get(accounts_url, params=params, headers=headers)
+        response = self._request('GET', accounts_url, params=params, headers=headers)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
@@ -350,8 +703,7 @@ class IikoApiClient:
         import logging
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         prices_url = f"{self.base_url}/v2/price"
         headers = {
@@ -367,7 +719,7 @@ class IikoApiClient:
         
         logger.info(f"Загрузка цен для подразделения {department_id} с {date_from} по {date_to}, тип: {price_type}")
         
-        response = requests.get(prices_url, params=params, headers=headers)
+        response = self._request('GET', prices_url, params=params, headers=headers)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
@@ -388,10 +740,10 @@ class IikoApiClient:
     def get_suppliers(self) -> list:
         """Получение списка поставщиков из API"""
         import logging
+        from src.xml_stream import iter_xml_records
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         suppliers_url = f"{self.base_url}/suppliers"
         headers = {
@@ -404,47 +756,54 @@ class IikoApiClient:
         
         logger.info(f"Загрузка списка поставщиков...")
         
-        response = requests.get(suppliers_url, params=params, headers=headers)
+        response = self._request('GET', suppliers_url, params=params, headers=headers, stream=True)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
-        response.raise_for_status()
-        
-        # Парсим XML ответ
-        import xml.etree.ElementTree as ET
-        root = ET.fromstring(response.content)
-        
-        suppliers = []
-        for employee in root.findall('.//employee'):
-            # Берем только тех, кто является поставщиком
-            is_supplier = employee.find('supplier')
-            if is_supplier is not None and is_supplier.text == 'true':
+        try:
+            response.raise_for_status()
+            
+            # Потоково парсим XML ответ: /suppliers возвращает всех сотрудников,
+            # поэтому берем только тех, кто является поставщиком, не накапливая остальных
+            suppliers = []
+            for fields in iter_xml_records(response.iter_content(chunk_size=65536), 'employee',
+                                           where=lambda f: f.get('supplier') == 'true'):
                 supplier = {
-                    'id': employee.find('id').text if employee.find('id') is not None else None,
-                    'code': employee.find('code').text if employee.find('code') is not None else None,
-                    'name': employee.find('name').text if employee.find('name') is not None else None,
-                    'login': employee.find('login').text if employee.find('login') is not None else None,
-                    'cardNumber': employee.find('cardNumber').text if employee.find('cardNumber') is not None else None,
-                    'taxpayerIdNumber': employee.find('taxpayerIdNumber').text if employee.find('taxpayerIdNumber') is not None else None,
-                    'snils': employee.find('snils').text if employee.find('snils') is not None else None,
-                    'deleted': employee.find('deleted').text == 'true' if employee.find('deleted') is not None else False,
-                    'supplier': employee.find('supplier').text == 'true' if employee.find('supplier') is not None else False,
-                    'employee': employee.find('employee').text == 'true' if employee.find('employee') is not None else False,
-                    'client': employee.find('client').text == 'true' if employee.find('client') is not None else False,
-                    'representsStore': employee.find('representsStore').text == 'true' if employee.find('representsStore') is not None else False
+                    'id': fields.get('id'),
+                    'code': fields.get('code'),
+                    'name': fields.get('name'),
+                    'login': fields.get('login'),
+                    'cardNumber': fields.get('cardNumber'),
+                    'taxpayerIdNumber': fields.get('taxpayerIdNumber'),
+                    'snils': fields.get('snils'),
+                    'deleted': fields.get('deleted') == 'true',
+                    'supplier': True,
+                    'employee': fields.get('employee') == 'true',
+                    'client': fields.get('client') == 'true',
+                    'representsStore': fields.get('representsStore') == 'true'
                 }
                 suppliers.append(supplier)
+        finally:
+            response.close()
         
         logger.info(f"Загружено {len(suppliers)} поставщиков")
         return suppliers
     
     def get_departments(self) -> list:
         """Получение списка подразделений из API"""
+        return self.get_departments_since(-1)[0]
+    
+    def get_departments_since(self, revision_from: int = -1) -> tuple:
+        """Получение подразделений, измененных после указанной ревизии
+        
+        :param revision_from: Ревизия, после которой нужны изменения (-1 - все подразделения)
+        :return: (список подразделений, максимальная ревизия ответа или None)
+        """
         import logging
+        from src.xml_stream import iter_xml_records
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         departments_url = f"{self.base_url}/corporation/departments"
         headers = {
@@ -453,45 +812,54 @@ class IikoApiClient:
         
         params = {
             'key': self.token,
-            'revisionFrom': '-1'
+            'revisionFrom': str(revision_from)
         }
         
-        logger.info(f"Загрузка списка подразделений...")
+        logger.info(f"Загрузка списка подразделений (revisionFrom={revision_from})...")
         
-        response = requests.get(departments_url, params=params, headers=headers)
+        response = self._request('GET', departments_url, params=params, headers=headers, stream=True)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
-        response.raise_for_status()
-        
-        # Парсим XML ответ
-        import xml.etree.ElementTree as ET
-        root = ET.fromstring(response.content)
-        
-        departments = []
-        for item in root.findall('.//corporateItemDto'):
-            department = {
-                'id': item.find('id').text if item.find('id') is not None else None,
-                'parentId': item.find('parentId').text if item.find('parentId') is not None else None,
-                'code': item.find('code').text if item.find('code') is not None else None,
-                'name': item.find('name').text if item.find('name') is not None else None,
-                'type': item.find('type').text if item.find('type') is not None else 'DEPARTMENT',
-                'taxpayerIdNumber': item.find('taxpayerIdNumber').text if item.find('taxpayerIdNumber') is not None else None
-            }
-            departments.append(department)
+        try:
+            response.raise_for_status()
+            
+            # Потоково парсим XML ответ
+            departments = []
+            root_attrib = {}
+            revision = None
+            for fields in iter_xml_records(response.iter_content(chunk_size=65536), 'corporateItemDto',
+                                           root_attrib=root_attrib):
+                revision = _max_revision(revision, fields.get('revision'))
+                department = {
+                    'id': fields.get('id'),
+                    'parentId': fields.get('parentId'),
+                    'code': fields.get('code'),
+                    'name': fields.get('name'),
+                    'type': fields.get('type') if 'type' in fields else 'DEPARTMENT',
+                    'taxpayerIdNumber': fields.get('taxpayerIdNumber')
+                }
+                departments.append(department)
+        finally:
+            response.close()
         
-        logger.info(f"Загружено {len(departments)} подразделений")
-        return departments
+        revision = _max_revision(revision, root_attrib.get('revision'))
+        logger.info(f"Загружено {len(departments)} подразделений, ревизия: {revision}")
+        return departments, revision
     
-    def get_writeoff_documents(self, date_from=None, date_to=None) -> list:
-        """Получение документов списания за период с фильтрацией по статусам NEW и PROCESSED"""
+    def iter_writeoff_documents(self, date_from=None, date_to=None):
+        """Потоковое получение документов списания за период (только статусы NEW и PROCESSED)
+        
+        Документы отдаются по мере разбора ответа, поэтому их обработка может
+        начинаться до окончания загрузки.
+        """
         import logging
         from datetime import datetime, timedelta
+        from src.json_stream import iter_json_array
         
         logger = logging.getLogger(__name__)
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
         
         # Если даты не указаны, берем вчерашний день для тестирования
         if not date_to:
@@ -511,65 +879,60 @@ class IikoApiClient:
         
         logger.info(f"Загрузка документов списания с {date_from} по {date_to}...")
         
-        response = requests.get(writeoff_url, params=params, headers=headers)
+        response = self._request('GET', writeoff_url, params=params, headers=headers, stream=True)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
-        response.raise_for_status()
-        
-        response_data = response.json()
-        
-        # Проверяем структуру ответа
-        if isinstance(response_data, dict) and 'response' in response_data:
-            documents_data = response_data['response']
-        else:
-            documents_data = response_data
-            
-        logger.info(f"Всего получено {len(documents_data)} документов списания")
-        
-        # Сначала проанализируем статусы, которые приходят из API
+        # Фильтруем документы только со статусами NEW и PROCESSED
+        allowed_statuses = ['NEW', 'PROCESSED']
         status_counts = {}
-        for doc in documents_data:
-            status = doc.get('status', 'Unknown')
-            status_counts[status] = status_counts.get(status, 0) + 1
+        passed = 0
         
+        try:
+            response.raise_for_status()
+            
+            # Ответ - массив документов или объект с массивом в поле response
+            for doc in iter_json_array(response.iter_content(chunk_size=65536), key='response'):
+                doc_status = doc.get('status', 'Unknown')
+                status_counts[doc_status] = status_counts.get(doc_status, 0) + 1
+                if doc_status in allowed_statuses:
+                    passed += 1
+                    yield doc
+                else:
+                    logger.debug(f"Пропущен документ {doc.get('documentNumber', 'без номера')} со статусом {doc_status}")
+        finally:
+            response.close()
+        
+        logger.info(f"Всего получено {sum(status_counts.values())} документов списания")
         if status_counts:
             logger.info(f"Статусы документов из API: {status_counts}")
-        
-        # Фильтруем документы только со статусами NEW и PROCESSED
-        allowed_statuses = ['NEW', 'PROCESSED']
-        filtered_documents = []
-        
-        for doc in documents_data:
-            doc_status = doc.get('status', '')
-            if doc_status in allowed_statuses:
-                filtered_documents.append(doc)
-            else:
-                logger.debug(f"Пропущен документ {doc.get('documentNumber', 'без номера')} со статусом {doc_status}")
-        
-        logger.info(f"После фильтрации по статусам ({', '.join(allowed_statuses)}) осталось {len(filtered_documents)} документов")
-        
-        return filtered_documents
+        logger.info(f"После фильтрации по статусам ({', '.join(allowed_statuses)}) осталось {passed} документов")
     
-    def get_incoming_invoices(self, from_date: str, to_date: str, supplier_id: str = None) -> list:
-        """Получение приходных накладных из API
+    def get_writeoff_documents(self, date_from=None, date_to=None) -> list:
+        """Получение документов списания за период с фильтрацией по статусам NEW и PROCESSED"""
+        return list(self.iter_writeoff_documents(date_from, date_to))
+    
+    def iter_incoming_invoices(self, from_date: str, to_date: str, supplier_id: str = None):
+        """Потоковое получение приходных накладных из API
+        
+        Накладные отдаются по мере разбора XML-ответа.
         
         Args:
             from_date: Дата начала в формате YYYY-MM-DD
             to_date: Дата окончания в формате YYYY-MM-DD
             supplier_id: ID поставщика (обязательный параметр)
         
-        Returns:
-            list: Список приходных накладных
+        Yields:
+            dict: Приходная накладная со статусом NEW или PROCESSED
         """
         import logging
+        from src.xml_stream import iter_xml_elements
         logger = logging.getLogger(__name__)
         
         if not supplier_id:
             raise ValueError("supplier_id является обязательным параметром для загрузки приходных накладных")
         
-        if not self.token:
-            self.authenticate()
+        self._ensure_token()
             
         invoices_url = f"{self.base_url}/documents/export/incomingInvoice"
         headers = {
@@ -591,82 +954,117 @@ class IikoApiClient:
         
         logger.info(f"Загрузка приходных накладных за период {from_date} - {to_date} для поставщика {supplier_id}")
         
-        response = requests.get(invoices_url, params=params, headers=headers)
+        response = self._request('GET', invoices_url, params=params, headers=headers, stream=True)
         response_status = response.status_code
         logger.info(f"Получен ответ от API со статусом: {response_status}")
         
-        response.raise_for_status()
+        # Фильтруем по статусам сразу при разборе, не создавая позиции лишних документов
+        allowed_statuses = ['NEW', 'PROCESSED']
+        total_count = 0
+        passed = 0
         
-        # Парсим XML ответ
-        import xml.etree.ElementTree as ET
-        root = ET.fromstring(response.content)
+        try:
+            response.raise_for_status()
+            
+            # Потоково парсим XML ответ, обрабатывая каждый документ по мере получения
+            for document in iter_xml_elements(response.iter_content(chunk_size=65536), 'document'):
+                total_count += 1
+                try:
+                    invoice_data = self._parse_incoming_invoice(document, supplier_id, allowed_statuses)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке документа: {e}")
+                    continue
+                if invoice_data is not None:
+                    passed += 1
+                    yield invoice_data
+        finally:
+            response.close()
+        
+        logger.info(f"Загружено {total_count} приходных накладных")
+        logger.info(f"После фильтрации по статусам осталось {passed} накладных")
+    
+    def get_incoming_invoices(self, from_date: str, to_date: str, supplier_id: str = None) -> list:
+        """Получение приходных накладных из API
         
-        invoices_data = []
+        Args:
+            from_date: Дата начала в формате YYYY-MM-DD
+            to_date: Дата окончания в формате YYYY-MM-DD
+            supplier_id: ID поставщика (обязательный параметр)
         
-        # Обрабатываем каждый документ
-        for document in root.findall('.//document'):
-            try:
-                # Извлекаем данные документа
-                invoice_data = {
-                    'id': document.findtext('id'),
-                    'transport_invoice_number': document.findtext('transportInvoiceNumber', ''),
-                    'incoming_document_number': document.findtext('incomingDocumentNumber', ''),
-                    'incoming_date': document.findtext('incomingDate'),
-                    'use_default_document_time': document.findtext('useDefaultDocumentTime', 'false').lower() == 'true',
-                    'due_date': document.findtext('dueDate') if document.findtext('dueDate') != 'null' else None,
-                    'supplier_id': document.findtext('supplier'),
-                    'default_store_id': document.findtext('defaultStore'),
-                    'invoice': document.findtext('invoice', ''),
-                    'date_incoming': document.findtext('dateIncoming'),
-                    'document_number': document.findtext('documentNumber'),
-                    'comment': document.findtext('comment', ''),
-                    'conception': document.findtext('conception'),
-                    'conception_code': document.findtext('conceptionCode', ''),
-                    'status': document.findtext('status', ''),
-                    'distribution_algorithm': document.findtext('distributionAlgorithm', ''),
-                    'items': []
-                }
-                
-                # Обрабатываем позиции документа
-                items_element = document.find('items')
-                if items_element is not None:
-                    for item in items_element.findall('item'):
-                        item_data = {
-                            'is_additional_expense': item.findtext('isAdditionalExpense', 'false').lower() == 'true',
-                            'actual_amount': float(item.findtext('actualAmount', '0')),
-                            'store_id': item.findtext('store'),
-                            'code': item.findtext('code', ''),
-                            'price': float(item.findtext('price', '0')),
-                            'price_without_vat': float(item.findtext('priceWithoutVat', '0')),
-                            'sum': float(item.findtext('sum', '0')),
-                            'vat_percent': float(item.findtext('vatPercent', '0')),
-                            'vat_sum': float(item.findtext('vatSum', '0')),
-                            'discount_sum': float(item.findtext('discountSum', '0')),
-                            'amount_unit': item.findtext('amountUnit'),
-                            'num': int(item.findtext('num', '0')),
-                            'product_id': item.findtext('product'),
-                            'product_article': item.findtext('productArticle', ''),
-                            'amount': float(item.findtext('amount', '0')),
-                            'supplier_id': supplier_id  # Дублируем supplier_id для удобства
-                        }
-                        invoice_data['items'].append(item_data)
-                
-                invoices_data.append(invoice_data)
-                
-            except Exception as e:
-                logger.error(f"Ошибка при обработке документа: {e}")
-                continue
+        Returns:
+            list: Список приходных накладных
+        """
+        return list(self.iter_incoming_invoices(from_date, to_date, supplier_id))
+    
+    @staticmethod
+    def _parse_incoming_invoice(document, supplier_id: str, allowed_statuses: list) -> Optional[dict]:
+        """Преобразование XML-элемента приходной накладной в словарь
         
-        logger.info(f"Загружено {len(invoices_data)} приходных накладных")
+        Поля документа и позиций извлекаются за один проход по дочерним узлам.
         
-        # Фильтруем по статусам (если нужно)
-        allowed_statuses = ['NEW', 'PROCESSED']
-        filtered_invoices = []
+        :return: Данные накладной или None, если статус не входит в allowed_statuses
+        """
+        from src.xml_stream import element_fields
         
-        for invoice in invoices_data:
-            if invoice.get('status') in allowed_statuses:
-                filtered_invoices.append(invoice)
+        fields = {}
+        items_element = None
+        for child in document:
+            if child.tag == 'items':
+                items_element = child
+            else:
+                fields[child.tag] = child.text or ''
+        
+        status = fields.get('status', '')
+        if status not in allowed_statuses:
+            return None
+        
+        due_date = fields.get('dueDate')
+        
+        # Извлекаем данные документа
+        invoice_data = {
+            'id': fields.get('id'),
+            'transport_invoice_number': fields.get('transportInvoiceNumber', ''),
+            'incoming_document_number': fields.get('incomingDocumentNumber', ''),
+            'incoming_date': fields.get('incomingDate'),
+            'use_default_document_time': fields.get('useDefaultDocumentTime', 'false').lower() == 'true',
+            'due_date': due_date if due_date != 'null' else None,
+            'supplier_id': fields.get('supplier'),
+            'default_store_id': fields.get('defaultStore'),
+            'invoice': fields.get('invoice', ''),
+            'date_incoming': fields.get('dateIncoming'),
+            'document_number': fields.get('documentNumber'),
+            'comment': fields.get('comment', ''),
+            'conception': fields.get('conception'),
+            'conception_code': fields.get('conceptionCode', ''),
+            'status': status,
+            'distribution_algorithm': fields.get('distributionAlgorithm', ''),
+            'items': []
+        }
         
-        logger.info(f"После фильтрации по статусам осталось {len(filtered_invoices)} накладных")
+        # Обрабатываем позиции документа
+        if items_element is not None:
+            for item in items_element:
+                if item.tag != 'item':
+                    continue
+                item_fields = element_fields(item)
+                item_data = {
+                    'is_additional_expense': (item_fields.get('isAdditionalExpense') or 'false').lower() == 'true',
+                    'actual_amount': float(item_fields.get('actualAmount') or '0'),
+                    'store_id': item_fields.get('store'),
+                    'code': item_fields.get('code') or '',
+                    'price': float(item_fields.get('price') or '0'),
+                    'price_without_vat': float(item_fields.get('priceWithoutVat') or '0'),
+                    'sum': float(item_fields.get('sum') or '0'),
+                    'vat_percent': float(item_fields.get('vatPercent') or '0'),
+                    'vat_sum': float(item_fields.get('vatSum') or '0'),
+                    'discount_sum': float(item_fields.get('discountSum') or '0'),
+                    'amount_unit': item_fields.get('amountUnit'),
+                    'num': int(item_fields.get('num') or '0'),
+                    'product_id': item_fields.get('product'),
+                    'product_article': item_fields.get('productArticle') or '',
+                    'amount': float(item_fields.get('amount') or '0'),
+                    'supplier_id': supplier_id  # Дублируем supplier_id для удобства
+                }
+                invoice_data['items'].append(item_data)
         
-        return filtered_invoices
+        return invoice_data
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from src.api_client import IikoApiClient
+from config.config import IIKO_ASYNC_MAX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncIikoApiClient:
+    """Асинхронный вариант IikoApiClient для параллельной загрузки данных
+
+    Повторяет все методы IikoApiClient. Запросы выполняются в потоках поверх
+    общего пула соединений и общего токена обернутого клиента, а число
+    одновременных запросов ограничено семафором.
+    """
+
+    def __init__(self, api_client: Optional[IikoApiClient] = None, max_concurrency: Optional[int] = None):
+        self.api_client = api_client or IikoApiClient()
+        self.max_concurrency = max_concurrency or IIKO_ASYNC_MAX_CONCURRENCY
+        self._semaphore = None
+
+    async def _call(self, func, *args, **kwargs):
+        """Выполнение синхронного метода клиента в отдельном потоке"""
+        # Семафор создается внутри работающего event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    @property
+    def token(self) -> Optional[str]:
+        return self.api_client.token
+
+    async def authenticate(self) -> str:
+        """Получение токена авторизации"""
+        return await self._call(self.api_client.authenticate)
+
+    async def ensure_token(self) -> str:
+        """Однократная авторизация перед серией параллельных запросов"""
+        return await self._call(self.api_client._ensure_token)
+
+    async def get_products(self, include_deleted: bool = False) -> list:
+        """Получение списка продуктов"""
+        return await self._call(self.api_client.get_products, include_deleted)
+
+    async def get_stores(self) -> list:
+        """Получение списка складов"""
+        return await self._call(self.api_client.get_stores)
+
+    async def get_stores_since(self, revision_from: int = -1) -> tuple:
+        """Получение складов, измененных после указанной ревизии"""
+        return await self._call(self.api_client.get_stores_since, revision_from)
+
+    async def analyze_products_structure(self) -> Dict[str, set]:
+        """Анализ структуры данных продуктов"""
+        return await self._call(self.api_client.analyze_products_structure)
+
+    async def get_sales(self, start_date=None, end_date=None, department_ids: Optional[list] = None) -> list:
+        """Получение данных о продажах"""
+        return await self._call(self.api_client.get_sales, start_date, end_date, department_ids)
+
+    async def get_accounts(self, include_deleted: bool = False) -> list:
+        """Получение списка счетов"""
+        return await self._call(self.api_client.get_accounts, include_deleted)
+
+    async def get_prices(self, department_id: str, date_from: str, date_to: str, price_type: str = 'BASE') -> list:
+        """Получение цен для подразделения за период"""
+        return await self._call(self.api_client.get_prices, department_id, date_from, date_to, price_type)
+
+    async def get_suppliers(self) -> list:
+        """Получение списка поставщиков"""
+        return await self._call(self.api_client.get_suppliers)
+
+    async def get_departments(self) -> list:
+        """Получение списка подразделений"""
+        return await self._call(self.api_client.get_departments)
+
+    async def get_departments_since(self, revision_from: int = -1) -> tuple:
+        """Получение подразделений, измененных после указанной ревизии"""
+        return await self._call(self.api_client.get_departments_since, revision_from)
+
+    async def get_writeoff_documents(self, date_from=None, date_to=None) -> list:
+        """Получение документов списания за период"""
+        return await self._call(self.api_client.get_writeoff_documents, date_from, date_to)
+
+    async def get_incoming_invoices(self, from_date: str, to_date: str, supplier_id: str = None) -> list:
+        """Получение приходных накладных"""
+        return await self._call(self.api_client.get_incoming_invoices, from_date, to_date, supplier_id)
+
+    async def gather(self, *coroutines, return_exceptions: bool = True) -> list:
+        """Параллельное выполнение нескольких загрузок
+
+        По умолчанию ошибка одной загрузки не отменяет остальные: исключение
+        возвращается на месте ее результата.
+        """
+        await self.ensure_token()
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
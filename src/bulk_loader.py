@@ -0,0 +1,231 @@
+"""
+Массовая загрузка строк в PostgreSQL через COPY и временную staging-таблицу.
+
+Строки потоком передаются командой COPY во временную таблицу с колонками целевой,
+после чего сливаются в целевую таблицу одним INSERT ... SELECT ... ON CONFLICT.
+Повторы ключа внутри загрузки схлопываются (побеждает последняя строка), а
+строки без изменений не переписываются.
+
+Обычный UNIQUE не считает строки с NULL в ключе конфликтующими, и ON CONFLICT для
+них не срабатывает (каждая загрузка вставляла бы дубликат). Поэтому ключ конфликта
+с колонками, допускающими NULL, принимается только при ограничении
+UNIQUE NULLS NOT DISTINCT (postgresql_nulls_not_distinct в модели).
+
+Загрузка выполняется в текущей транзакции сессии и не фиксирует ее.
+"""
+import enum
+import itertools
+import json
+import logging
+from datetime import date, datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import UniqueConstraint
+
+logger = logging.getLogger(__name__)
+
+# Колонки, которые меняются при каждой синхронизации и не считаются изменением данных
+_SERVICE_COLUMNS = ('created_at', 'updated_at', 'synced_at')
+
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _csv_value(value) -> str:
+    """Значение в формате CSV для COPY: пустое поле без кавычек - NULL"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, enum.Enum):
+        value = value.name
+    elif isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False)
+    else:
+        value = str(value)
+    return '"' + value.replace('"', '""') + '"'
+
+
+class _CopyStream:
+    """Файлоподобный объект для cursor.copy_expert поверх итератора строк CSV"""
+
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line.encode('utf-8')
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    readline = read
+
+
+class BulkLoader:
+    """Загрузчик строк в таблицу модели через COPY + слияние
+
+    :param session: Сессия SQLAlchemy (используется ее текущее соединение и транзакция)
+    :param model: Модель целевой таблицы
+    :param conflict_columns: Колонки уникального ключа для ON CONFLICT (None - только вставка)
+    :param update_columns: Колонки, обновляемые при конфликте (по умолчанию все, кроме ключа, id и created_at)
+    :param skip_unchanged: Не обновлять строки, данные которых не изменились
+    :param table_name: Загрузка в другую таблицу той же структуры (например, в таблицу перезагрузки партиции)
+    :param hash_column: Колонка отпечатка данных (content_hash): неизмененность строки
+        определяется сравнением только отпечатков, а не всех колонок
+    """
+
+    def __init__(self, session, model, conflict_columns: Optional[Sequence[str]] = None,
+                 update_columns: Optional[Sequence[str]] = None, skip_unchanged: bool = True,
+                 table_name: Optional[str] = None, hash_column: Optional[str] = None):
+        self.session = session
+        self.table = model.__table__
+        self.table_name = table_name or self.table.name
+        self.conflict_columns = list(conflict_columns or [])
+        self.update_columns = list(update_columns) if update_columns is not None else None
+        self.skip_unchanged = skip_unchanged
+        self.hash_column = hash_column
+        self._staging_seq = itertools.count()
+        self._check_conflict_columns()
+    
+    def _check_conflict_columns(self):
+        """Ключ конфликта с колонками, допускающими NULL, должен быть UNIQUE NULLS NOT DISTINCT"""
+        nullable = [name for name in self.conflict_columns if self.table.columns[name].nullable]
+        if not nullable:
+            return
+        for constraint in self.table.constraints:
+            if not isinstance(constraint, UniqueConstraint):
+                continue
+            if {column.name for column in constraint.columns} != set(self.conflict_columns):
+                continue
+            if constraint.dialect_options['postgresql']['nulls_not_distinct']:
+                return
+        raise ValueError(
+            f"Колонки ключа конфликта {self.table.name} допускают NULL ({', '.join(nullable)}): "
+            f"ON CONFLICT не сработает для строк с NULL, нужно ограничение UNIQUE NULLS NOT DISTINCT"
+        )
+
+    def _defaults(self, columns: List[str]) -> Dict[str, object]:
+        """Python-умолчания модели для колонок, отсутствующих в строках (COPY их не применяет)"""
+        defaults = {}
+        for column in self.table.columns:
+            if column.name in columns or column.default is None:
+                continue
+            if not (column.default.is_scalar or column.default.is_callable):
+                continue
+            defaults[column.name] = column.default
+        return defaults
+
+    def load(self, rows: Iterable[dict]) -> Dict[str, int]:
+        """Загрузка строк (у всех строк одинаковый набор ключей - колонок таблицы)
+
+        :return: {'staged', 'inserted', 'updated', 'unchanged'}
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return {'staged': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        columns = [name for name in first.keys() if name in self.table.columns]
+        defaults = self._defaults(columns)
+        all_columns = columns + list(defaults)
+
+        staged = 0
+
+        def lines():
+            nonlocal staged
+            for row in itertools.chain([first], rows):
+                staged += 1
+                values = [row.get(name) for name in columns]
+                for default in defaults.values():
+                    values.append(default.arg(None) if default.is_callable else default.arg)
+                yield ','.join(_csv_value(value) for value in values) + '\n'
+
+        staging = f"bulk_{self.table_name}_{next(self._staging_seq)}"
+        column_list = ', '.join(_quote_ident(name) for name in all_columns)
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.execute(
+                f"CREATE TEMP TABLE {_quote_ident(staging)} AS "
+                f"SELECT {column_list} FROM {_quote_ident(self.table_name)} WITH NO DATA"
+            )
+            # Порядковый номер строки: при повторе ключа побеждает последняя
+            cursor.execute(f"ALTER TABLE {_quote_ident(staging)} ADD COLUMN _bulk_row BIGSERIAL")
+
+            cursor.copy_expert(
+                f"COPY {_quote_ident(staging)} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+                _CopyStream(lines())
+            )
+
+            cursor.execute(self._merge_sql(staging, all_columns))
+            inserted, updated = cursor.fetchone()
+            cursor.execute(f"DROP TABLE {_quote_ident(staging)}")
+        finally:
+            cursor.close()
+
+        result = {
+            'staged': staged,
+            'inserted': inserted or 0,
+            'updated': updated or 0,
+        }
+        result['unchanged'] = staged - result['inserted'] - result['updated']
+        logger.debug(f"Загрузка в {self.table_name}: {result}")
+        return result
+
+    def _merge_sql(self, staging: str, columns: List[str]) -> str:
+        target = _quote_ident(self.table_name)
+        column_list = ', '.join(_quote_ident(name) for name in columns)
+
+        if not self.conflict_columns:
+            insert = (f"INSERT INTO {target} ({column_list}) "
+                      f"SELECT {column_list} FROM {_quote_ident(staging)} ORDER BY _bulk_row "
+                      f"RETURNING true AS inserted")
+        else:
+            # NULL в ключе допустим только при NULLS NOT DISTINCT (см. _check_conflict_columns):
+            # такие строки конфликтуют, и DISTINCT ON схлопывает их так же, как ON CONFLICT
+            keys = [_quote_ident(name) for name in self.conflict_columns]
+
+            update_columns = self.update_columns
+            if update_columns is None:
+                update_columns = [name for name in columns
+                                  if name not in self.conflict_columns and name not in ('id', 'created_at')]
+            compare_columns = [name for name in update_columns if name not in _SERVICE_COLUMNS]
+            if self.hash_column and self.hash_column in columns:
+                compare_columns = [self.hash_column]
+            # У типа json нет оператора сравнения - сравниваем текстовое представление
+            json_columns = {column.name for column in self.table.columns
+                            if column.type.__class__.__name__ in ('JSON', 'JSONB')}
+
+            set_clause = ', '.join(f"{_quote_ident(name)} = EXCLUDED.{_quote_ident(name)}"
+                                   for name in update_columns)
+            insert = (f"INSERT INTO {target} AS t ({column_list}) "
+                      f"SELECT DISTINCT ON ({', '.join(keys)}) {column_list} "
+                      f"FROM {_quote_ident(staging)} "
+                      f"ORDER BY {', '.join(keys)}, _bulk_row DESC "
+                      f"ON CONFLICT ({', '.join(keys)}) ")
+            if not set_clause:
+                insert += "DO NOTHING "
+            else:
+                insert += f"DO UPDATE SET {set_clause} "
+                if self.skip_unchanged and compare_columns:
+                    cast = lambda name: '::text' if name in json_columns else ''
+                    target_values = ', '.join(f"t.{_quote_ident(name)}{cast(name)}" for name in compare_columns)
+                    new_values = ', '.join(f"EXCLUDED.{_quote_ident(name)}{cast(name)}" for name in compare_columns)
+                    insert += f"WHERE ({target_values}) IS DISTINCT FROM ({new_values}) "
+                    if compare_columns == [self.hash_column]:
+                        # Строка без отпечатка (например, с неразрешенными ссылками) обновляется всегда
+                        insert += f"OR EXCLUDED.{_quote_ident(self.hash_column)} IS NULL "
+            insert += "RETURNING (xmax = 0) AS inserted"
+
+        return (f"WITH merged AS ({insert}) "
+                f"SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged")
@@ -8,6 +8,8 @@ import uuid
 
 from .models import Department, SyncLog
 from .api_client import IikoApiClient
+from .sync_state import get_sync_state, save_sync_state
+from .reference_resolver import get_reference_resolver
 
 logger = logging.getLogger(__name__)
 
@@ -19,15 +21,23 @@ class DepartmentSynchronizer:
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
     
-    def sync_departments(self) -> Dict[str, any]:
-        """Синхронизация подразделений из IIKO API"""
+    def sync_departments(self, full_refresh: bool = False) -> Dict[str, any]:
+        """Синхронизация подразделений из IIKO API
+        
+        Запрашиваются только подразделения, измененные после последней сохраненной ревизии.
+        
+        :param full_refresh: Игнорировать сохраненную ревизию и запросить все подразделения
+        """
         logger.info("Начинаем синхронизацию подразделений...")
         start_time = datetime.now()
         
         try:
-            # Получаем данные из API
-            departments_data = self.api_client.get_departments()
-            logger.info(f"Получено {len(departments_data)} подразделений из API")
+            state = None if full_refresh else get_sync_state(self.session, 'departments')
+            revision_from = state.revision if state and state.revision is not None else -1
+            
+            # Получаем данные из API (только изменения после сохраненной ревизии)
+            departments_data, revision = self.api_client.get_departments_since(revision_from)
+            logger.info(f"Получено {len(departments_data)} подразделений из API (revisionFrom={revision_from})")
             
             created_count = 0
             updated_count = 0
@@ -74,6 +84,10 @@ class DepartmentSynchronizer:
                     self.session.rollback()
                     skipped_count += 1
             
+            # Запоминаем ревизию для следующего запуска
+            if revision is not None:
+                save_sync_state(self.session, 'departments', revision=revision)
+            
             # Создаем запись в логе синхронизации
             sync_log = SyncLog(
                 entity_type='departments',
@@ -83,11 +97,14 @@ class DepartmentSynchronizer:
                     'created': created_count,
                     'updated': updated_count,
                     'skipped': skipped_count,
+                    'revision_from': revision_from,
+                    'revision': revision,
                     'duration_seconds': (datetime.now() - start_time).total_seconds()
                 }
             )
             self.session.add(sync_log)
             self.session.commit()
+            get_reference_resolver().invalidate('departments')
             
             result = {
                 'status': 'success',
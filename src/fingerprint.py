@@ -0,0 +1,94 @@
+"""
+Отпечатки содержимого строк (колонка content_hash).
+
+Отпечаток - MD5 от канонического представления значений колонок, пришедших из
+API. Перед записью отпечаток сравнивается с сохраненным: совпавшие строки не
+переписываются (не создаются новые версии строк, WAL и работа для VACUUM),
+а по итогам синхронизации в SyncLog.details попадает разбивка
+new / changed / unchanged.
+
+Числа приводятся к одному виду (1, 1.0 и Decimal('1.00') дают один отпечаток),
+UUID - к строке в нижнем регистре, даты - к ISO-формату.
+"""
+import enum
+import hashlib
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Sequence
+
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+# Строк в одном запросе сохраненных отпечатков (IN (...))
+_LOAD_CHUNK_SIZE = 5000
+
+
+def _canonical(value):
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (int, float, Decimal)):
+        number = Decimal(str(value)).normalize()
+        return format(number, 'f')
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    return str(value)
+
+
+def content_hash(row: dict, columns: Sequence[str], extra=None) -> str:
+    """Отпечаток значений колонок строки
+
+    :param row: Значения колонок
+    :param columns: Колонки, входящие в отпечаток (порядок важен)
+    :param extra: Дополнительные данные, влияющие на запись (например, позиции документа)
+    """
+    payload = [_canonical(row.get(name)) for name in columns]
+    if extra is not None:
+        payload.append(_canonical(extra))
+    encoded = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+    return hashlib.md5(encoded.encode('utf-8')).hexdigest()
+
+
+def load_hashes(session, model, keys: Optional[Iterable] = None) -> Dict[str, Optional[str]]:
+    """Сохраненные отпечатки строк модели по id одним запросом на порцию ключей
+
+    :param keys: ID строк (None - все строки таблицы)
+    :return: {id в нижнем регистре: content_hash или None}
+    """
+    if keys is None:
+        return {str(row_id).lower(): value for row_id, value in session.query(model.id, model.content_hash)}
+
+    keys = list({str(key).lower() for key in keys if key})
+    hashes = {}
+    for start in range(0, len(keys), _LOAD_CHUNK_SIZE):
+        chunk = keys[start:start + _LOAD_CHUNK_SIZE]
+        query = session.query(model.id, model.content_hash).filter(model.id.in_(chunk))
+        hashes.update((str(row_id).lower(), value) for row_id, value in query)
+    return hashes
+
+
+def classify(stored: Dict[str, Optional[str]], key, current: str) -> str:
+    """new, changed или unchanged для строки по сохраненным отпечаткам"""
+    key = str(key).lower()
+    if key not in stored:
+        return NEW
+    return UNCHANGED if stored[key] == current else CHANGED
+
+
+def empty_diff() -> Dict[str, int]:
+    return {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+
+
+def diff_from_load(loaded: Dict[str, int]) -> Dict[str, int]:
+    """Разбивка по счетчикам BulkLoader.load (inserted / updated / unchanged)"""
+    return {NEW: loaded['inserted'], CHANGED: loaded['updated'], UNCHANGED: loaded['unchanged']}
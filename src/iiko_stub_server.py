@@ -0,0 +1,462 @@
+"""
+Локальный заменитель IIKO REST API для воспроизводимых замеров без сервера ресторана.
+
+Режимы:
+- replay (по умолчанию): отдает фикстуры из --fixtures-dir, а для эндпоинтов без
+  фикстуры - синтетические данные (детерминированные, связанные между собой:
+  цены, списания и накладные ссылаются на существующие продукты и склады);
+- record: проксирует запросы на настоящий сервер (--record-from) и сохраняет ответы
+  в фикстуры (кроме /auth и /logout).
+
+Задержка ответа и доля ошибок настраиваются для проверки параллельной загрузки,
+ограничителя нагрузки и повторов.
+
+Запуск:
+    python -m src.iiko_stub_server --port 8099 --latency 0.2 --fail-rate 0.05
+    IIKO_API_BASE_URL=http://127.0.0.1:8099/resto/api python main.py --entity products
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+
+STUB_TOKEN = 'stub-token-0000'
+
+# (суффикс пути, имя фикстуры, формат)
+ROUTES = [
+    ('/auth', 'auth', 'text'),
+    ('/logout', 'logout', 'text'),
+    ('/v2/entities/products/list', 'products', 'json'),
+    ('/v2/entities/accounts/list', 'accounts', 'json'),
+    ('/v2/reports/olap', 'olap', 'json'),
+    ('/corporation/stores', 'stores', 'xml'),
+    ('/corporation/departments', 'departments', 'xml'),
+    ('/v2/price', 'price', 'json'),
+    ('/suppliers', 'suppliers', 'xml'),
+    ('/v2/documents/writeoff', 'writeoff', 'json'),
+    ('/documents/export/incomingInvoice', 'incomingInvoice', 'xml'),
+]
+
+CONTENT_TYPES = {
+    'json': 'application/json; charset=utf-8',
+    'xml': 'application/xml; charset=utf-8',
+    'text': 'text/plain; charset=utf-8',
+}
+
+_NAMESPACE = uuid.UUID('6f1c1a52-5d1e-4f55-9d33-6b8f3c2a9e10')
+
+
+def _uid(kind: str, index: int) -> str:
+    """Детерминированный UUID сущности: одинаковый между запусками и эндпоинтами"""
+    return str(uuid.uuid5(_NAMESPACE, f'{kind}:{index}'))
+
+
+def _match_route(path: str) -> Optional[tuple]:
+    for suffix, name, fmt in ROUTES:
+        if path.rstrip('/').endswith(suffix):
+            return suffix, name, fmt
+    return None
+
+
+def _xml_items(root: str, tag: str, items: list) -> str:
+    parts = [f'<?xml version="1.0" encoding="UTF-8"?><{root}>']
+    for item in items:
+        parts.append(f'<{tag}>')
+        for key, value in item.items():
+            if isinstance(value, list):
+                parts.append(f'<{key}>')
+                for child in value:
+                    parts.append('<item>' + ''.join(
+                        f'<{k}>{escape(str(v))}</{k}>' for k, v in child.items()) + '</item>')
+                parts.append(f'</{key}>')
+            elif value is None:
+                parts.append(f'<{key}/>')
+            else:
+                parts.append(f'<{key}>{escape(str(value))}</{key}>')
+        parts.append(f'</{tag}>')
+    parts.append(f'</{root}>')
+    return ''.join(parts)
+
+
+class SyntheticData:
+    """Синтетические ответы IIKO API заданного объема"""
+
+    def __init__(self, products: int, stores: int, departments: int, suppliers: int,
+                 sales_per_day: int, documents_per_day: int):
+        self.products = products
+        self.stores = stores
+        self.departments = departments
+        self.suppliers = suppliers
+        self.sales_per_day = sales_per_day
+        self.documents_per_day = documents_per_day
+
+    @staticmethod
+    def _days(date_from: str, date_to: str, include_last: bool = False):
+        start = datetime.strptime(date_from[:10], '%Y-%m-%d')
+        end = datetime.strptime(date_to[:10], '%Y-%m-%d')
+        if include_last:
+            end += timedelta(days=1)
+        day = start
+        while day < end:
+            yield day
+            day += timedelta(days=1)
+
+    def build(self, name: str, query: dict, body: Optional[dict]) -> str:
+        return getattr(self, f'_{name}')(query, body)
+
+    def _auth(self, query, body):
+        return STUB_TOKEN
+
+    def _logout(self, query, body):
+        return ''
+
+    def _products(self, query, body):
+        return json.dumps([{
+            'id': _uid('product', i),
+            'deleted': False,
+            'name': f'Товар {i}',
+            'description': None,
+            'num': f'{i:05d}',
+            'code': str(10000 + i),
+            'parent': None,
+            'modifiers': [],
+            'taxCategory': None,
+            'category': _uid('category', i % 20),
+            'accountingCategory': None,
+            'type': 'GOODS',
+            'mainUnit': _uid('unit', 0),
+        } for i in range(self.products)], ensure_ascii=False)
+
+    def _accounts(self, query, body):
+        return json.dumps([{
+            'id': _uid('account', i),
+            'deleted': False,
+            'code': str(i),
+            'name': f'Счет {i}',
+            'type': 'EXPENSES',
+            'system': False,
+        } for i in range(10)], ensure_ascii=False)
+
+    def _stores(self, query, body):
+        return _xml_items('corporateItemDtoes', 'corporateItemDto', [{
+            'id': _uid('store', i),
+            'parentId': None,
+            'code': str(i),
+            'name': f'Склад {i}',
+            'type': 'STORE',
+            'deleted': 'false',
+        } for i in range(self.stores)])
+
+    def _departments(self, query, body):
+        return _xml_items('corporateItemDtoes', 'corporateItemDto', [{
+            'id': _uid('department', i),
+            'parentId': None,
+            'code': str(i),
+            'name': f'Подразделение {i}',
+            'type': 'DEPARTMENT',
+            'taxpayerIdNumber': None,
+        } for i in range(self.departments)])
+
+    def _suppliers(self, query, body):
+        return _xml_items('employees', 'employee', [{
+            'id': _uid('supplier', i),
+            'code': str(i),
+            'name': f'Поставщик {i}',
+            'deleted': 'false',
+            'supplier': 'true',
+            'employee': 'false',
+            'client': 'false',
+        } for i in range(self.suppliers)])
+
+    def _price(self, query, body):
+        department_id = query.get('departmentId') or _uid('department', 0)
+        date_from = query.get('dateFrom', '2025-01-01')
+        date_to = query.get('dateTo', date_from)
+        return json.dumps({'result': 'SUCCESS', 'errors': [], 'response': [{
+            'departmentId': department_id,
+            'productId': _uid('product', i),
+            'productSizeId': None,
+            'prices': [{
+                'dateFrom': date_from,
+                'dateTo': date_to,
+                'price': 100 + i % 900,
+                'included': True,
+            }],
+        } for i in range(self.products)]}, ensure_ascii=False)
+
+    def _writeoff(self, query, body):
+        documents = []
+        for day in self._days(query.get('dateFrom', '2025-01-01'), query.get('dateTo', '2025-01-01'), True):
+            for n in range(self.documents_per_day):
+                index = int(day.strftime('%Y%m%d')) * 1000 + n
+                documents.append({
+                    'id': _uid('writeoff', index),
+                    'dateIncoming': (day + timedelta(hours=10, minutes=n)).strftime('%Y-%m-%dT%H:%M:%S'),
+                    'documentNumber': str(index),
+                    'status': 'PROCESSED',
+                    'conceptionId': None,
+                    'comment': None,
+                    'storeId': _uid('store', n % max(1, self.stores)),
+                    'accountId': _uid('account', n % 10),
+                    'items': [{
+                        'num': k + 1,
+                        'productId': _uid('product', (n + k) % max(1, self.products)),
+                        'productSizeId': None,
+                        'amountFactor': 1,
+                        'amount': 1 + k,
+                        'measureUnitId': _uid('unit', 0),
+                        'containerId': None,
+                        'cost': 50 + k,
+                    } for k in range(3)],
+                })
+        return json.dumps({'result': 'SUCCESS', 'response': documents}, ensure_ascii=False)
+
+    def _incomingInvoice(self, query, body):
+        supplier_id = query.get('supplierId') or _uid('supplier', 0)
+        documents = []
+        for day in self._days(query.get('from', '2025-01-01'), query.get('to', '2025-01-01'), True):
+            for n in range(self.documents_per_day):
+                index = int(day.strftime('%Y%m%d')) * 1000 + n
+                date = (day + timedelta(hours=9, minutes=n)).strftime('%Y-%m-%dT%H:%M:%S')
+                documents.append({
+                    'id': _uid(f'invoice:{supplier_id}', index),
+                    'incomingDate': date,
+                    'useDefaultDocumentTime': 'false',
+                    'dueDate': None,
+                    'supplier': supplier_id,
+                    'defaultStore': _uid('store', n % max(1, self.stores)),
+                    'dateIncoming': date,
+                    'documentNumber': str(index),
+                    'status': 'PROCESSED',
+                    'items': [{
+                        'isAdditionalExpense': 'false',
+                        'actualAmount': 1 + k,
+                        'store': _uid('store', n % max(1, self.stores)),
+                        'code': str(10000 + k),
+                        'price': 100,
+                        'priceWithoutVat': 100,
+                        'sum': 100 * (1 + k),
+                        'vatPercent': 0,
+                        'vatSum': 0,
+                        'discountSum': 0,
+                        'amountUnit': _uid('unit', 0),
+                        'num': k + 1,
+                        'product': _uid('product', (n + k) % max(1, self.products)),
+                        'amount': 1 + k,
+                    } for k in range(3)],
+                })
+        return _xml_items('incomingInvoiceDtoes', 'document', documents)
+
+    def _olap(self, query, body):
+        body = body or {}
+        filters = body.get('filters', {})
+        period = filters.get('OpenDate.Typed', {})
+        department_filter = filters.get('Department.Id', {}).get('values')
+        departments = [(i, _uid('department', i)) for i in range(max(1, self.departments))]
+        if department_filter:
+            departments = [(i, d) for i, d in departments if d in department_filter]
+
+        rows = []
+        for day in self._days(period.get('from', '2025-01-01'), period.get('to', '2025-01-02')):
+            for dept_index, dept_id in departments:
+                for n in range(self.sales_per_day):
+                    close_time = day + timedelta(hours=10, seconds=n * 7)
+                    rows.append({
+                        'OrderNum': int(day.strftime('%m%d')) * 100000 + n,
+                        'UniqOrderId.Id': _uid('order', int(day.strftime('%Y%m%d')) * 100000 + dept_index * 10000 + n),
+                        'FiscalChequeNumber': str(n),
+                        'CashRegisterName': f'Касса {dept_index}',
+                        'CashRegisterName.CashRegisterSerialNumber': f'SN{dept_index}',
+                        'CashRegisterName.Number': dept_index + 1,
+                        'CloseTime': close_time.strftime('%Y-%m-%dT%H:%M:%S.000'),
+                        'PrechequeTime': (close_time - timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S.000'),
+                        'DeletedWithWriteoff': 'NOT_DELETED',
+                        'Department': f'Подразделение {dept_index}',
+                        'Department.Id': dept_id,
+                        'DishAmountInt': 1 + n % 3,
+                        'DishCode': str(10000 + n % max(1, self.products)),
+                        'DishDiscountSumInt': 0,
+                        'DishMeasureUnit': 'шт',
+                        'DishName': f'Товар {n % max(1, self.products)}',
+                        'DishReturnSum': 0,
+                        'DishSumInt': 100 * (1 + n % 3),
+                        'IncreaseSum': 0,
+                        'OrderIncrease.Type': None,
+                        'OrderItems': 1,
+                        'OrderType': 'Обычный заказ',
+                        'PayTypes': 'Наличные',
+                        'Store.Name': f'Склад {dept_index % max(1, self.stores)}',
+                        'Storned': 'FALSE',
+                    })
+        return json.dumps({'data': rows, 'summary': []}, ensure_ascii=False)
+
+
+class StubServer(ThreadingHTTPServer):
+    """HTTP-сервер заменителя с общими настройками обработчиков"""
+
+    daemon_threads = True
+
+    def __init__(self, address, fixtures_dir: str, synthetic: SyntheticData, latency: float = 0.0,
+                 latency_jitter: float = 0.0, fail_rate: float = 0.0, fail_status: int = 503,
+                 fail_endpoints: Optional[set] = None, record_from: Optional[str] = None):
+        super().__init__(address, StubRequestHandler)
+        self.fixtures_dir = fixtures_dir
+        self.synthetic = synthetic
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.fail_endpoints = fail_endpoints
+        self.record_from = record_from.rstrip('/') if record_from else None
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def fixture_path(self, name: str, fmt: str) -> str:
+        return os.path.join(self.fixtures_dir, f'{name}.{fmt}')
+
+    def count(self, name: str, key: str):
+        with self.stats_lock:
+            endpoint = self.stats.setdefault(name, {'requests': 0, 'failures': 0})
+            endpoint[key] += 1
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        server = self.server
+        url = urlparse(self.path)
+        route = _match_route(url.path)
+        if route is None:
+            self._send(404, b'Not found', CONTENT_TYPES['text'])
+            return
+        suffix, name, fmt = route
+        server.count(name, 'requests')
+
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+
+        if server.latency or server.latency_jitter:
+            time.sleep(server.latency + random.uniform(0, server.latency_jitter))
+
+        failing = server.fail_endpoints is None and name not in ('auth', 'logout') \
+            or server.fail_endpoints is not None and name in server.fail_endpoints
+        if server.fail_rate and failing and random.random() < server.fail_rate:
+            server.count(name, 'failures')
+            self._send(server.fail_status, b'Injected failure', CONTENT_TYPES['text'], {'Retry-After': '1'})
+            return
+
+        if server.record_from:
+            self._proxy_and_record(suffix, name, fmt, url.query, raw_body)
+            return
+
+        fixture = server.fixture_path(name, fmt)
+        if os.path.exists(fixture):
+            with open(fixture, 'rb') as f:
+                body = f.read()
+        else:
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                request_json = json.loads(raw_body) if raw_body else None
+            except ValueError:
+                request_json = None
+            body = server.synthetic.build(name, query, request_json).encode('utf-8')
+
+        self._send(200, body, CONTENT_TYPES[fmt])
+
+    def _proxy_and_record(self, suffix: str, name: str, fmt: str, query: str, raw_body: bytes):
+        import requests
+
+        server = self.server
+        upstream_url = server.record_from + suffix + (f'?{query}' if query else '')
+        headers = {key: self.headers[key] for key in ('Cookie', 'Authorization', 'Content-Type')
+                   if self.headers.get(key)}
+        response = requests.request(self.command, upstream_url, data=raw_body or None,
+                                    headers=headers, timeout=(10, 600))
+
+        # Токены и ответы авторизации в фикстуры не сохраняются
+        if response.ok and name not in ('auth', 'logout'):
+            os.makedirs(server.fixtures_dir, exist_ok=True)
+            with open(server.fixture_path(name, fmt), 'wb') as f:
+                f.write(response.content)
+            logger.info(f"Записана фикстура {name}.{fmt} ({len(response.content)} байт)")
+
+        self._send(response.status_code, response.content,
+                   response.headers.get('Content-Type', CONTENT_TYPES[fmt]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный заменитель IIKO REST API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--fixtures-dir', default=os.path.join('fixtures', 'iiko'),
+                        help='Каталог фикстур (<эндпоинт>.json|xml)')
+    parser.add_argument('--record-from', help='Базовый URL настоящего API для записи фикстур, '
+                                              'например https://server/resto/api')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа, секунды')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Случайная добавка к задержке, секунды')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Доля запросов, завершаемых ошибкой')
+    parser.add_argument('--fail-status', type=int, default=503, help='HTTP-статус внедряемой ошибки')
+    parser.add_argument('--fail-endpoints', help='Эндпоинты для ошибок через запятую (по умолчанию все, кроме auth)')
+    parser.add_argument('--products', type=int, default=1000, help='Синтетических продуктов')
+    parser.add_argument('--stores', type=int, default=5, help='Синтетических складов')
+    parser.add_argument('--departments', type=int, default=5, help='Синтетических подразделений')
+    parser.add_argument('--suppliers', type=int, default=10, help='Синтетических поставщиков')
+    parser.add_argument('--sales-per-day', type=int, default=500,
+                        help='Синтетических строк OLAP в день на подразделение')
+    parser.add_argument('--documents-per-day', type=int, default=5,
+                        help='Синтетических документов (списаний, накладных) в день')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    synthetic = SyntheticData(args.products, args.stores, args.departments, args.suppliers,
+                              args.sales_per_day, args.documents_per_day)
+    fail_endpoints = set(args.fail_endpoints.split(',')) if args.fail_endpoints else None
+    server = StubServer((args.host, args.port), args.fixtures_dir, synthetic,
+                        latency=args.latency, latency_jitter=args.latency_jitter,
+                        fail_rate=args.fail_rate, fail_status=args.fail_status,
+                        fail_endpoints=fail_endpoints, record_from=args.record_from)
+
+    mode = f"запись с {args.record_from}" if args.record_from else "воспроизведение"
+    logger.info(f"Заменитель IIKO API ({mode}): http://{args.host}:{args.port}/resto/api")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Статистика запросов: {server.stats}")
+
+
+if __name__ == '__main__':
+    main()
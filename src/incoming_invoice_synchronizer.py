@@ -1,17 +1,28 @@
+import asyncio
 import logging
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 from src.models import IncomingInvoice, IncomingInvoiceItem, SyncLog
 from src.api_client import IikoApiClient
+from src.async_api_client import AsyncIikoApiClient
+from src.bulk_loader import BulkLoader
+from src.fingerprint import content_hash, load_hashes, classify, NEW, UNCHANGED
+from src.pipeline import Pipeline
 import uuid
 
 logger = logging.getLogger(__name__)
 
+# Колонки накладной, которые не меняются при обновлении (поставщик, склад и концепция документа)
+INVOICE_FIXED_COLUMNS = ('supplier_id', 'default_store_id', 'conception', 'conception_code')
+
 
 class IncomingInvoiceSynchronizer:
+    # Накладных в одной записи (и одной транзакции)
+    COMMIT_EVERY = 100
+    
     def __init__(self, api_client: IikoApiClient, connection_string: str):
         self.api_client = api_client
         self.engine = create_engine(connection_string)
@@ -20,8 +31,10 @@ class IncomingInvoiceSynchronizer:
         self.counters = {
             'invoices_created': 0,
             'invoices_updated': 0,
+            'invoices_unchanged': 0,
             'items_created': 0,
             'items_updated': 0,
+            'items_deleted': 0,
             'errors': 0
         }
     
@@ -39,35 +52,52 @@ class IncomingInvoiceSynchronizer:
         logger.info(f"Начало синхронизации приходных накладных за период {from_date} - {to_date} для поставщика {supplier_id}")
         
         try:
-            # Получаем данные из API
-            invoices_data = self.api_client.get_incoming_invoices(from_date, to_date, supplier_id)
-            
-            # Обрабатываем каждую накладную
-            for invoice_data in invoices_data:
-                try:
-                    self._process_invoice(invoice_data)
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке накладной {invoice_data.get('document_number', 'без номера')}: {e}")
-                    self.counters['errors'] += 1
-                    continue
-            
-            # Сохраняем изменения
-            self.session.commit()
+            # Загрузка из API, разбор и запись идут конвейером: накладные пишутся в БД
+            # порциями по COMMIT_EVERY, пока следующие еще загружаются
+            parse_errors = []
+            pending = []
+            
+            def normalize(invoices):
+                for invoice_data in invoices:
+                    try:
+                        yield invoice_data, self._invoice_fields(invoice_data)
+                    except Exception as e:
+                        parse_errors.append(invoice_data.get('document_number'))
+                        logger.error(f"Ошибка при разборе накладной {invoice_data.get('document_number', 'без номера')}: {e}")
+            
+            def write(parsed):
+                pending.append(parsed)
+                if len(pending) >= self.COMMIT_EVERY:
+                    self._write_invoice_batch(pending)
+                    pending.clear()
+            
+            pipeline = Pipeline('incoming_invoices').add_stage('normalize', normalize)
+            pipeline_stats = pipeline.run(self.api_client.iter_incoming_invoices(from_date, to_date, supplier_id), write)
+            self.counters['errors'] += len(parse_errors)
+            total = pipeline_stats['fetch']['items']
+            
+            # Сохраняем оставшиеся накладные
+            self._write_invoice_batch(pending)
             
             # Записываем лог синхронизации
             sync_log = SyncLog(
                 entity_type='incoming_invoices',
                 status='success',
                 sync_date=datetime.utcnow(),
+                records_count=total,
                 details={
                     'from_date': from_date,
                     'to_date': to_date,
                     'supplier_id': supplier_id,
                     'invoices_created': self.counters['invoices_created'],
                     'invoices_updated': self.counters['invoices_updated'],
+                    'invoices_unchanged': self.counters['invoices_unchanged'],
+                    'diff': self._diff(),
                     'items_created': self.counters['items_created'],
                     'items_updated': self.counters['items_updated'],
-                    'errors': self.counters['errors']
+                    'items_deleted': self.counters['items_deleted'],
+                    'errors': self.counters['errors'],
+                    'pipeline': pipeline_stats
                 }
             )
             self.session.add(sync_log)
@@ -75,15 +105,18 @@ class IncomingInvoiceSynchronizer:
             
             logger.info(f"Синхронизация завершена. Создано накладных: {self.counters['invoices_created']}, "
                        f"обновлено: {self.counters['invoices_updated']}, "
+                       f"без изменений: {self.counters['invoices_unchanged']}, "
                        f"создано позиций: {self.counters['items_created']}, "
                        f"ошибок: {self.counters['errors']}")
             
             return {
-                'total': len(invoices_data),
+                'total': total,
                 'invoices_created': self.counters['invoices_created'],
                 'invoices_updated': self.counters['invoices_updated'],
+                'invoices_unchanged': self.counters['invoices_unchanged'],
                 'items_created': self.counters['items_created'],
                 'items_updated': self.counters['items_updated'],
+                'items_deleted': self.counters['items_deleted'],
                 'errors': self.counters['errors']
             }
             
@@ -110,24 +143,254 @@ class IncomingInvoiceSynchronizer:
         finally:
             self.session.close()
     
-    def _process_invoice(self, invoice_data: dict):
-        """Обработка одной приходной накладной"""
-        invoice_id = uuid.UUID(invoice_data['id'])
-        
-        # Проверяем существование накладной
-        existing_invoice = self.session.query(IncomingInvoice).filter_by(id=invoice_id).first()
-        
-        if existing_invoice:
-            logger.debug(f"Обновление накладной {invoice_data['document_number']}")
-            self._update_invoice(existing_invoice, invoice_data)
-            self.counters['invoices_updated'] += 1
-        else:
-            logger.debug(f"Создание новой накладной {invoice_data['document_number']}")
-            self._create_invoice(invoice_data)
-            self.counters['invoices_created'] += 1
+    def sync_incoming_invoices_for_suppliers(self, from_date: str, to_date: str, supplier_ids: List[str]) -> Dict[str, any]:
+        """Синхронизация приходных накладных сразу для нескольких поставщиков
+        
+        Накладные всех поставщиков загружаются из API параллельно, а накладные каждого
+        поставщика записываются в БД, как только загружены, не дожидаясь остальных.
+        
+        Args:
+            from_date: Дата начала в формате YYYY-MM-DD
+            to_date: Дата окончания в формате YYYY-MM-DD
+            supplier_ids: Список ID поставщиков
+            
+        Returns:
+            Dict: Статистика синхронизации
+        """
+        logger.info(f"Начало синхронизации приходных накладных за период {from_date} - {to_date} для {len(supplier_ids)} поставщиков")
+        
+        try:
+            failed_suppliers = []
+            total = asyncio.run(self._sync_suppliers(from_date, to_date, supplier_ids, failed_suppliers))
+            
+            sync_log = SyncLog(
+                entity_type='incoming_invoices',
+                status='success',
+                sync_date=datetime.utcnow(),
+                records_count=total,
+                details={
+                    'from_date': from_date,
+                    'to_date': to_date,
+                    'suppliers_count': len(supplier_ids),
+                    'failed_suppliers': failed_suppliers,
+                    'invoices_created': self.counters['invoices_created'],
+                    'invoices_updated': self.counters['invoices_updated'],
+                    'invoices_unchanged': self.counters['invoices_unchanged'],
+                    'diff': self._diff(),
+                    'items_created': self.counters['items_created'],
+                    'items_updated': self.counters['items_updated'],
+                    'items_deleted': self.counters['items_deleted'],
+                    'errors': self.counters['errors']
+                }
+            )
+            self.session.add(sync_log)
+            self.session.commit()
+            
+            logger.info(f"Синхронизация завершена. Создано накладных: {self.counters['invoices_created']}, "
+                       f"обновлено: {self.counters['invoices_updated']}, "
+                       f"без изменений: {self.counters['invoices_unchanged']}, "
+                       f"создано позиций: {self.counters['items_created']}, "
+                       f"ошибок: {self.counters['errors']}")
+            
+            return {
+                'total': total,
+                'invoices_created': self.counters['invoices_created'],
+                'invoices_updated': self.counters['invoices_updated'],
+                'invoices_unchanged': self.counters['invoices_unchanged'],
+                'items_created': self.counters['items_created'],
+                'items_updated': self.counters['items_updated'],
+                'items_deleted': self.counters['items_deleted'],
+                'failed_suppliers': failed_suppliers,
+                'errors': self.counters['errors']
+            }
+            
+        except Exception as e:
+            logger.error(f"Критическая ошибка при синхронизации: {e}")
+            self.session.rollback()
+            
+            sync_log = SyncLog(
+                entity_type='incoming_invoices',
+                status='error',
+                sync_date=datetime.utcnow(),
+                details={
+                    'error': str(e),
+                    'from_date': from_date,
+                    'to_date': to_date,
+                    'suppliers_count': len(supplier_ids)
+                }
+            )
+            self.session.add(sync_log)
+            self.session.commit()
+            
+            raise
+        finally:
+            self.session.close()
+    
+    async def _sync_suppliers(self, from_date: str, to_date: str, supplier_ids: List[str],
+                              failed_suppliers: list) -> int:
+        """Параллельная загрузка накладных поставщиков с записью по мере готовности
+        
+        Запись идет в отдельном потоке, чтобы не останавливать event loop и загрузку
+        остальных поставщиков; записи выполняются по одной, поэтому сессия не используется
+        из двух потоков одновременно.
+        
+        Returns:
+            int: Количество полученных накладных
+        """
+        async_client = AsyncIikoApiClient(self.api_client)
+        await async_client.ensure_token()
+        
+        async def fetch(supplier_id):
+            try:
+                return supplier_id, await async_client.get_incoming_invoices(from_date, to_date, supplier_id)
+            except Exception as e:
+                return supplier_id, e
+        
+        total = 0
+        for next_result in asyncio.as_completed([fetch(supplier_id) for supplier_id in supplier_ids]):
+            supplier_id, invoices_data = await next_result
+            if isinstance(invoices_data, Exception):
+                logger.error(f"Ошибка загрузки накладных поставщика {supplier_id}: {invoices_data}")
+                failed_suppliers.append(supplier_id)
+                self.counters['errors'] += 1
+                continue
+            
+            total += len(invoices_data)
+            await asyncio.to_thread(self._write_supplier_invoices, invoices_data)
+        return total
     
-    def _create_invoice(self, invoice_data: dict):
-        """Создание новой приходной накладной"""
+    def _write_supplier_invoices(self, invoices_data: list):
+        """Разбор и запись накладных одного поставщика порциями по COMMIT_EVERY"""
+        parsed = []
+        for invoice_data in invoices_data:
+            try:
+                parsed.append((invoice_data, self._invoice_fields(invoice_data)))
+            except Exception as e:
+                logger.error(f"Ошибка при разборе накладной {invoice_data.get('document_number', 'без номера')}: {e}")
+                self.counters['errors'] += 1
+        
+        # Накладные каждого поставщика фиксируются порциями отдельно от других поставщиков
+        for start in range(0, len(parsed), self.COMMIT_EVERY):
+            self._write_invoice_batch(parsed[start:start + self.COMMIT_EVERY])
+    
+    def _diff(self) -> Dict[str, int]:
+        """Разбивка накладных по отпечаткам: новые, измененные, без изменений"""
+        return {
+            'new': self.counters['invoices_created'],
+            'changed': self.counters['invoices_updated'],
+            'unchanged': self.counters['invoices_unchanged']
+        }
+    
+    def _write_invoice_batch(self, batch: list):
+        """Запись порции накладных и фиксация транзакции
+        
+        При ошибке порция откатывается и записывается по одной накладной, чтобы
+        ошибка одной накладной не отменяла запись остальных.
+        
+        :param batch: Список (данные накладной из API, колонки из _invoice_fields)
+        """
+        if not batch:
+            return
+        try:
+            with self.session.no_autoflush:
+                counts = self._upsert_invoice_batch(batch)
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            if len(batch) > 1:
+                logger.warning(f"Ошибка записи порции из {len(batch)} накладных, записываем по одной: {e}")
+                for parsed in batch:
+                    self._write_invoice_batch([parsed])
+                return
+            logger.error(f"Ошибка при обработке накладной {batch[0][0].get('document_number', 'без номера')}: {e}")
+            self.counters['errors'] += 1
+            return
+        
+        # Счетчики учитываются только после фиксации, чтобы повтор порции не считался дважды
+        for key, value in counts.items():
+            self.counters[key] += value
+    
+    def _upsert_invoice_batch(self, batch: list) -> Dict[str, int]:
+        """Set-based запись порции накладных (без фиксации)
+        
+        1. Отпечатки накладных порции читаются одним запросом, неизмененные накладные
+           пропускаются вместе с позициями.
+        2. Шапки новых и измененных накладных пишутся одной загрузкой COPY + INSERT ... ON CONFLICT.
+        3. Позиции измененных накладных сверяются с БД по (invoice_id, num): исчезнувшие
+           удаляются одним DELETE, остальные пишутся одной загрузкой, строки без
+           изменений не переписываются.
+        
+        :return: Счетчики порции
+        """
+        counts = {'invoices_created': 0, 'invoices_updated': 0, 'invoices_unchanged': 0,
+                  'items_created': 0, 'items_updated': 0, 'items_deleted': 0}
+        
+        # Повтор накладной в ответе: в одном INSERT ... ON CONFLICT строка не может
+        # обновляться дважды, поэтому оставляем последнюю версию
+        invoices = {str(fields['id']).lower(): (invoice_data, fields) for invoice_data, fields in batch}
+        stored_hashes = load_hashes(self.session, IncomingInvoice, keys=invoices)
+        
+        now = datetime.utcnow()
+        invoice_rows = []
+        item_rows = {}
+        changed_ids = []
+        for key, (invoice_data, fields) in invoices.items():
+            change = classify(stored_hashes, key, fields['content_hash'])
+            if change == UNCHANGED:
+                # Накладная и ее позиции не изменились - не переписываем
+                counts['invoices_unchanged'] += 1
+                continue
+            if change == NEW:
+                logger.debug(f"Создание новой накладной {invoice_data['document_number']}")
+                counts['invoices_created'] += 1
+            else:
+                logger.debug(f"Обновление накладной {invoice_data['document_number']}")
+                counts['invoices_updated'] += 1
+                changed_ids.append(fields['id'])
+            
+            invoice_rows.append(dict(fields, created_at=now, updated_at=now, synced_at=now))
+            for item_data in invoice_data.get('items', []):
+                item_row = self._invoice_item_row(fields['id'], item_data, now)
+                # Повтор номера позиции: побеждает последняя, как и при загрузке
+                item_rows[(key, item_row['num'])] = item_row
+        
+        if not invoice_rows:
+            return counts
+        
+        # Шапки накладных должны попасть в БД раньше позиций, которые на них ссылаются
+        update_columns = [column.name for column in IncomingInvoice.__table__.columns
+                          if column.name not in ('id', 'created_at') + INVOICE_FIXED_COLUMNS]
+        BulkLoader(self.session, IncomingInvoice, conflict_columns=['id'], update_columns=update_columns,
+                   hash_column='content_hash').load(invoice_rows)
+        
+        # Позиции, которых больше нет в измененных накладных
+        stale_ids = []
+        if changed_ids:
+            query = self.session.query(IncomingInvoiceItem.id, IncomingInvoiceItem.invoice_id,
+                                       IncomingInvoiceItem.num).filter(
+                IncomingInvoiceItem.invoice_id.in_(changed_ids)
+            )
+            stale_ids = [item_id for item_id, invoice_id, num in query
+                         if (str(invoice_id).lower(), num) not in item_rows]
+        if stale_ids:
+            self.session.query(IncomingInvoiceItem).filter(
+                IncomingInvoiceItem.id.in_(stale_ids)
+            ).delete(synchronize_session=False)
+        
+        loaded = BulkLoader(self.session, IncomingInvoiceItem,
+                            conflict_columns=['invoice_id', 'num']).load(list(item_rows.values()))
+        counts['items_created'] = loaded['inserted']
+        counts['items_updated'] = loaded['updated']
+        counts['items_deleted'] = len(stale_ids)
+        return counts
+    
+    @staticmethod
+    def _invoice_fields(invoice_data: dict) -> dict:
+        """Колонки IncomingInvoice из данных API: даты и UUID разбираются без обращения к БД
+        
+        В content_hash входят колонки накладной и позиции, поэтому изменение любой
+        позиции тоже приводит к перезаписи накладной.
+        """
         # Преобразуем строковые даты в объекты datetime/date
         incoming_date = None
         if invoice_data.get('incoming_date'):
@@ -148,92 +411,47 @@ class IncomingInvoiceSynchronizer:
             else:
                 date_incoming = datetime.strptime(date_str[:19], '%Y-%m-%d %H:%M:%S')
         
-        # Создаем накладную
-        invoice = IncomingInvoice(
-            id=uuid.UUID(invoice_data['id']),
-            transport_invoice_number=invoice_data.get('transport_invoice_number'),
-            incoming_document_number=invoice_data.get('incoming_document_number'),
-            incoming_date=incoming_date,
-            use_default_document_time=invoice_data.get('use_default_document_time', False),
-            due_date=due_date,
-            supplier_id=uuid.UUID(invoice_data['supplier_id']) if invoice_data.get('supplier_id') else None,
-            default_store_id=uuid.UUID(invoice_data['default_store_id']) if invoice_data.get('default_store_id') else None,
-            invoice=invoice_data.get('invoice'),
-            date_incoming=date_incoming,
-            document_number=invoice_data['document_number'],
-            comment=invoice_data.get('comment'),
-            conception=uuid.UUID(invoice_data['conception']) if invoice_data.get('conception') else None,
-            conception_code=invoice_data.get('conception_code'),
-            status=invoice_data.get('status'),
-            distribution_algorithm=invoice_data.get('distribution_algorithm'),
-            synced_at=datetime.utcnow()
-        )
-        
-        self.session.add(invoice)
-        
-        # Создаем позиции
-        for item_data in invoice_data.get('items', []):
-            self._create_invoice_item(invoice.id, item_data)
-    
-    def _update_invoice(self, invoice: IncomingInvoice, invoice_data: dict):
-        """Обновление существующей накладной"""
-        # Обновляем поля накладной
-        invoice.transport_invoice_number = invoice_data.get('transport_invoice_number')
-        invoice.incoming_document_number = invoice_data.get('incoming_document_number')
-        
-        if invoice_data.get('incoming_date'):
-            date_str = invoice_data['incoming_date'].replace('T00:00:00', '').split('T')[0]
-            invoice.incoming_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        
-        invoice.use_default_document_time = invoice_data.get('use_default_document_time', False)
-        
-        if invoice_data.get('due_date'):
-            date_str = invoice_data['due_date'].replace('T00:00:00', '').split('T')[0]
-            invoice.due_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        else:
-            invoice.due_date = None
-        
-        if invoice_data.get('date_incoming'):
-            date_str = invoice_data['date_incoming'].replace('T', ' ')
-            if len(date_str) == 10:
-                invoice.date_incoming = datetime.strptime(date_str, '%Y-%m-%d')
-            else:
-                invoice.date_incoming = datetime.strptime(date_str[:19], '%Y-%m-%d %H:%M:%S')
-        
-        invoice.document_number = invoice_data['document_number']
-        invoice.comment = invoice_data.get('comment')
-        invoice.status = invoice_data.get('status')
-        invoice.distribution_algorithm = invoice_data.get('distribution_algorithm')
-        invoice.synced_at = datetime.utcnow()
-        
-        # Удаляем старые позиции
-        self.session.query(IncomingInvoiceItem).filter_by(invoice_id=invoice.id).delete()
-        
-        # Создаем новые позиции
-        for item_data in invoice_data.get('items', []):
-            self._create_invoice_item(invoice.id, item_data)
+        fields = {
+            'id': uuid.UUID(invoice_data['id']),
+            'transport_invoice_number': invoice_data.get('transport_invoice_number'),
+            'incoming_document_number': invoice_data.get('incoming_document_number'),
+            'incoming_date': incoming_date,
+            'use_default_document_time': invoice_data.get('use_default_document_time', False),
+            'due_date': due_date,
+            'supplier_id': uuid.UUID(invoice_data['supplier_id']) if invoice_data.get('supplier_id') else None,
+            'default_store_id': uuid.UUID(invoice_data['default_store_id']) if invoice_data.get('default_store_id') else None,
+            'invoice': invoice_data.get('invoice'),
+            'date_incoming': date_incoming,
+            'document_number': invoice_data['document_number'],
+            'comment': invoice_data.get('comment'),
+            'conception': uuid.UUID(invoice_data['conception']) if invoice_data.get('conception') else None,
+            'conception_code': invoice_data.get('conception_code'),
+            'status': invoice_data.get('status'),
+            'distribution_algorithm': invoice_data.get('distribution_algorithm')
+        }
+        fields['content_hash'] = content_hash(fields, list(fields), extra=invoice_data.get('items', []))
+        return fields
     
-    def _create_invoice_item(self, invoice_id: uuid.UUID, item_data: dict):
-        """Создание позиции накладной"""
-        item = IncomingInvoiceItem(
-            invoice_id=invoice_id,
-            is_additional_expense=item_data.get('is_additional_expense', False),
-            actual_amount=item_data.get('actual_amount', 0),
-            store_id=uuid.UUID(item_data['store_id']) if item_data.get('store_id') else None,
-            code=item_data.get('code'),
-            price=item_data.get('price', 0),
-            price_without_vat=item_data.get('price_without_vat', 0),
-            sum=item_data.get('sum', 0),
-            vat_percent=item_data.get('vat_percent', 0),
-            vat_sum=item_data.get('vat_sum', 0),
-            discount_sum=item_data.get('discount_sum', 0),
-            amount_unit=uuid.UUID(item_data['amount_unit']) if item_data.get('amount_unit') else None,
-            num=item_data.get('num', 0),
-            product_id=uuid.UUID(item_data['product_id']) if item_data.get('product_id') else None,
-            product_article=item_data.get('product_article'),
-            amount=item_data.get('amount', 0),
-            supplier_id=uuid.UUID(item_data['supplier_id']) if item_data.get('supplier_id') else None
-        )
-        
-        self.session.add(item)
-        self.counters['items_created'] += 1
\ No newline at end of file
+    @staticmethod
+    def _invoice_item_row(invoice_id: uuid.UUID, item_data: dict, now: datetime) -> dict:
+        """Строка позиции накладной для загрузки"""
+        return {
+            'invoice_id': invoice_id,
+            'is_additional_expense': item_data.get('is_additional_expense', False),
+            'actual_amount': item_data.get('actual_amount', 0),
+            'store_id': uuid.UUID(item_data['store_id']) if item_data.get('store_id') else None,
+            'code': item_data.get('code'),
+            'price': item_data.get('price', 0),
+            'price_without_vat': item_data.get('price_without_vat', 0),
+            'sum': item_data.get('sum', 0),
+            'vat_percent': item_data.get('vat_percent', 0),
+            'vat_sum': item_data.get('vat_sum', 0),
+            'discount_sum': item_data.get('discount_sum', 0),
+            'amount_unit': uuid.UUID(item_data['amount_unit']) if item_data.get('amount_unit') else None,
+            'num': item_data.get('num') or 0,
+            'product_id': uuid.UUID(item_data['product_id']) if item_data.get('product_id') else None,
+            'product_article': item_data.get('product_article'),
+            'amount': item_data.get('amount', 0),
+            'supplier_id': uuid.UUID(item_data['supplier_id']) if item_data.get('supplier_id') else None,
+            'updated_at': now
+        }
@@ -0,0 +1,125 @@
+"""
+Потоковый разбор JSON-ответов IIKO API.
+
+Ответ читается из сокета порциями, а элементы JSON-массива отдаются по одному,
+поэтому в памяти одновременно находится только текущий элемент и небольшой буфер.
+"""
+import codecs
+import json
+from typing import Iterable, Iterator, Optional, Union
+
+_WHITESPACE = ' \t\n\r'
+# Символы, которыми может заканчиваться значение внутри массива или объекта
+_DELIMITERS = _WHITESPACE + ',]}:'
+_decoder = json.JSONDecoder()
+
+
+class _JsonReader:
+    """Буфер поверх итератора порций текста/байт ответа"""
+
+    def __init__(self, chunks: Iterable[Union[bytes, str]]):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self) -> bool:
+        """Дочитывает следующую порцию; False, если ответ закончился"""
+        if self.eof:
+            return False
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._utf8.decode(chunk)
+            if chunk:
+                # Отбрасываем уже разобранную часть буфера
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+        self.buf = self.buf[self.pos:] + self._utf8.decode(b'', final=True)
+        self.pos = 0
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        """Следующий значимый символ (пробелы пропускаются)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Неожиданный конец JSON-ответа")
+
+    def advance(self):
+        self.pos += 1
+
+    def read_value(self):
+        """Читает одно JSON-значение целиком, при необходимости дочитывая ответ"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # Число на границе порции могло быть обрезано ("7." из "7.5" разбирается как 7):
+            # значение принимается, только если за ним уже есть разделитель
+            if not self.eof and (end == len(self.buf) or self.buf[end] not in _DELIMITERS):
+                self._more()
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self) -> Iterator:
+        """Отдает элементы массива, начинающегося в текущей позиции"""
+        self.advance()  # '['
+        while True:
+            ch = self.peek()
+            if ch == ']':
+                self.advance()
+                return
+            if ch == ',':
+                self.advance()
+                continue
+            yield self.read_value()
+
+
+def iter_json_array(chunks: Iterable[Union[bytes, str]], key: Optional[str] = None) -> Iterator:
+    """Потоковый перебор элементов JSON-массива
+
+    :param chunks: Порции ответа (например, response.iter_content())
+    :param key: Если ответ - объект, имя поля верхнего уровня, содержащего массив
+    :return: Итератор по элементам массива
+    """
+    reader = _JsonReader(chunks)
+    ch = reader.peek()
+
+    if ch == '[':
+        yield from reader.iter_array()
+        return
+
+    if ch != '{':
+        raise ValueError(f"Ожидался JSON-массив или объект, получено: {ch!r}")
+
+    reader.advance()  # '{'
+    while True:
+        ch = reader.peek()
+        if ch == '}':
+            return
+        if ch == ',':
+            reader.advance()
+            continue
+
+        name = reader.read_value()
+        if reader.peek() != ':':
+            raise ValueError("Некорректный JSON-объект в ответе")
+        reader.advance()
+
+        if name == key and reader.peek() == '[':
+            yield from reader.iter_array()
+            return
+
+        # Остальные поля верхнего уровня (summary, result и т.п.) пропускаем
+        reader.read_value()
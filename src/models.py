@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, Boolean, DateTime, ForeignKey, Integer, JSON, UniqueConstraint, Enum, Float, Date, Numeric, Text
+from sqlalchemy import create_engine, Column, String, Boolean, DateTime, ForeignKey, Integer, BigInteger, JSON, UniqueConstraint, Enum, Float, Date, Numeric, Text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
@@ -40,6 +40,7 @@ class Product(Base):
     tax_category_id = Column(UUID(as_uuid=True), ForeignKey('categories.id'), nullable=True)
     category_id = Column(UUID(as_uuid=True), ForeignKey('categories.id'), nullable=True)
     accounting_category_id = Column(UUID(as_uuid=True), ForeignKey('categories.id'), nullable=True)
+    content_hash = Column(String(32), nullable=True)  # Отпечаток данных из API (src/fingerprint.py)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -101,6 +102,7 @@ class Store(Base):
     code = Column(String(50), nullable=True)
     name = Column(String(255), nullable=False)
     type = Column(Enum(StoreType), default=StoreType.STORE)
+    deleted = Column(Boolean, default=False, nullable=False)  # Удален в IIKO (миграция 017)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -169,11 +171,12 @@ class Sale(Base):
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     order_num = Column(Integer, nullable=False)
+    order_id = Column(UUID(as_uuid=True), nullable=True)  # UniqOrderId.Id: общий для всех закрытий заказа
     fiscal_cheque_number = Column(String(50), nullable=True)
     cash_register_name = Column(String(255), nullable=True)
     cash_register_serial_number = Column(String(100), nullable=True)
     cash_register_number = Column(Integer, nullable=True)
-    close_time = Column(DateTime, nullable=True)
+    close_time = Column(DateTime, primary_key=True)  # Ключ помесячных партиций, входит в первичный ключ
     precheque_time = Column(DateTime, nullable=True)
     deleted_with_writeoff = Column(String(50), nullable=True)
     department = Column(String(255), nullable=True)
@@ -193,6 +196,7 @@ class Sale(Base):
     store_name = Column(String(255), nullable=True)
     store_id = Column(UUID(as_uuid=True), ForeignKey('stores.id'), nullable=True)
     storned = Column(Boolean, default=False, nullable=True)  # Флаг отмены чека
+    content_hash = Column(String(32), nullable=True)  # Отпечаток данных из API (src/fingerprint.py)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -203,7 +207,9 @@ class Sale(Base):
     store = relationship("Store")
     
     __table_args__ = (
-        UniqueConstraint('order_num', 'fiscal_cheque_number', 'dish_code', 'cash_register_number', name='unique_sale_item'),
+        UniqueConstraint('order_num', 'fiscal_cheque_number', 'dish_code', 'cash_register_number', 'close_time',
+                         name='unique_sale_item', postgresql_nulls_not_distinct=True),
+        {'postgresql_partition_by': 'RANGE (close_time)'},
     )
 
 class Account(Base):
@@ -218,6 +224,7 @@ class Account(Base):
     type = Column(String(100), nullable=True)
     system = Column(Boolean, default=False, nullable=False)
     custom_transactions_allowed = Column(Boolean, default=True, nullable=False)
+    content_hash = Column(String(32), nullable=True)  # Отпечаток данных из API (src/fingerprint.py)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -256,6 +263,44 @@ class SyncLog(Base):
     error_message = Column(String, nullable=True)
     details = Column(JSON, nullable=True)
 
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity_type = Column(String(50), nullable=False)
+    scope = Column(String(100), nullable=False, default='')  # '' - вся сущность, иначе ID подразделения/склада
+    revision = Column(BigInteger, nullable=True)  # Последняя полученная ревизия IIKO
+    watermark = Column(DateTime, nullable=True)  # Водяной знак по времени
+    details = Column(JSON, nullable=True)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('entity_type', 'scope', name='unique_sync_state'),
+    )
+
+class SyncCheckpoint(Base):
+    __tablename__ = 'sync_checkpoints'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String(100), nullable=False)  # Сущность и период загрузки, например sales:2025-01-01:2025-04-01
+    entity_type = Column(String(50), nullable=False)
+    window_start = Column(Date, nullable=False)  # Включительно
+    window_end = Column(Date, nullable=False)  # Не включается
+    status = Column(String(20), nullable=False, default='pending')  # pending, running, done, failed
+    rows_count = Column(Integer, nullable=True)
+    duration_seconds = Column(Float, nullable=True)
+    error_message = Column(Text, nullable=True)
+
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('job_id', 'window_start', name='unique_sync_checkpoint'),
+    )
+
 class WriteoffDocument(Base):
     __tablename__ = 'writeoff_documents'
     
@@ -267,6 +312,7 @@ class WriteoffDocument(Base):
     comment = Column(String, nullable=True)
     store_id = Column(UUID(as_uuid=True), ForeignKey('stores.id'), nullable=True)
     account_id = Column(UUID(as_uuid=True), ForeignKey('accounts.id'), nullable=True)
+    content_hash = Column(String(32), nullable=True)  # Отпечаток данных из API (src/fingerprint.py)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -344,6 +390,7 @@ class Price(Base):
     flyer_program = Column(Boolean, default=False)
     document_id = Column(UUID(as_uuid=True), nullable=True)
     schedule = Column(String, nullable=True)
+    content_hash = Column(String(32), nullable=True)  # Отпечаток данных из API (src/fingerprint.py)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -357,7 +404,7 @@ class Price(Base):
     # Уникальное ограничение
     __table_args__ = (
         UniqueConstraint('department_id', 'product_id', 'product_size_id', 'price_type', 'date_from', 'date_to', 
-                        name='unique_price_entry'),
+                        name='unique_price_entry', postgresql_nulls_not_distinct=True),
     )
 
 
@@ -380,6 +427,7 @@ class IncomingInvoice(Base):
     conception_code = Column(String(50))
     status = Column(String(50))
     distribution_algorithm = Column(String(100))
+    content_hash = Column(String(32), nullable=True)  # Отпечаток данных из API (src/fingerprint.py)
     
     # Временные метки
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -408,7 +456,7 @@ class IncomingInvoiceItem(Base):
     vat_sum = Column(Numeric(15, 9))
     discount_sum = Column(Numeric(15, 9))
     amount_unit = Column(UUID(as_uuid=True))
-    num = Column(Integer)
+    num = Column(Integer, nullable=False)
     product_id = Column(UUID(as_uuid=True), ForeignKey('products.id'))
     product_article = Column(String(50))
     amount = Column(Numeric(15, 9))
@@ -422,4 +470,8 @@ class IncomingInvoiceItem(Base):
     invoice = relationship('IncomingInvoice', back_populates='items')
     product = relationship('Product', backref='incoming_invoice_items')
     store = relationship('Store', backref='incoming_invoice_items')
-    supplier = relationship('Supplier', backref='incoming_invoice_items')
\ No newline at end of file
+    supplier = relationship('Supplier', backref='incoming_invoice_items')
+    
+    __table_args__ = (
+        UniqueConstraint('invoice_id', 'num', name='unique_incoming_invoice_item_num'),
+    )
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+Преобразование строк OLAP-отчетов IIKO в записи моделей.
+
+Соответствие колонок OLAP колонкам модели задается декларативно. Для каждого
+набора ключей строки (обычно один на ответ) карта компилируется один раз в список
+(ключ строки, колонка модели, преобразователь), и строка переводится в запись
+за один проход.
+"""
+import logging
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def to_str(value) -> Optional[str]:
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def to_int(value) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        # Агрегаты иногда приходят дробными (например, 12.0)
+        try:
+            return int(float(value))
+        except (ValueError, TypeError):
+            logger.warning(f"Не удалось преобразовать в число: {value!r}")
+            return None
+
+
+def to_uuid(value) -> Optional[uuid.UUID]:
+    if not value:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        logger.warning(f"Некорректный UUID: {value!r}")
+        return None
+
+
+def to_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        pass
+    # Редкие форматы, которые fromisoformat старых версий Python не разбирает
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%d.%m.%Y %H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt)
+        except (ValueError, TypeError):
+            continue
+    logger.warning(f"Не удалось разобрать дату: {value!r}")
+    return None
+
+
+def to_flag(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).upper() == 'TRUE' if value is not None else False
+
+
+# Колонка OLAP -> (колонка модели Sale, преобразователь)
+SALES_FIELDS: Dict[str, Tuple[str, Callable]] = {
+    "OrderNum": ("order_num", to_int),
+    "UniqOrderId.Id": ("order_id", to_uuid),
+    "FiscalChequeNumber": ("fiscal_cheque_number", to_str),
+    "CashRegisterName": ("cash_register_name", to_str),
+    "CashRegisterName.CashRegisterSerialNumber": ("cash_register_serial_number", to_str),
+    "CashRegisterName.Number": ("cash_register_number", to_int),
+    "CloseTime": ("close_time", to_datetime),
+    "PrechequeTime": ("precheque_time", to_datetime),
+    "DeletedWithWriteoff": ("deleted_with_writeoff", to_str),
+    "Department": ("department", to_str),
+    "Department.Id": ("department_id", to_uuid),
+    "DishAmountInt": ("dish_amount", to_int),
+    "DishCode": ("dish_code", to_str),
+    "DishDiscountSumInt": ("dish_discount_sum", to_int),
+    "DishMeasureUnit": ("dish_measure_unit", to_str),
+    "DishName": ("dish_name", to_str),
+    "DishReturnSum": ("dish_return_sum", to_int),
+    "DishSumInt": ("dish_sum", to_int),
+    "IncreaseSum": ("increase_sum", to_int),
+    "OrderIncrease.Type": ("order_increase_type", to_str),
+    "OrderItems": ("order_items", to_int),
+    "OrderType": ("order_type", to_str),
+    "PayTypes": ("pay_types", to_str),
+    "Store.Name": ("store_name", to_str),
+    "Storned": ("storned", to_flag),
+}
+
+
+def _match_field(key: str, fields: Dict[str, Tuple[str, Callable]]) -> Optional[Tuple[str, Callable]]:
+    """Поиск описания поля по ключу строки
+
+    Ключ может содержать префикс с номером колонки OLAP, поэтому кроме точного
+    совпадения проверяется самое длинное совпадение по суффиксу ('.Имя').
+    """
+    if key in fields:
+        return fields[key]
+    best = None
+    for name in fields:
+        if key.endswith('.' + name) and (best is None or len(name) > len(best)):
+            best = name
+    return fields[best] if best else None
+
+
+class OlapRowNormalizer:
+    """Однопроходное преобразование строк OLAP-отчета по карте полей"""
+
+    def __init__(self, fields: Dict[str, Tuple[str, Callable]]):
+        self.fields = fields
+        self._compiled: Dict[Tuple[str, ...], List[Tuple[str, str, Callable]]] = {}
+
+    def _compile(self, keys: Tuple[str, ...]) -> List[Tuple[str, str, Callable]]:
+        plan = []
+        unknown = []
+        for key in keys:
+            field = _match_field(key, self.fields)
+            if field is None:
+                unknown.append(key)
+                continue
+            plan.append((key, field[0], field[1]))
+
+        # Колонки, которых нет в ответе, заполняются None
+        present = {column for _, column, _ in plan}
+        for column, converter in self.fields.values():
+            if column not in present:
+                plan.append((None, column, converter))
+
+        if unknown:
+            logger.debug(f"Колонки OLAP без соответствия в модели: {unknown}")
+        return plan
+
+    def __call__(self, row: dict) -> dict:
+        keys = tuple(row)
+        plan = self._compiled.get(keys)
+        if plan is None:
+            plan = self._compiled[keys] = self._compile(keys)
+        return {column: converter(row[key] if key is not None else None)
+                for key, column, converter in plan}
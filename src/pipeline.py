@@ -0,0 +1,210 @@
+"""
+Конвейер синхронизации: загрузка, преобразование и запись идут одновременно.
+
+Каждая стадия работает в своем потоке и передает результаты следующей через
+ограниченную очередь. Пока БД записывает очередной батч, из сети уже читается
+следующий; если запись не успевает, очередь заполняется и загрузка ждет
+(back-pressure), поэтому память ограничена размером очередей. Общее время
+близко ко времени самой медленной стадии, а не к сумме всех стадий.
+
+Последняя стадия (запись) выполняется в вызывающем потоке: сессия SQLAlchemy
+не должна использоваться из нескольких потоков.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config.config import PIPELINE_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Признак конца потока данных в очереди
+_END = object()
+# Период проверки остановки при ожидании очереди
+_POLL_SECONDS = 0.2
+
+
+class PipelineStopped(Exception):
+    """Конвейер остановлен из-за ошибки в другой стадии"""
+
+
+class _StageStats:
+    def __init__(self):
+        self.items = 0
+        self.wait_in = 0.0  # Ожидание входных данных: стадия простаивает из-за предыдущей
+        self.wait_out = 0.0  # Ожидание места в очереди: следующая стадия не успевает
+        self.started = None
+        self.finished = None
+
+    def as_dict(self) -> Dict[str, float]:
+        total = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        return {
+            'items': self.items,
+            'seconds': round(total, 3),
+            'busy_seconds': round(max(total - self.wait_in - self.wait_out, 0.0), 3),
+            'wait_in_seconds': round(self.wait_in, 3),
+            'wait_out_seconds': round(self.wait_out, 3),
+        }
+
+
+class Pipeline:
+    """Конвейер из источника, промежуточных стадий и записи
+
+    Пример::
+
+        pipeline = Pipeline('sales')
+        pipeline.add_stage('batch', make_batches)   # Iterator -> Iterator
+        stats = pipeline.run(api_rows, write_batch)  # write_batch(item) в текущем потоке
+
+    :param name: Имя конвейера (для логов и потоков)
+    :param queue_size: Емкость очередей между стадиями (по умолчанию PIPELINE_QUEUE_SIZE)
+    """
+
+    def __init__(self, name: str, queue_size: Optional[int] = None):
+        self.name = name
+        self.queue_size = queue_size or PIPELINE_QUEUE_SIZE
+        self._stages: List[Tuple[str, Callable[[Iterator], Iterable]]] = []
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self._stats: Dict[str, _StageStats] = {}
+
+    def add_stage(self, name: str, func: Callable[[Iterator], Iterable]) -> 'Pipeline':
+        """Промежуточная стадия: функция от итератора входных элементов, возвращающая итератор"""
+        self._stages.append((name, func))
+        return self
+
+    def _put(self, out: queue.Queue, item, stats: _StageStats):
+        started = time.monotonic()
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                out.put(item, timeout=_POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        stats.wait_out += time.monotonic() - started
+
+    def _iter_queue(self, source: queue.Queue, stats: _StageStats) -> Iterator:
+        while True:
+            started = time.monotonic()
+            while True:
+                if self._stop.is_set():
+                    raise PipelineStopped()
+                try:
+                    item = source.get(timeout=_POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    continue
+            stats.wait_in += time.monotonic() - started
+            if item is _END:
+                return
+            yield item
+
+    def _worker(self, name: str, items: Callable[[_StageStats], Iterable], out: queue.Queue):
+        stats = self._stats[name]
+        stats.started = time.monotonic()
+        iterator = None
+        try:
+            iterator = iter(items(stats))
+            for item in iterator:
+                stats.items += 1
+                self._put(out, item, stats)
+            self._put(out, _END, stats)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            logger.error(f"Конвейер {self.name}: ошибка в стадии {name}: {e}")
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            # Закрытие генератора освобождает ресурсы источника (потоковый ответ, слот ограничителя)
+            close = getattr(iterator, 'close', None)
+            if close:
+                try:
+                    close()
+                except Exception as close_error:
+                    logger.warning(f"Конвейер {self.name}: ошибка закрытия стадии {name}: {close_error}")
+            stats.finished = time.monotonic()
+
+    def run(self, source: Iterable, sink: Callable[[object], None], source_name: str = 'fetch',
+            sink_name: str = 'write') -> Dict[str, Dict[str, float]]:
+        """Запуск конвейера до исчерпания источника
+
+        Ошибка любой стадии останавливает остальные и пробрасывается вызывающему.
+
+        :param source: Итерируемый источник (читается в отдельном потоке)
+        :param sink: Запись элемента последней очереди (в вызывающем потоке)
+        :return: Статистика стадий: элементы, время работы и ожидания
+        """
+        names = [source_name] + [name for name, _ in self._stages] + [sink_name]
+        self._stats = {name: _StageStats() for name in names}
+        self._stop.clear()
+        self._errors = []
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self._stages) + 1)]
+        threads = [threading.Thread(
+            target=self._worker, args=(source_name, lambda stats: source, queues[0]),
+            name=f"{self.name}-{source_name}", daemon=True
+        )]
+        for index, (name, func) in enumerate(self._stages):
+            def stage_items(stats, func=func, inbox=queues[index]):
+                return func(self._iter_queue(inbox, stats))
+            threads.append(threading.Thread(
+                target=self._worker, args=(name, stage_items, queues[index + 1]),
+                name=f"{self.name}-{name}", daemon=True
+            ))
+
+        for thread in threads:
+            thread.start()
+
+        sink_stats = self._stats[sink_name]
+        sink_stats.started = time.monotonic()
+        try:
+            for item in self._iter_queue(queues[-1], sink_stats):
+                sink(item)
+                sink_stats.items += 1
+        except PipelineStopped:
+            pass
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            sink_stats.finished = time.monotonic()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+        stats = self.stats()
+        logger.info(f"Конвейер {self.name}: {stats}")
+        return stats
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: stage.as_dict() for name, stage in self._stats.items()}
+
+
+def merge_stats(total: Optional[Dict[str, Dict[str, float]]],
+                stats: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Суммирование статистики нескольких запусков конвейера (например, по окнам)"""
+    result = {name: dict(values) for name, values in (total or {}).items()}
+    for name, values in stats.items():
+        stage = result.setdefault(name, {})
+        for key, value in values.items():
+            stage[key] = round(stage.get(key, 0) + value, 3)
+    return result
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Порции по size элементов: через очередь передаются порции, а не отдельные строки"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -1,16 +1,29 @@
 import logging
-from typing import List, Dict, Optional
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, List, Dict, Optional
 from datetime import datetime, date
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, and_, or_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
 import uuid
 
 from .models import Price, Department, Product, SyncLog
 from .api_client import IikoApiClient
+from .bulk_loader import BulkLoader
+from .fingerprint import content_hash, NEW, CHANGED, UNCHANGED
+from .reference_resolver import get_reference_resolver
+from config.config import PRICE_SYNC_MAX_PARALLEL
 
 logger = logging.getLogger(__name__)
 
+# Колонки ограничения unique_price_entry
+PRICE_KEY_COLUMNS = ['department_id', 'product_id', 'product_size_id', 'price_type', 'date_from', 'date_to']
+# Колонки отпечатка цены (content_hash)
+PRICE_HASH_COLUMNS = PRICE_KEY_COLUMNS + ['price', 'tax_category_id', 'tax_category_enabled', 'included',
+                                          'dish_of_day', 'flyer_program', 'document_id', 'schedule']
+
 
 class PriceSynchronizer:
     def __init__(self, api_client: IikoApiClient, connection_string: str):
@@ -18,6 +31,7 @@ class PriceSynchronizer:
         self.engine = create_engine(connection_string)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        self.references = get_reference_resolver()
     
     def sync_prices(self, department_id: str, date_from: str, date_to: str, price_type: str = 'BASE') -> Dict[str, any]:
         """Синхронизация цен для конкретного подразделения за период"""
@@ -30,75 +44,19 @@ class PriceSynchronizer:
             if not department:
                 raise ValueError(f"Подразделение с ID {department_id} не найдено")
             
+            self.references.refresh_if_changed(self.session, ['products'])
+            references_before = self.references.stats()
+            
             # Получаем данные из API
             prices_data = self.api_client.get_prices(department_id, date_from, date_to, price_type)
             logger.info(f"Получено {len(prices_data)} записей о ценах из API")
             
-            created_count = 0
-            updated_count = 0
-            skipped_count = 0
-            
-            # Удаляем старые цены для этого подразделения и периода
-            self.session.query(Price).filter(
-                and_(
-                    Price.department_id == uuid.UUID(department_id),
-                    Price.price_type == price_type,
-                    Price.date_from >= datetime.strptime(date_from, '%Y-%m-%d').date(),
-                    Price.date_to <= datetime.strptime(date_to, '%Y-%m-%d').date()
-                )
-            ).delete()
-            
-            for price_data in prices_data:
-                dept_id = uuid.UUID(price_data['departmentId'])
-                product_id = uuid.UUID(price_data['productId'])
-                product_size_id = uuid.UUID(price_data['productSizeId']) if price_data.get('productSizeId') else None
-                
-                # Проверяем существование продукта
-                product = self.session.query(Product).filter_by(id=product_id).first()
-                if not product:
-                    logger.warning(f"Продукт с ID {product_id} не найден, пропускаем")
-                    skipped_count += 1
-                    continue
-                
-                # Обрабатываем каждую цену в массиве prices
-                for price_info in price_data.get('prices', []):
-                    try:
-                        # Парсим даты
-                        price_date_from = datetime.strptime(price_info['dateFrom'], '%Y-%m-%d').date()
-                        price_date_to = datetime.strptime(price_info['dateTo'], '%Y-%m-%d').date()
-                        
-                        # Создаем новую запись о цене
-                        new_price = Price(
-                            department_id=dept_id,
-                            product_id=product_id,
-                            product_size_id=product_size_id,
-                            price_type=price_type,
-                            date_from=price_date_from,
-                            date_to=price_date_to,
-                            price=price_info['price'],
-                            tax_category_id=uuid.UUID(price_info['taxCategoryId']) if price_info.get('taxCategoryId') else None,
-                            tax_category_enabled=price_info.get('taxCategoryEnabled', False),
-                            included=price_info.get('included', True),
-                            dish_of_day=price_info.get('dishOfDay', False),
-                            flyer_program=price_info.get('flyerProgram', False),
-                            document_id=uuid.UUID(price_info['documentId']) if price_info.get('documentId') else None,
-                            schedule=price_info.get('schedule'),
-                            synced_at=datetime.utcnow()
-                        )
-                        self.session.add(new_price)
-                        created_count += 1
-                        
-                    except Exception as e:
-                        logger.error(f"Ошибка при обработке цены для продукта {product_id}: {e}")
-                        skipped_count += 1
-            
-            # Фиксируем изменения
-            self.session.commit()
+            counts = self._write_department_prices(department_id, date_from, date_to, price_type, prices_data)
             
             # Создаем запись в логе синхронизации
             sync_log = SyncLog(
                 entity_type='prices',
-                records_count=created_count,
+                records_count=counts['created'],
                 status='success',
                 details={
                     'department_id': department_id,
@@ -106,8 +64,12 @@ class PriceSynchronizer:
                     'date_from': date_from,
                     'date_to': date_to,
                     'price_type': price_type,
-                    'created': created_count,
-                    'skipped': skipped_count,
+                    'created': counts['created'],
+                    'updated': counts['updated'],
+                    'skipped': counts['skipped'],
+                    'deleted': counts['deleted'],
+                    'diff': {NEW: counts['created'], CHANGED: counts['updated'], UNCHANGED: counts['unchanged']},
+                    'references': self.references.stats(since=references_before),
                     'duration_seconds': (datetime.now() - start_time).total_seconds()
                 }
             )
@@ -119,12 +81,16 @@ class PriceSynchronizer:
                 'department_id': department_id,
                 'department_name': department.name,
                 'total': len(prices_data),
-                'created': created_count,
-                'skipped': skipped_count,
+                'created': counts['created'],
+                'updated': counts['updated'],
+                'unchanged': counts['unchanged'],
+                'deleted': counts['deleted'],
+                'skipped': counts['skipped'],
                 'duration': (datetime.now() - start_time).total_seconds()
             }
             
-            logger.info(f"Синхронизация цен завершена: создано {created_count}, пропущено {skipped_count}")
+            logger.info(f"Синхронизация цен завершена: создано {counts['created']}, обновлено {counts['updated']}, "
+                        f"без изменений {counts['unchanged']}, удалено {counts['deleted']}, пропущено {counts['skipped']}")
             return result
             
         except Exception as e:
@@ -152,6 +118,261 @@ class PriceSynchronizer:
         finally:
             self.session.close()
     
+    def sync_all_prices(self, date_from: str, date_to: str, price_type: str = 'BASE',
+                        max_parallel: Optional[int] = None, department_ids: Optional[List[str]] = None) -> Dict[str, any]:
+        """Синхронизация цен всех подразделений за период
+        
+        Цены подразделений (/v2/price) запрашиваются параллельно, не больше max_parallel
+        запросов одновременно, а записываются в вызывающем потоке по мере получения:
+        каждое подразделение - в своей транзакции, так что ошибка одного не отменяет
+        цены остальных. В SyncLog.details.departments попадают время загрузки и
+        записи, количество строк и результат по каждому подразделению.
+        
+        :param max_parallel: Одновременных запросов цен (по умолчанию PRICE_SYNC_MAX_PARALLEL)
+        :param department_ids: Ограничить синхронизацию подразделениями (по умолчанию все типа DEPARTMENT)
+        :return: Итоги по всем подразделениям и сводка по каждому
+        """
+        max_parallel = max_parallel or PRICE_SYNC_MAX_PARALLEL
+        start_time = datetime.now()
+        
+        try:
+            query = self.session.query(Department.id, Department.name)
+            if department_ids:
+                query = query.filter(Department.id.in_([uuid.UUID(str(dept_id)) for dept_id in department_ids]))
+            else:
+                query = query.filter(Department.type == 'DEPARTMENT')
+            departments = [(str(dept_id), name) for dept_id, name in query.order_by(Department.name)]
+            logger.info(f"Синхронизация цен {len(departments)} подразделений с {date_from} по {date_to} "
+                        f"({max_parallel} параллельных запросов)")
+            
+            self.references.refresh_if_changed(self.session, ['products'])
+            references_before = self.references.stats()
+            
+            def fetch(department_id):
+                fetch_started = time.monotonic()
+                prices_data = self.api_client.get_prices(department_id, date_from, date_to, price_type)
+                return prices_data, time.monotonic() - fetch_started
+            
+            summary = []
+            totals = {'created': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0, 'skipped': 0}
+            queue = deque(departments)
+            with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+                pending = {}
+                while queue or pending:
+                    # Не больше max_parallel ответов одновременно в работе и в памяти
+                    while queue and len(pending) < max_parallel:
+                        department_id, name = queue.popleft()
+                        pending[executor.submit(fetch, department_id)] = (department_id, name)
+                    
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        department_id, name = pending.pop(future)
+                        entry = {'department_id': department_id, 'department_name': name}
+                        try:
+                            prices_data, fetch_seconds = future.result()
+                            entry['fetch_seconds'] = round(fetch_seconds, 3)
+                            entry['total'] = len(prices_data)
+                            
+                            write_started = time.monotonic()
+                            counts = self._write_department_prices(department_id, date_from, date_to,
+                                                                   price_type, prices_data)
+                            entry['write_seconds'] = round(time.monotonic() - write_started, 3)
+                            entry.update(counts, status='success')
+                            for key in totals:
+                                totals[key] += counts[key]
+                        except Exception as e:
+                            self.session.rollback()
+                            logger.error(f"Ошибка при синхронизации цен подразделения {name} ({department_id}): {e}")
+                            entry.update(status='error', error=str(e))
+                        summary.append(entry)
+            
+            failed = [entry for entry in summary if entry['status'] == 'error']
+            duration = (datetime.now() - start_time).total_seconds()
+            sync_log = SyncLog(
+                entity_type='prices',
+                records_count=totals['created'],
+                status='success' if not failed else 'error',
+                error_message=f"Не синхронизированы цены {len(failed)} подразделений" if failed else None,
+                details={
+                    'mode': 'all_departments',
+                    'date_from': date_from,
+                    'date_to': date_to,
+                    'price_type': price_type,
+                    'max_parallel': max_parallel,
+                    'departments_total': len(departments),
+                    'departments_failed': len(failed),
+                    **totals,
+                    'references': self.references.stats(since=references_before),
+                    'duration_seconds': duration,
+                    'departments': summary
+                }
+            )
+            self.session.add(sync_log)
+            self.session.commit()
+            
+            logger.info(f"Синхронизация цен всех подразделений завершена за {duration:.1f} с: "
+                        f"подразделений {len(departments)}, с ошибками {len(failed)}; создано {totals['created']}, "
+                        f"обновлено {totals['updated']}, без изменений {totals['unchanged']}, "
+                        f"удалено {totals['deleted']}, пропущено {totals['skipped']}")
+            return {
+                'status': 'success' if not failed else 'error',
+                'departments': summary,
+                'departments_failed': len(failed),
+                **totals,
+                'duration': duration
+            }
+            
+        except Exception as e:
+            logger.error(f"Ошибка при синхронизации цен всех подразделений: {e}")
+            self.session.rollback()
+            
+            sync_log = SyncLog(
+                entity_type='prices',
+                records_count=0,
+                status='error',
+                error_message=str(e),
+                details={
+                    'mode': 'all_departments',
+                    'date_from': date_from,
+                    'date_to': date_to,
+                    'price_type': price_type
+                }
+            )
+            self.session.add(sync_log)
+            self.session.commit()
+            
+            raise
+        
+        finally:
+            self.session.close()
+    
+    def _price_rows(self, prices_data: List[dict], price_type: str):
+        """Строки таблицы prices из ответа API (цены неизвестных продуктов пропускаются)
+        
+        :return: (строки, количество пропущенных)
+        """
+        skipped_count = 0
+        price_rows = []
+        
+        for price_data in prices_data:
+            dept_id = uuid.UUID(price_data['departmentId'])
+            product_id = uuid.UUID(price_data['productId'])
+            product_size_id = uuid.UUID(price_data['productSizeId']) if price_data.get('productSizeId') else None
+            
+            # Проверяем существование продукта
+            if not self.references.has_product(product_id, self.session):
+                logger.warning(f"Продукт с ID {product_id} не найден, пропускаем")
+                skipped_count += 1
+                continue
+            
+            # Обрабатываем каждую цену в массиве prices
+            for price_info in price_data.get('prices', []):
+                try:
+                    # Парсим даты
+                    price_date_from = datetime.strptime(price_info['dateFrom'], '%Y-%m-%d').date()
+                    price_date_to = datetime.strptime(price_info['dateTo'], '%Y-%m-%d').date()
+                    
+                    price_rows.append({
+                        'department_id': dept_id,
+                        'product_id': product_id,
+                        'product_size_id': product_size_id,
+                        'price_type': price_type,
+                        'date_from': price_date_from,
+                        'date_to': price_date_to,
+                        'price': price_info['price'],
+                        'tax_category_id': uuid.UUID(price_info['taxCategoryId']) if price_info.get('taxCategoryId') else None,
+                        'tax_category_enabled': price_info.get('taxCategoryEnabled', False),
+                        'included': price_info.get('included', True),
+                        'dish_of_day': price_info.get('dishOfDay', False),
+                        'flyer_program': price_info.get('flyerProgram', False),
+                        'document_id': uuid.UUID(price_info['documentId']) if price_info.get('documentId') else None,
+                        'schedule': price_info.get('schedule'),
+                        'synced_at': datetime.utcnow()
+                    })
+                    
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке цены для продукта {product_id}: {e}")
+                    skipped_count += 1
+        
+        for row in price_rows:
+            row['content_hash'] = content_hash(row, PRICE_HASH_COLUMNS)
+        return price_rows, skipped_count
+    
+    def _write_department_prices(self, department_id: str, date_from: str, date_to: str, price_type: str,
+                                 prices_data: List[dict]) -> Dict[str, int]:
+        """Запись цен подразделения за период в отдельной транзакции
+        
+        Полученные интервалы цен сравниваются с сохраненными по ключу unique_price_entry
+        и отпечатку: новые интервалы вставляются, измененные обновляются по id сохраненной
+        строки, интервалы периода, которых нет в ответе API, удаляются, неизмененные
+        не затрагиваются.
+        
+        :return: Счетчики rows/created/updated/unchanged/deleted/skipped
+        """
+        price_rows, skipped_count = self._price_rows(prices_data, price_type)
+        period_from = datetime.strptime(date_from, '%Y-%m-%d').date()
+        period_to = datetime.strptime(date_to, '%Y-%m-%d').date()
+        
+        # Повтор ключа в ответе: побеждает последняя строка, как и при загрузке
+        rows_by_key = {tuple(row[name] for name in PRICE_KEY_COLUMNS): row for row in price_rows}
+        stored = self._stored_prices(department_id, price_type, period_from, period_to, rows_by_key.values())
+        
+        new_rows = []
+        changed_rows = []
+        for key, row in rows_by_key.items():
+            stored_entry = stored.get(key)
+            if stored_entry is None:
+                new_rows.append(row)
+            elif stored_entry[1] != row['content_hash']:
+                changed_rows.append(dict(row, id=stored_entry[0]))
+        
+        # Удаляются только интервалы самого периода: интервалы, выходящие за него,
+        # API возвращает не для каждого запрошенного периода
+        stale_ids = [price_id for key, (price_id, _) in stored.items()
+                     if key not in rows_by_key and key[4] >= period_from and key[5] <= period_to]
+        
+        created = BulkLoader(self.session, Price, conflict_columns=PRICE_KEY_COLUMNS,
+                             hash_column='content_hash').load(new_rows)['inserted']
+        updated = BulkLoader(self.session, Price, conflict_columns=['id'],
+                             hash_column='content_hash').load(changed_rows)['updated']
+        if stale_ids:
+            self.session.query(Price).filter(Price.id.in_(stale_ids)).delete(synchronize_session=False)
+        
+        # Фиксируем изменения
+        self.session.commit()
+        
+        return {
+            'rows': len(rows_by_key),
+            'created': created,
+            'updated': updated,
+            'unchanged': len(rows_by_key) - len(new_rows) - len(changed_rows),
+            'deleted': len(stale_ids),
+            'skipped': skipped_count
+        }
+    
+    def _stored_prices(self, department_id: str, price_type: str, period_from: date, period_to: date,
+                       price_rows: Iterable[dict]) -> Dict[tuple, tuple]:
+        """Сохраненные интервалы цен подразделения одним запросом
+        
+        Кроме интервалов периода выбираются интервалы в границах дат ответа API:
+        ответ может содержать интервалы, выходящие за запрошенный период.
+        
+        :return: {ключ unique_price_entry: (id, content_hash)}
+        """
+        ranges = [and_(Price.date_from >= period_from, Price.date_to <= period_to)]
+        price_rows = list(price_rows)
+        if price_rows:
+            ranges.append(and_(Price.date_from >= min(row['date_from'] for row in price_rows),
+                               Price.date_to <= max(row['date_to'] for row in price_rows)))
+        
+        key_columns = [getattr(Price, name) for name in PRICE_KEY_COLUMNS]
+        query = self.session.query(Price.id, Price.content_hash, *key_columns).filter(
+            Price.department_id == uuid.UUID(department_id),
+            Price.price_type == price_type,
+            or_(*ranges)
+        )
+        return {tuple(key): (price_id, value) for price_id, value, *key in query}
+    
     def get_prices_by_department(self, department_id: Optional[str] = None) -> List[Price]:
         """Получение цен с фильтрацией по подразделению"""
         try:
@@ -0,0 +1,188 @@
+"""
+Ограничение нагрузки на сервер IIKO RMS.
+
+Сервер IIKO один на всю сеть и одновременно обслуживает кассы ресторанов, поэтому
+все запросы процесса проходят через общий ограничитель:
+
+- token bucket с отдельным бюджетом запросов в секунду для каждого класса
+  эндпоинтов (OLAP и цены тяжелее справочников);
+- общий лимит одновременно выполняемых запросов;
+- адаптивное замедление при 429/5xx/409: повтор с экспоненциальной задержкой
+  и jitter, временное снижение бюджета класса с постепенным восстановлением;
+- счетчики времени ожидания для диагностики.
+"""
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from config.config import (
+    IIKO_RATE_LIMITS, IIKO_RATE_MAX_IN_FLIGHT, IIKO_RATE_MAX_RETRIES,
+    IIKO_RATE_BACKOFF_BASE, IIKO_RATE_BACKOFF_MAX
+)
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых сервер перегружен или занят и запрос стоит повторить позже
+THROTTLE_STATUSES = frozenset({409, 429, 500, 502, 503, 504})
+
+# Минимальная доля исходного бюджета при замедлении
+_MIN_RATE_FACTOR = 0.1
+# Шаг восстановления бюджета после каждого успешного запроса (доля исходного)
+_RECOVERY_STEP = 0.05
+
+
+def endpoint_class(url: str) -> str:
+    """Класс эндпоинта по пути URL"""
+    path = urlparse(url).path
+    if '/reports/olap' in path:
+        return 'olap'
+    if '/price' in path:
+        return 'prices'
+    if '/documents/' in path:
+        return 'documents'
+    if path.endswith('/auth') or path.endswith('/logout'):
+        return 'auth'
+    return 'reference'
+
+
+class TokenBucket:
+    """Token bucket: rate запросов в секунду, всплеск до capacity запросов"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, cost: float = 1.0) -> float:
+        """Резервирует cost токенов и возвращает, сколько секунд нужно подождать"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= cost
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def slow_down(self):
+        """Снижение бюджета вдвое (не ниже _MIN_RATE_FACTOR от исходного)"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.base_rate * _MIN_RATE_FACTOR, self.rate / 2)
+
+    def recover(self):
+        """Постепенное восстановление бюджета после успешного запроса"""
+        with self._lock:
+            if self.rate < self.base_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.base_rate, self.rate + self.base_rate * _RECOVERY_STEP)
+
+
+class RateLimiter:
+    """Общий для процесса ограничитель запросов к IIKO API"""
+
+    def __init__(self, limits: Dict[str, float], max_in_flight: int, max_retries: int,
+                 backoff_base: float, backoff_max: float):
+        # Бюджет 0 - класс не ограничивается по частоте
+        self.buckets = {name: TokenBucket(rate) if rate > 0 else None for name, rate in limits.items()}
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
+
+    def _bucket(self, name: str) -> Optional[TokenBucket]:
+        if name in self.buckets:
+            return self.buckets[name]
+        return self.buckets.get('reference')
+
+    def _count(self, name: str, **values):
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, {
+                'requests': 0, 'rate_wait_seconds': 0.0, 'slot_wait_seconds': 0.0,
+                'backoff_seconds': 0.0, 'throttled': 0, 'retries': 0
+            })
+            for key, value in values.items():
+                stats[key] += value
+
+    def acquire(self, name: str):
+        """Ожидание бюджета класса и свободного слота; слот освобождается release()"""
+        bucket = self._bucket(name)
+        rate_wait = bucket.reserve() if bucket else 0.0
+        if rate_wait > 0:
+            time.sleep(rate_wait)
+
+        slot_wait = 0.0
+        if self._slots is not None:
+            started = time.monotonic()
+            self._slots.acquire()
+            slot_wait = time.monotonic() - started
+
+        self._count(name, requests=1, rate_wait_seconds=rate_wait, slot_wait_seconds=slot_wait)
+
+    def release(self):
+        if self._slots is not None:
+            self._slots.release()
+
+    def should_retry(self, status_code: int, attempt: int) -> bool:
+        return status_code in THROTTLE_STATUSES and attempt < self.max_retries
+
+    def on_success(self, name: str):
+        bucket = self._bucket(name)
+        if bucket:
+            bucket.recover()
+
+    def backoff(self, name: str, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Замедление класса и пауза перед повтором (экспоненциальная, с полным jitter)"""
+        bucket = self._bucket(name)
+        if bucket:
+            bucket.slow_down()
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        try:
+            # Retry-After от сервера - нижняя граница паузы
+            delay = max(delay, min(self.backoff_max, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+
+        self._count(name, throttled=1, retries=1, backoff_seconds=delay)
+        logger.warning(f"IIKO API перегружен ({name}), повтор через {delay:.1f} с")
+        time.sleep(delay)
+        return delay
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Снимок счетчиков по классам эндпоинтов"""
+        with self._stats_lock:
+            snapshot = {name: dict(values) for name, values in self._stats.items()}
+        for name, values in snapshot.items():
+            bucket = self._bucket(name)
+            values['current_rate'] = bucket.rate if bucket else None
+        return snapshot
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Общий для процесса ограничитель запросов к IIKO API"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(
+                    IIKO_RATE_LIMITS,
+                    max_in_flight=IIKO_RATE_MAX_IN_FLIGHT,
+                    max_retries=IIKO_RATE_MAX_RETRIES,
+                    backoff_base=IIKO_RATE_BACKOFF_BASE,
+                    backoff_max=IIKO_RATE_BACKOFF_MAX
+                )
+    return _rate_limiter
@@ -0,0 +1,173 @@
+"""
+Справочники в памяти для синхронизаторов: склады, подразделения, продукты.
+
+Вместо точечного запроса к БД на каждую строку продаж, списаний или цен
+справочник загружается одним запросом в компактные словари и используется
+всеми синхронизаторами процесса. Перед каждой синхронизацией проверяется
+отпечаток таблицы (количество строк и max(updated_at)); если таблица изменилась
+(в том числе другим процессом), справочник перечитывается. Синхронизаторы
+справочников после записи сбрасывают его явно через invalidate().
+"""
+import logging
+import threading
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import func
+
+from src.models import Department, Product, Store
+
+logger = logging.getLogger(__name__)
+
+
+def _key(value) -> Optional[str]:
+    """Единый вид идентификатора: строка UUID в нижнем регистре"""
+    return str(value).lower() if value else None
+
+
+class _Dimension:
+    """Один справочник: загрузка, отпечаток таблицы и счетчики обращений"""
+
+    def __init__(self, name: str, model, loader):
+        self.name = name
+        self.model = model
+        self._loader = loader
+        self.fingerprint = None
+        self.data = None
+        self.hits = 0
+        self.misses = 0
+
+    def current_fingerprint(self, session):
+        return tuple(session.query(func.count(self.model.id), func.max(self.model.updated_at)).one())
+
+    def load(self, session, fingerprint=None):
+        self.data = self._loader(session)
+        self.fingerprint = fingerprint or self.current_fingerprint(session)
+        logger.info(f"Справочник {self.name} загружен: {self.fingerprint[0]} записей")
+
+    def count(self, found: bool):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+def _load_stores(session) -> dict:
+    by_id = set()
+    by_name = {}
+    for store_id, name in session.query(Store.id, Store.name):
+        by_id.add(_key(store_id))
+        # Как и прежний запрос .first(), при одинаковых названиях берется первый склад
+        by_name.setdefault(name, store_id)
+    return {'ids': by_id, 'by_name': by_name}
+
+
+def _load_departments(session) -> dict:
+    return {'ids': {_key(dept_id) for (dept_id,) in session.query(Department.id)}}
+
+
+def _load_products(session) -> dict:
+    ids = set()
+    by_code = {}
+    for product_id, code in session.query(Product.id, Product.code):
+        ids.add(_key(product_id))
+        if code:
+            by_code.setdefault(code, product_id)
+    return {'ids': ids, 'by_code': by_code}
+
+
+class ReferenceResolver:
+    """Общий для процесса кэш справочников"""
+
+    def __init__(self):
+        self._dimensions = {
+            'stores': _Dimension('stores', Store, _load_stores),
+            'departments': _Dimension('departments', Department, _load_departments),
+            'products': _Dimension('products', Product, _load_products),
+        }
+        self._lock = threading.RLock()
+
+    def refresh_if_changed(self, session, dimensions: Optional[Iterable[str]] = None):
+        """Перечитывает справочники, таблицы которых изменились с прошлой загрузки
+
+        Вызывается в начале синхронизации: один легкий запрос на справочник.
+        """
+        with self._lock:
+            for name in dimensions or self._dimensions:
+                dimension = self._dimensions[name]
+                fingerprint = dimension.current_fingerprint(session)
+                if dimension.data is None or fingerprint != dimension.fingerprint:
+                    dimension.load(session, fingerprint)
+
+    def invalidate(self, *dimensions: str):
+        """Сброс справочников после их изменения (перечитаются при следующем обращении)"""
+        with self._lock:
+            for name in dimensions or self._dimensions:
+                self._dimensions[name].data = None
+
+    def _data(self, name: str, session=None) -> dict:
+        dimension = self._dimensions[name]
+        if dimension.data is None:
+            if session is None:
+                raise RuntimeError(f"Справочник {name} не загружен: вызовите refresh_if_changed()")
+            with self._lock:
+                if dimension.data is None:
+                    dimension.load(session)
+        return dimension.data
+
+    def _lookup(self, name: str, found):
+        self._dimensions[name].count(bool(found))
+        return found
+
+    def store_id_by_name(self, store_name: str, session=None):
+        """ID склада по названию или None"""
+        if not store_name:
+            return None
+        return self._lookup('stores', self._data('stores', session)['by_name'].get(store_name))
+
+    def has_store(self, store_id, session=None) -> bool:
+        return self._lookup('stores', _key(store_id) in self._data('stores', session)['ids'])
+
+    def has_department(self, department_id, session=None) -> bool:
+        return self._lookup('departments', _key(department_id) in self._data('departments', session)['ids'])
+
+    def department_ids(self, session=None) -> set:
+        """ID всех подразделений (строки UUID в нижнем регистре)"""
+        return set(self._data('departments', session)['ids'])
+
+    def has_product(self, product_id, session=None) -> bool:
+        return self._lookup('products', _key(product_id) in self._data('products', session)['ids'])
+
+    def product_id_by_code(self, code: str, session=None):
+        """ID продукта по коду или None"""
+        if not code:
+            return None
+        return self._lookup('products', self._data('products', session)['by_code'].get(code))
+
+    def stats(self, since: Optional[Dict[str, Dict[str, int]]] = None) -> Dict[str, Dict[str, int]]:
+        """Счетчики попаданий/промахов по справочникам
+
+        :param since: Предыдущий снимок stats(); тогда возвращается прирост с того момента
+        """
+        since = since or {}
+        result = {}
+        for name, dimension in self._dimensions.items():
+            before = since.get(name, {})
+            result[name] = {
+                'hits': dimension.hits - before.get('hits', 0),
+                'misses': dimension.misses - before.get('misses', 0)
+            }
+        return result
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_reference_resolver() -> ReferenceResolver:
+    """Общий для процесса справочник"""
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = ReferenceResolver()
+    return _resolver
@@ -0,0 +1,194 @@
+"""
+Помесячные партиции таблицы sales (PARTITION BY RANGE (close_time)).
+
+- Партиция месяца sales_YYYY_MM создается автоматически перед записью продаж.
+- Свежие партиции имеют B-tree индекс по close_time, старые (после
+  SALES_PARTITION_BTREE_MONTHS месяцев) переводятся на компактный BRIN.
+- Полная перезагрузка месяца идет в отдельную таблицу, которая затем
+  атомарно подменяет партицию месяца (DETACH + ATTACH в одной транзакции).
+
+Структура таблицы создается миграцией 015_partition_sales_by_month.sql.
+"""
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import Iterable, Optional, Set
+
+from sqlalchemy import text
+
+from config.config import SALES_PARTITION_BTREE_MONTHS
+
+logger = logging.getLogger(__name__)
+
+SALES_TABLE = 'sales'
+
+
+def month_start(value) -> date:
+    """Первый день месяца даты/времени"""
+    return date(value.year, value.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{SALES_TABLE}_{month.year:04d}_{month.month:02d}"
+
+
+def _bounds(month: date) -> str:
+    return f"FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+
+
+def is_full_month(start: date, end: date) -> bool:
+    """Период [start, end) - ровно один календарный месяц"""
+    return start.day == 1 and end == next_month(start)
+
+
+class SalesPartitions:
+    """Управление партициями sales; известные партиции кэшируются в процессе"""
+
+    def __init__(self, btree_months: int = SALES_PARTITION_BTREE_MONTHS):
+        self.btree_months = btree_months
+        self._known: Optional[Set[date]] = None
+        self._lock = threading.Lock()
+
+    def _load(self, session) -> Set[date]:
+        rows = session.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table"
+        ), {'table': SALES_TABLE})
+        months = set()
+        for (name,) in rows:
+            try:
+                year, month = name[len(SALES_TABLE) + 1:].split('_')
+                months.add(date(int(year), int(month), 1))
+            except ValueError:
+                continue
+        return months
+
+    def reset(self):
+        """Сброс кэша (например, после отката транзакции, в которой создавались партиции)"""
+        with self._lock:
+            self._known = None
+
+    def ensure(self, session, months: Iterable[date]) -> list:
+        """Создание недостающих партиций месяцев в текущей транзакции сессии
+
+        :return: Созданные партиции
+        """
+        created = []
+        with self._lock:
+            if self._known is None:
+                self._known = self._load(session)
+            for month in sorted(set(months) - self._known):
+                name = partition_name(month)
+                session.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF {SALES_TABLE} FOR VALUES {_bounds(month)}'
+                ))
+                session.execute(text(
+                    f'CREATE INDEX IF NOT EXISTS "{name}_close_time_idx" ON "{name}" (close_time)'
+                ))
+                self._known.add(month)
+                created.append(name)
+        if created:
+            logger.info(f"Созданы партиции продаж: {', '.join(created)}")
+        return created
+
+    def ensure_for_rows(self, session, rows: Iterable[dict]) -> list:
+        """Создание партиций для месяцев close_time строк продаж"""
+        return self.ensure(session, {month_start(row['close_time']) for row in rows if row.get('close_time')})
+
+    def compact_old(self, session, today: Optional[date] = None) -> list:
+        """Перевод старых партиций с B-tree на BRIN по close_time (фиксация - на вызывающей стороне)
+
+        Старые месяцы почти не меняются и читаются диапазонами, для них BRIN
+        в сотни раз меньше B-tree и не мешает отсечению партиций.
+
+        :return: Партиции, переведенные на BRIN
+        """
+        oldest_btree = month_start(today or datetime.now())
+        for _ in range(max(self.btree_months - 1, 0)):
+            oldest_btree = month_start(oldest_btree - timedelta(days=1))
+
+        with self._lock:
+            if self._known is None:
+                self._known = self._load(session)
+            old_months = sorted(month for month in self._known if month < oldest_btree)
+
+        compacted = []
+        for month in old_months:
+            name = partition_name(month)
+            has_btree = session.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE tablename = :table AND indexname = :index"
+            ), {'table': name, 'index': f"{name}_close_time_idx"}).first()
+            if not has_btree:
+                continue
+            session.execute(text(
+                f'CREATE INDEX IF NOT EXISTS "{name}_close_time_brin" ON "{name}" USING brin (close_time)'
+            ))
+            session.execute(text(f'DROP INDEX IF EXISTS "{name}_close_time_idx"'))
+            compacted.append(name)
+        if compacted:
+            logger.info(f"Партиции продаж переведены на BRIN: {', '.join(compacted)}")
+        return compacted
+
+    def truncate(self, session, month: date):
+        """Очистка партиции месяца целиком (вместо построчного DELETE)"""
+        self.ensure(session, [month])
+        session.execute(text(f'TRUNCATE TABLE "{partition_name(month)}"'))
+
+    def create_staging(self, session, month: date) -> str:
+        """Отдельная таблица для полной перезагрузки месяца
+
+        Структура и ограничения как у партиции, CHECK по границам месяца
+        позволяет подключить таблицу без проверочного сканирования.
+        """
+        # Имена ограничений staging-таблицы остаются за партицией после подмены,
+        # поэтому суффикс уникален для каждой перезагрузки
+        staging = f"{partition_name(month)}_reload_{datetime.now():%Y%m%d%H%M%S}"
+        session.execute(text(
+            f'CREATE TABLE "{staging}" (LIKE {SALES_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        ))
+        session.execute(text(
+            f'ALTER TABLE "{staging}" '
+            f'ADD CONSTRAINT "{staging}_pkey" PRIMARY KEY (id, close_time), '
+            f'ADD CONSTRAINT "{staging}_unique_sale_item" '
+            f'UNIQUE NULLS NOT DISTINCT (order_num, fiscal_cheque_number, dish_code, cash_register_number, close_time), '
+            f'ADD CONSTRAINT "{staging}_month" CHECK (close_time >= \'{month.isoformat()}\' '
+            f'AND close_time < \'{next_month(month).isoformat()}\')'
+        ))
+        return staging
+
+    def swap(self, session, month: date, staging: str):
+        """Атомарная подмена партиции месяца загруженной таблицей (в текущей транзакции)
+
+        Запросы к другим месяцам не блокируются дольше, чем на время DETACH/ATTACH,
+        а читатели месяца видят либо старые, либо новые данные целиком.
+        """
+        name = partition_name(month)
+        self.ensure(session, [month])
+        session.execute(text(f'ALTER TABLE {SALES_TABLE} DETACH PARTITION "{name}"'))
+        session.execute(text(f'CREATE INDEX "{staging}_close_time_idx" ON "{staging}" (close_time)'))
+        session.execute(text(f'ALTER TABLE {SALES_TABLE} ATTACH PARTITION "{staging}" FOR VALUES {_bounds(month)}'))
+        session.execute(text(f'ALTER TABLE "{staging}" DROP CONSTRAINT "{staging}_month"'))
+        session.execute(text(f'DROP TABLE "{name}"'))
+        session.execute(text(f'ALTER TABLE "{staging}" RENAME TO "{name}"'))
+        session.execute(text(f'ALTER INDEX "{staging}_close_time_idx" RENAME TO "{name}_close_time_idx"'))
+        logger.info(f"Партиция {name} заменена перезагруженными данными")
+
+
+_partitions = None
+_partitions_lock = threading.Lock()
+
+
+def get_sales_partitions() -> SalesPartitions:
+    """Общий для процесса менеджер партиций продаж"""
+    global _partitions
+    if _partitions is None:
+        with _partitions_lock:
+            if _partitions is None:
+                _partitions = SalesPartitions()
+    return _partitions
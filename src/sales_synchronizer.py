@@ -2,18 +2,26 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, tuple_
 from sqlalchemy.orm import sessionmaker
 import uuid
 import json
 import logging
 from logging.handlers import RotatingFileHandler
-from datetime import datetime
+from datetime import datetime, timedelta
 import traceback
 
 from src.models import Base, Sale, SyncLog, Store
 from src.api_client import IikoApiClient
-from config.config import DATABASE_CONFIG
+from src.bulk_loader import BulkLoader
+from src.fingerprint import content_hash
+from src.pipeline import Pipeline, chunked, merge_stats
+from src.reference_resolver import get_reference_resolver
+from src.sales_partitions import get_sales_partitions, month_start, next_month, is_full_month
+from src.sync_state import get_sync_states, save_sync_state, plan_checkpoints, mark_checkpoint
+from config.config import (
+    DATABASE_CONFIG, SALES_SYNC_OVERLAP_HOURS, SALES_SYNC_INITIAL_DAYS, SALES_BACKFILL_WINDOW_DAYS
+)
 
 # Настройка логирования
 log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs", "sync_sales.log")
@@ -37,7 +45,25 @@ console_handler.setFormatter(console_formatter)
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
+# Колонки ограничения unique_sale_item (close_time - ключ партиций, обязан входить в уникальные ключи)
+SALE_KEY_COLUMNS = ['order_num', 'fiscal_cheque_number', 'dish_code', 'cash_register_number', 'close_time']
+
+# Колонки отпечатка строки продажи: данные из API и вычисляемые из них (без служебных)
+SALE_HASH_COLUMNS = [column.name for column in Sale.__table__.columns
+                     if column.name not in ('id', 'content_hash', 'created_at', 'updated_at', 'synced_at')]
+
+# Тип сущности в sync_state для водяных знаков продаж (scope - ID подразделения)
+SALES_STATE_ENTITY = 'sales'
+
+
 class SalesSynchronizer:
+    # Строк в одной загрузке COPY (и одной транзакции)
+    UPSERT_BATCH_SIZE = 10000
+    # Заказов в одном запросе сверки повторно закрытых чеков
+    RECLOSE_QUERY_SIZE = 1000
+    # Строк в одной порции между стадиями загрузки и сборки батчей
+    FETCH_CHUNK_SIZE = 1000
+    
     def __init__(self):
         """
         Инициализация синхронизатора продаж
@@ -51,23 +77,38 @@ class SalesSynchronizer:
         # Создание API клиента
         self.api_client = IikoApiClient()
         
+        # Общий справочник складов (название -> ID) вместо запроса на каждую продажу
+        self.references = get_reference_resolver()
+        self._references_before = self.references.stats()
+        
+        # Помесячные партиции sales создаются перед записью батча
+        self.partitions = get_sales_partitions()
+        
         # Статистика
         self.stats = {
             "created": 0,
             "updated": 0,
             "errors": 0,
-            "skipped": 0
+            "skipped": 0,
+            "duplicates": 0
         }
         
+        # Максимальное время закрытия чека по подразделениям за текущий запуск
+        self._watermarks = {}
+        
+        # Времена закрытия заказов (UniqOrderId.Id), полученные текущей загрузкой
+        self._closings = {}
+        
         logger.info("Sales synchronizer initialized")
     
-    def sync_sales(self, start_date=None, end_date=None, clear_existing=False):
+    def sync_sales(self, start_date=None, end_date=None, clear_existing=False, department_ids=None):
         """
         Синхронизация продаж из API IIKO
         
         :param start_date: Начальная дата для получения продаж
         :param end_date: Конечная дата для получения продаж
         :param clear_existing: Флаг, указывающий нужно ли удалить существующие данные за указанный период
+        :param department_ids: ID подразделений, по которым дополнительно делится OLAP-запрос
         """
         # Преобразуем формат даты если пришел datetime-local
         if start_date and 'T' in str(start_date):
@@ -84,70 +125,21 @@ class SalesSynchronizer:
                 self._clear_existing_sales(start_date, end_date)
                 self.stats["deleted"] = self.stats.get("deleted", 0) + 1
             
-            # Получение данных о продажах из API
-            sales_data = self.api_client.get_sales(start_date, end_date)
+            self.references.refresh_if_changed(self.session, ['stores'])
+            self._references_before = self.references.stats()
             
-            if not sales_data:
+            # Получение данных о продажах из API потоком: записи приходят по одной,
+            # поэтому память зависит только от размера батча, а не от длины периода
+            sales_stream = self.api_client.iter_sales(start_date, end_date, department_ids)
+            total_sales = self._load_sales(sales_stream)
+            
+            if total_sales == 0:
                 logger.warning("No sales data received from API")
                 self._log_sync_result("No data received", 0)
                 return False
             
-            total_sales = len(sales_data)
             logger.info(f"Received {total_sales} sales from API")
             
-            # Логирование первых и последних 5 продаж для отладки
-            if total_sales > 0:
-                first_sales = sales_data[:min(5, total_sales)]
-                logger.debug(f"First 5 sales: {json.dumps(first_sales, indent=2)}")
-                
-                if total_sales > 5:
-                    last_sales = sales_data[-5:]
-                    logger.debug(f"Last 5 sales: {json.dumps(last_sales, indent=2)}")
-            
-            # Обработка каждой продажи с батчами для коммитов
-            batch_size = 100  # Коммитим каждые 100 записей
-            batch_count = 0
-            
-            for i, sale_data in enumerate(sales_data):
-                try:
-                    self._sync_single_sale(sale_data)
-                    batch_count += 1
-                    
-                    # Коммитим батч каждые 100 записей
-                    if batch_count >= batch_size:
-                        try:
-                            self.session.commit()
-                            batch_count = 0
-                            if i % 1000 == 0:  # Логируем прогресс каждые 1000 записей
-                                logger.info(f"Processed {i+1}/{len(sales_data)} sales...")
-                        except Exception as commit_error:
-                            logger.error(f"Error committing batch: {commit_error}")
-                            self.session.rollback()
-                            self.stats["errors"] += batch_count
-                            batch_count = 0
-                            
-                except Exception as e:
-                    error_msg = str(e)
-                    logger.error(f"Error syncing sale: {error_msg}")
-                    # Для дублирующихся ключей или других constraint нарушений
-                    if any(keyword in error_msg.lower() for keyword in ["duplicate key", "unique constraint", "violates"]):
-                        logger.debug(f"Constraint violation for sale: order_num={sale_data.get('OrderNum')}, fiscal_cheque_number={sale_data.get('FiscalChequeNumber')}, dish_code={sale_data.get('DishCode')}")
-                        self.session.rollback()
-                        batch_count = 0
-                    else:
-                        logger.error(traceback.format_exc())
-                        self.session.rollback()
-                        batch_count = 0
-                    self.stats["errors"] += 1
-            
-            # Финальный коммит для оставшихся записей
-            if batch_count > 0:
-                try:
-                    self.session.commit()
-                except Exception as commit_error:
-                    logger.error(f"Error in final commit: {commit_error}")
-                    self.session.rollback()
-            
             # Запись в лог информации о синхронизации
             logger.info(f"Sales synchronization finished. Stats: {self.stats}")
             self._log_sync_result("success", total_sales)
@@ -169,291 +161,509 @@ class SalesSynchronizer:
             except Exception as close_error:
                 logger.error(f"Error closing session: {close_error}")
     
-    def _sync_single_sale(self, sale_data):
+    def sync_sales_incremental(self, overlap_hours=None, department_ids=None):
         """
-        Обработка и сохранение данных одной продажи с использованием upsert
+        Инкрементальная синхронизация продаж по водяным знакам подразделений
         
-        :param sale_data: Данные продажи из API
-        """
-        from sqlalchemy.dialects.postgresql import insert
+        Для каждого подразделения хранится максимальное время закрытия загруженного
+        чека (sync_state, entity_type='sales', scope=ID подразделения). Запрашивается
+        только период от водяного знака минус перекрытие до сегодняшнего дня включительно;
+        подразделения без водяного знака загружаются за SALES_SYNC_INITIAL_DAYS дней.
+        Подразделения с одинаковой начальной датой запрашиваются одним OLAP-фильтром.
         
-        # Проверяем, не является ли чек отмененным
-        is_storned = sale_data.get("Storned", "").upper() == "TRUE" or sale_data.get("Storned") is True
-        if is_storned:
-            logger.debug(f"Skipping storned sale: order_num={sale_data.get('OrderNum')}")
-            self.stats["skipped"] += 1
-            return
+        :param overlap_hours: Перекрытие с водяным знаком в часах (по умолчанию SALES_SYNC_OVERLAP_HOURS)
+        :param department_ids: Ограничить синхронизацию подразделениями (по умолчанию все известные)
+        """
+        overlap = timedelta(hours=SALES_SYNC_OVERLAP_HOURS if overlap_hours is None else overlap_hours)
+        now = datetime.now()
+        end_date = (now + timedelta(days=1)).strftime('%Y-%m-%d')
+        initial_date = (now - timedelta(days=SALES_SYNC_INITIAL_DAYS)).strftime('%Y-%m-%d')
         
-        order_num = int(sale_data.get("OrderNum", 0))
-        fiscal_cheque_number = sale_data.get("FiscalChequeNumber")
-        dish_code = sale_data.get("DishCode")
-        cash_register_number = sale_data.get("CashRegisterName.Number")
+        logger.info(f"Starting incremental sales synchronization (overlap={overlap})")
         
         try:
-            with self.session.no_autoflush:
-                # Подготавливаем данные для upsert
-                sale_dict = self._prepare_sale_data(sale_data)
-                
-                # Используем PostgreSQL UPSERT (INSERT ... ON CONFLICT ... DO UPDATE)
-                stmt = insert(Sale).values(**sale_dict)
-                
-                # При конфликте обновляем все поля кроме уникального ключа и id
-                update_dict = {key: stmt.excluded[key] for key in sale_dict.keys() 
-                              if key not in ['id', 'order_num', 'fiscal_cheque_number', 'dish_code', 'cash_register_number', 'created_at']}
-                update_dict['updated_at'] = stmt.excluded.updated_at
-                update_dict['synced_at'] = stmt.excluded.synced_at
-                
-                upsert_stmt = stmt.on_conflict_do_update(
-                    index_elements=['order_num', 'fiscal_cheque_number', 'dish_code', 'cash_register_number'],
-                    set_=update_dict
-                )
-                
-                result = self.session.execute(upsert_stmt)
-                
-                # Определяем, была ли запись создана или обновлена
-                if result.rowcount > 0:
-                    # Проверяем, была ли запись создана (INSERT) или обновлена (UPDATE)
-                    # Для PostgreSQL это сложно определить напрямую, поэтому считаем как created
-                    self.stats["created"] += 1
-                    logger.debug(f"Upserted sale: order_num={order_num}, fiscal_cheque_number={fiscal_cheque_number}")
+            self.references.refresh_if_changed(self.session, ['stores', 'departments'])
+            self._references_before = self.references.stats()
+            
+            states = get_sync_states(self.session, SALES_STATE_ENTITY)
+            known = set(states) | self.references.department_ids(self.session)
+            known.discard('')
+            selected = {str(d).lower() for d in department_ids} if department_ids else known
+            
+            # Начальная дата OLAP-фильтра (OpenDate) по каждому подразделению
+            groups = {}
+            for scope in sorted(selected):
+                state = states.get(scope)
+                if state is not None and state.watermark:
+                    start_date = (state.watermark - overlap).strftime('%Y-%m-%d')
+                else:
+                    start_date = initial_date
+                groups.setdefault(start_date, []).append(scope)
+            
+            total_sales = 0
+            if not groups:
+                # Подразделения еще неизвестны - первая загрузка без фильтра
+                groups = {initial_date: None}
+            for start_date, scopes in sorted(groups.items()):
+                # Если окно общее для всех подразделений, фильтр не нужен: так же
+                # подхватываются продажи новых подразделений
+                filter_ids = None if department_ids is None and len(groups) == 1 else scopes
+                logger.info(f"Incremental sales window from {start_date}" +
+                            (f" for {len(filter_ids)} departments" if filter_ids else ""))
+                sales_stream = self.api_client.iter_sales(start_date, end_date, filter_ids,
+                                                          split_departments=False)
+                total_sales += self._load_sales(sales_stream)
+            
+            # Водяные знаки подразделений без продаж в окне не сдвигаются: их кассы могли
+            # еще не выгрузить чеки, и следующий запуск должен запросить тот же период
+            self._save_watermarks()
+            self._compact_partitions()
+            
+            self.stats["mode"] = "incremental"
+            self.stats["windows"] = {start_date: len(scopes) if scopes else None
+                                     for start_date, scopes in groups.items()}
+            
+            logger.info(f"Incremental sales synchronization finished: {total_sales} rows. Stats: {self.stats}")
+            self._log_sync_result("success", total_sales)
+            return True
             
         except Exception as e:
-            logger.error(f"Error in upsert for sale order_num={order_num}: {e}")
-            logger.error(f"Sale data: order_num={order_num}, fiscal_cheque_number={fiscal_cheque_number}, dish_code={dish_code}, cash_register_number={cash_register_number}")
-            self.stats["errors"] = self.stats.get("errors", 0) + 1
-            raise e
+            logger.error(f"Error during incremental sales synchronization: {str(e)}")
+            logger.error(traceback.format_exc())
+            try:
+                self.session.rollback()
+            except Exception as rollback_error:
+                logger.error(f"Error during rollback: {rollback_error}")
+            self._log_sync_result("error", 0, error_message=str(e))
+            return False
+        finally:
+            try:
+                self.session.close()
+            except Exception as close_error:
+                logger.error(f"Error closing session: {close_error}")
     
-    def _prepare_sale_data(self, sale_data):
+    def backfill_sales(self, start_date, end_date, resume=False, clear_existing=False, window_days=None):
         """
-        Подготавливает данные продажи в формате словаря для upsert
+        Возобновляемая загрузка истории продаж по окнам
         
-        :param sale_data: Данные продажи из API
-        :return: Словарь с данными для вставки/обновления
-        """
-        # Получаем связанный склад по имени, если есть
-        store_name = sale_data.get("Store.Name")
-        store_id = None
+        Период делится на окна по window_days дней, состояние каждого окна (pending,
+        running, done, failed, количество строк, длительность) хранится в sync_checkpoints
+        под идентификатором загрузки sales:<начало>:<конец>. Загрузка останавливается на
+        первом неудачном окне; повторный запуск с resume=True продолжает с первого
+        незавершенного окна, не перезагружая завершенные.
         
-        if store_name:
-            store = self.session.query(Store).filter(Store.name == store_name).first()
-            if store:
-                store_id = store.id
+        :param start_date: Начальная дата в формате YYYY-MM-DD
+        :param end_date: Конечная дата в формате YYYY-MM-DD (не включается)
+        :param resume: Продолжить прерванную загрузку того же периода
+        :param clear_existing: Перезагрузить окна целиком; окна тогда совпадают с календарными
+            месяцами, и полный месяц загружается в отдельную таблицу с подменой партиции
+        :param window_days: Размер окна в днях (по умолчанию SALES_BACKFILL_WINDOW_DAYS)
+        :return: True, если все окна загружены
+        """
+        if start_date and 'T' in str(start_date):
+            start_date = start_date.split('T')[0]
+        if end_date and 'T' in str(end_date):
+            end_date = end_date.split('T')[0]
         
-        # Обработка полей с датами
-        close_time = None
-        if sale_data.get("CloseTime"):
-            try:
-                close_time = datetime.strptime(sale_data["CloseTime"], "%Y-%m-%dT%H:%M:%S.%f")
-            except ValueError:
-                try:
-                    close_time = datetime.strptime(sale_data["CloseTime"], "%Y-%m-%dT%H:%M:%S")
-                except ValueError:
-                    logger.warning(f"Could not parse CloseTime: {sale_data['CloseTime']}")
+        range_start = datetime.strptime(start_date, '%Y-%m-%d').date()
+        range_end = datetime.strptime(end_date, '%Y-%m-%d').date()
+        if range_end <= range_start:
+            range_end = range_start + timedelta(days=1)
+        window_days = window_days or SALES_BACKFILL_WINDOW_DAYS
         
-        precheque_time = None
-        if sale_data.get("PrechequeTime"):
-            try:
-                precheque_time = datetime.strptime(sale_data["PrechequeTime"], "%Y-%m-%dT%H:%M:%S.%f")
-            except ValueError:
-                try:
-                    precheque_time = datetime.strptime(sale_data["PrechequeTime"], "%Y-%m-%dT%H:%M:%S")
-                except ValueError:
-                    logger.warning(f"Could not parse PrechequeTime: {sale_data['PrechequeTime']}")
+        windows = []
+        window_start = range_start
+        while window_start < range_end:
+            if clear_existing:
+                window_end = min(next_month(window_start), range_end)
+            else:
+                window_end = min(window_start + timedelta(days=window_days), range_end)
+            windows.append((window_start, window_end))
+            window_start = window_end
         
-        # Возвращаем словарь с данными (UUID генерируется только при INSERT, исключен для UPDATE)
-        return {
-            'id': uuid.uuid4(),  # Это будет использоваться только при INSERT
-            'order_num': int(sale_data.get("OrderNum", 0)),
-            'fiscal_cheque_number': sale_data.get("FiscalChequeNumber"),
-            'cash_register_name': sale_data.get("CashRegisterName"),
-            'cash_register_serial_number': sale_data.get("CashRegisterName.CashRegisterSerialNumber"),
-            'cash_register_number': int(sale_data.get("CashRegisterName.Number", 0)) if sale_data.get("CashRegisterName.Number") else None,
-            'close_time': close_time,
-            'precheque_time': precheque_time,
-            'deleted_with_writeoff': sale_data.get("DeletedWithWriteoff", "NOT_DELETED"),
-            'department': sale_data.get("Department"),
-            'department_id': uuid.UUID(sale_data["DepartmentId"]) if sale_data.get("DepartmentId") else None,
-            # Исправлены типы данных - используем Integer как в модели
-            'dish_amount': int(sale_data.get("DishAmountInt", 0)) if sale_data.get("DishAmountInt") is not None else None,
-            'dish_code': sale_data.get("DishCode"),
-            'dish_discount_sum': int(sale_data.get("DishDiscountSumInt", 0)) if sale_data.get("DishDiscountSumInt") is not None else None,
-            'dish_measure_unit': sale_data.get("DishMeasureUnit"),
-            'dish_name': sale_data.get("DishName"),
-            'dish_return_sum': int(sale_data.get("DishReturnSumInt", 0)) if sale_data.get("DishReturnSumInt") is not None else None,
-            'dish_sum': int(sale_data.get("DishSumInt", 0)) if sale_data.get("DishSumInt") is not None else None,
-            'increase_sum': int(sale_data.get("IncreaseSumInt", 0)) if sale_data.get("IncreaseSumInt") is not None else None,
-            'order_increase_type': sale_data.get("OrderIncreaseType", ""),
-            'order_items': int(sale_data.get("OrderItems", 0)) if sale_data.get("OrderItems") else None,
-            'order_type': sale_data.get("OrderType"),
-            'pay_types': sale_data.get("PayTypes"),
-            'store_name': store_name,
-            'store_id': store_id,
-            'storned': sale_data.get("Storned", "").upper() == "TRUE" or sale_data.get("Storned") is True,
-            'created_at': datetime.utcnow(),
-            'updated_at': datetime.utcnow(),
-            'synced_at': datetime.utcnow()
-        }
-    
-    def _create_sale(self, sale_data):
-        """
-        Создание новой записи продажи
+        job_id = f"sales:{range_start.isoformat()}:{range_end.isoformat()}" + (":reload" if clear_existing else "")
+        logger.info(f"Starting sales backfill {job_id}: {len(windows)} windows (resume={resume})")
         
-        :param sale_data: Данные продажи из API
-        """
+        total_sales = 0
+        failed = None
         try:
-            # Получаем связанный склад по имени, если есть
-            store_name = sale_data.get("Store.Name")
-            store_id = None
-            
-            logger.debug(f"Creating sale - Searching for store with name: {store_name}")
-            logger.debug(f"Sale data keys: {sale_data.keys()}")
+            self.references.refresh_if_changed(self.session, ['stores'])
+            self._references_before = self.references.stats()
             
-            if store_name:
-                store = self.session.query(Store).filter(Store.name == store_name).first()
-                if store:
-                    store_id = store.id
-                    logger.debug(f"Found store with id: {store_id}")
-                else:
-                    logger.warning(f"Store with name '{store_name}' not found in database")
+            checkpoints = plan_checkpoints(self.session, job_id, SALES_STATE_ENTITY, windows, resume=resume)
+            self.session.commit()
             
-            # Обработка полей с датами
-            close_time = None
-            if sale_data.get("CloseTime"):
+            for checkpoint in checkpoints:
+                if checkpoint.status == 'done':
+                    logger.info(f"Window {checkpoint.window_start} - {checkpoint.window_end} already done, skipping")
+                    continue
+                
+                window_from = checkpoint.window_start.strftime('%Y-%m-%d')
+                window_to = checkpoint.window_end.strftime('%Y-%m-%d')
+                mark_checkpoint(checkpoint, 'running')
+                self.session.commit()
+                
+                errors_before = self.stats["errors"]
                 try:
-                    close_time = datetime.strptime(sale_data["CloseTime"], "%Y-%m-%dT%H:%M:%S.%f")
-                except ValueError:
-                    try:
-                        close_time = datetime.strptime(sale_data["CloseTime"], "%Y-%m-%dT%H:%M:%S")
-                    except ValueError:
-                        logger.warning(f"Could not parse CloseTime: {sale_data['CloseTime']}")
+                    if clear_existing and is_full_month(checkpoint.window_start, checkpoint.window_end):
+                        rows = self._reload_month(checkpoint.window_start)
+                    else:
+                        if clear_existing:
+                            last_day = (checkpoint.window_end - timedelta(days=1)).strftime('%Y-%m-%d')
+                            self._clear_existing_sales(window_from, last_day)
+                        rows = self._load_sales(self.api_client.iter_sales(window_from, window_to))
+                except Exception as e:
+                    logger.error(f"Window {window_from} - {window_to} failed: {e}")
+                    logger.error(traceback.format_exc())
+                    self.session.rollback()
+                    failed = mark_checkpoint(checkpoint, 'failed', error_message=str(e))
+                    self.session.commit()
+                    break
+                
+                total_sales += rows
+                if self.stats["errors"] > errors_before:
+                    failed = mark_checkpoint(checkpoint, 'failed', rows_count=rows,
+                                             error_message=f"{self.stats['errors'] - errors_before} rows failed to save")
+                    self.session.commit()
+                    break
+                
+                mark_checkpoint(checkpoint, 'done', rows_count=rows)
+                self.session.commit()
+                logger.info(f"Window {window_from} - {window_to} done: {rows} rows in "
+                            f"{checkpoint.duration_seconds:.1f}s")
             
-            precheque_time = None
-            if sale_data.get("PrechequeTime"):
-                try:
-                    precheque_time = datetime.strptime(sale_data["PrechequeTime"], "%Y-%m-%dT%H:%M:%S.%f")
-                except ValueError:
-                    try:
-                        precheque_time = datetime.strptime(sale_data["PrechequeTime"], "%Y-%m-%dT%H:%M:%S")
-                    except ValueError:
-                        logger.warning(f"Could not parse PrechequeTime: {sale_data['PrechequeTime']}")
+            self._compact_partitions()
             
-            # Создаем новую запись
-            new_sale = Sale(
-                id=uuid.uuid4(),
-                order_num=int(sale_data.get("OrderNum", 0)),
-                fiscal_cheque_number=sale_data.get("FiscalChequeNumber"),
-                cash_register_name=sale_data.get("CashRegisterName"),
-                cash_register_serial_number=sale_data.get("CashRegisterName.CashRegisterSerialNumber"),
-                cash_register_number=int(sale_data.get("CashRegisterName.Number", 0)) if sale_data.get("CashRegisterName.Number") else None,
-                close_time=close_time,
-                precheque_time=precheque_time,
-                deleted_with_writeoff=sale_data.get("DeletedWithWriteoff"),
-                department=sale_data.get("Department"),
-                department_id=sale_data.get("Department.Id"),
-                dish_amount=int(sale_data.get("DishAmountInt", 0)) if sale_data.get("DishAmountInt") else None,
-                dish_code=sale_data.get("DishCode"),
-                dish_discount_sum=int(sale_data.get("DishDiscountSumInt", 0)) if sale_data.get("DishDiscountSumInt") else None,
-                dish_measure_unit=sale_data.get("DishMeasureUnit"),
-                dish_name=sale_data.get("DishName"),
-                dish_return_sum=int(sale_data.get("DishReturnSum", 0)) if sale_data.get("DishReturnSum") else None,
-                dish_sum=int(sale_data.get("DishSumInt", 0)) if sale_data.get("DishSumInt") else None,
-                increase_sum=int(sale_data.get("IncreaseSum", 0)) if sale_data.get("IncreaseSum") else None,
-                order_increase_type=sale_data.get("OrderIncrease.Type"),
-                order_items=int(sale_data.get("OrderItems", 0)) if sale_data.get("OrderItems") else None,
-                order_type=sale_data.get("OrderType"),
-                pay_types=sale_data.get("PayTypes"),
-                store_name=store_name,
-                store_id=store_id,
-                storned=(sale_data.get("Storned", "").upper() == "TRUE"),
-                synced_at=datetime.utcnow()
-            )
+            statuses = {}
+            for checkpoint in checkpoints:
+                statuses[checkpoint.status] = statuses.get(checkpoint.status, 0) + 1
+            self.stats["backfill"] = {'job_id': job_id, 'windows': len(checkpoints), 'statuses': statuses}
             
-            self.session.add(new_sale)
-            logger.debug(f"Created new sale: {new_sale.id}")
+            if failed is not None:
+                message = (f"Window {failed.window_start} - {failed.window_end} failed: {failed.error_message}. "
+                           f"Run again with resume to continue")
+                logger.error(message)
+                self._log_sync_result("error", total_sales, error_message=message)
+                return False
+            
+            logger.info(f"Sales backfill {job_id} finished: {total_sales} rows. Stats: {self.stats}")
+            self._log_sync_result("success", total_sales)
+            return True
             
         except Exception as e:
-            self.session.rollback()
-            logger.error(f"Error creating sale: {str(e)}")
+            logger.error(f"Error during sales backfill: {str(e)}")
             logger.error(traceback.format_exc())
-            raise
+            try:
+                self.session.rollback()
+            except Exception as rollback_error:
+                logger.error(f"Error during rollback: {rollback_error}")
+            self._log_sync_result("error", total_sales, error_message=str(e))
+            return False
+        finally:
+            try:
+                self.session.close()
+            except Exception as close_error:
+                logger.error(f"Error closing session: {close_error}")
     
-    def _update_sale(self, sale, sale_data):
+    def _reload_month(self, month):
         """
-        Обновление существующей записи продажи
+        Полная перезагрузка месяца с подменой партиции
+        
+        Продажи месяца загружаются в отдельную таблицу, которая в той же транзакции
+        подменяет партицию месяца, поэтому отчеты видят либо старые, либо новые данные
+        месяца целиком, а удаление старых строк сводится к DROP TABLE.
+        
+        OLAP фильтрует по дате открытия заказа, а партиции - по времени закрытия, поэтому
+        запрашивается и последний день предыдущего месяца. Строки, закрытые вне месяца,
+        записываются обычным upsert после подмены.
         
-        :param sale: Существующая запись продажи
-        :param sale_data: Новые данные продажи из API
+        :param month: Первый день месяца
+        :return: Количество полученных из API записей
         """
+        window_from = (month - timedelta(days=1)).strftime('%Y-%m-%d')
+        window_to = next_month(month).strftime('%Y-%m-%d')
+        logger.info(f"Reloading sales month {month:%Y-%m} via partition swap")
+        
+        staging = self.partitions.create_staging(self.session, month)
+        loader = BulkLoader(self.session, Sale, conflict_columns=SALE_KEY_COLUMNS, table_name=staging,
+                            hash_column='content_hash')
+        
+        batch = {}
+        outside = {}
+        total_sales = 0
+        reloaded = 0
         try:
-            # Получаем связанный склад по имени, если есть
-            store_name = sale_data.get("Store.Name")
-            store_id = None
-            
-            logger.debug(f"Updating sale - Searching for store with name: {store_name}")
-            logger.debug(f"Sale data keys: {sale_data.keys()}")
-            
-            if store_name:
-                store = self.session.query(Store).filter(Store.name == store_name).first()
-                if store:
-                    store_id = store.id
-                    logger.debug(f"Found store with id: {store_id}")
+            for sale_data in self.api_client.iter_sales(window_from, window_to):
+                total_sales += 1
+                self._track_watermark(sale_data)
+                close_time = sale_data.get("close_time")
+                if close_time is not None and month_start(close_time) == month:
+                    self._add_to_batch(batch, sale_data)
+                    if len(batch) >= self.UPSERT_BATCH_SIZE:
+                        reloaded += loader.load(
+                            [self._prepare_sale_data(row) for row in batch.values()])['staged']
+                        batch.clear()
                 else:
-                    logger.warning(f"Store with name '{store_name}' not found in database")
-            
-            # Обработка полей с датами
-            close_time = None
-            if sale_data.get("CloseTime"):
-                try:
-                    close_time = datetime.strptime(sale_data["CloseTime"], "%Y-%m-%dT%H:%M:%S.%f")
-                except ValueError:
-                    try:
-                        close_time = datetime.strptime(sale_data["CloseTime"], "%Y-%m-%dT%H:%M:%S")
-                    except ValueError:
-                        logger.warning(f"Could not parse CloseTime: {sale_data['CloseTime']}")
-            
-            precheque_time = None
-            if sale_data.get("PrechequeTime"):
-                try:
-                    precheque_time = datetime.strptime(sale_data["PrechequeTime"], "%Y-%m-%dT%H:%M:%S.%f")
-                except ValueError:
-                    try:
-                        precheque_time = datetime.strptime(sale_data["PrechequeTime"], "%Y-%m-%dT%H:%M:%S")
-                    except ValueError:
-                        logger.warning(f"Could not parse PrechequeTime: {sale_data['PrechequeTime']}")
-            
-            # Обновляем поля
-            sale.cash_register_name = sale_data.get("CashRegisterName")
-            sale.cash_register_serial_number = sale_data.get("CashRegisterName.CashRegisterSerialNumber")
-            sale.cash_register_number = int(sale_data.get("CashRegisterName.Number", 0)) if sale_data.get("CashRegisterName.Number") else None
-            sale.close_time = close_time
-            sale.precheque_time = precheque_time
-            sale.deleted_with_writeoff = sale_data.get("DeletedWithWriteoff")
-            sale.department = sale_data.get("Department")
-            sale.department_id = sale_data.get("Department.Id")
-            sale.dish_amount = int(sale_data.get("DishAmountInt", 0)) if sale_data.get("DishAmountInt") else None
-            sale.dish_code = sale_data.get("DishCode")
-            sale.dish_discount_sum = int(sale_data.get("DishDiscountSumInt", 0)) if sale_data.get("DishDiscountSumInt") else None
-            sale.dish_measure_unit = sale_data.get("DishMeasureUnit")
-            sale.dish_name = sale_data.get("DishName")
-            sale.dish_return_sum = int(sale_data.get("DishReturnSum", 0)) if sale_data.get("DishReturnSum") else None
-            sale.dish_sum = int(sale_data.get("DishSumInt", 0)) if sale_data.get("DishSumInt") else None
-            sale.increase_sum = int(sale_data.get("IncreaseSum", 0)) if sale_data.get("IncreaseSum") else None
-            sale.order_increase_type = sale_data.get("OrderIncrease.Type")
-            sale.order_items = int(sale_data.get("OrderItems", 0)) if sale_data.get("OrderItems") else None
-            sale.order_type = sale_data.get("OrderType")
-            sale.pay_types = sale_data.get("PayTypes")
-            sale.store_name = store_name
-            sale.store_id = store_id
-            sale.storned = (sale_data.get("Storned", "").upper() == "TRUE")
-            sale.synced_at = datetime.utcnow()
-            
-            logger.debug(f"Updated sale: {sale.id}")
+                    self._add_to_batch(outside, sale_data)
             
+            if batch:
+                reloaded += loader.load(
+                    [self._prepare_sale_data(row) for row in batch.values()])['staged']
+            self.partitions.swap(self.session, month, staging)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            self.partitions.reset()
+            self._closings.clear()
+            raise
+        
+        self.stats["reloaded"] = self.stats.get("reloaded", 0) + reloaded
+        logger.info(f"Month {month:%Y-%m} reloaded: {reloaded} rows")
+        
+        errors_before = self.stats["errors"]
+        if outside:
+            self._flush_sales_batch(outside)
+        self._reconcile_reclosed(errors_before)
+        return total_sales
+    
+    def _compact_partitions(self):
+        """Перевод старых партиций продаж на BRIN (ошибка не прерывает синхронизацию)"""
+        try:
+            compacted = self.partitions.compact_old(self.session)
+            self.session.commit()
+            if compacted:
+                self.stats["brin_partitions"] = compacted
         except Exception as e:
+            logger.warning(f"Could not compact old sales partitions: {e}")
             self.session.rollback()
-            logger.error(f"Error updating sale: {str(e)}")
-            logger.error(traceback.format_exc())
+    
+    def _load_sales(self, sales_stream):
+        """
+        Запись потока продаж батчами с учетом водяных знаков подразделений
+        
+        Загрузка из API, сборка батчей и запись в БД идут конвейером: пока батч
+        записывается, следующий уже загружается и собирается.
+        
+        :param sales_stream: Итератор записей о продажах из API
+        :return: Количество полученных записей
+        """
+        received = {'rows': 0, 'written': 0}
+        errors_before = self.stats["errors"]
+        
+        def build_batches(chunks):
+            # Продажи накапливаются в батч, дедуплицируются по ключу unique_sale_item
+            # и записываются одной загрузкой COPY + INSERT ... ON CONFLICT на батч
+            batch = {}
+            for chunk in chunks:
+                for sale_data in chunk:
+                    position = received['rows']
+                    received['rows'] += 1
+                    
+                    # Логирование первых 5 продаж для отладки
+                    if position < 5:
+                        logger.debug(f"Sale #{position+1}: {json.dumps(sale_data, indent=2, default=str)}")
+                    
+                    self._track_watermark(sale_data)
+                    self._add_to_batch(batch, sale_data)
+                    
+                    if len(batch) >= self.UPSERT_BATCH_SIZE:
+                        yield batch
+                        batch = {}
+            # Финальная запись оставшихся продаж
+            if batch:
+                yield batch
+        
+        def write_batch(batch):
+            received['written'] += len(batch)
+            self._flush_sales_batch(batch)
+            logger.info(f"Processed {received['written']} sales ({received['rows']} received)...")
+        
+        pipeline = Pipeline('sales').add_stage('batch', build_batches)
+        try:
+            stats = pipeline.run(chunked(sales_stream, self.FETCH_CHUNK_SIZE), write_batch)
+        except Exception:
+            self._closings.clear()
             raise
+        self.stats["pipeline"] = merge_stats(self.stats.get("pipeline"), stats)
+        self._reconcile_reclosed(errors_before)
+        return received['rows']
+    
+    def _track_watermark(self, sale_data):
+        """Учет максимального времени закрытия чека по подразделению"""
+        close_time = sale_data.get("close_time")
+        department_id = sale_data.get("department_id")
+        if close_time is None or department_id is None:
+            return
+        scope = str(department_id).lower()
+        if scope not in self._watermarks or close_time > self._watermarks[scope]:
+            self._watermarks[scope] = close_time
+    
+    def _save_watermarks(self):
+        """
+        Сохранение водяных знаков подразделений после записи продаж
+        
+        Водяной знак только растет; при ошибках записи он не сдвигается, чтобы
+        следующий запуск повторно загрузил пропущенный период. Сохраняется только
+        инкрементальной синхронизацией: загрузка за период (в том числе истории) не
+        означает, что подразделение загружено до конца этого периода и позже.
+        """
+        if not self._watermarks:
+            return
+        if self.stats["errors"]:
+            logger.warning("Sales watermarks are not advanced because of write errors")
+            return
+        
+        states = get_sync_states(self.session, SALES_STATE_ENTITY)
+        for scope, close_time in self._watermarks.items():
+            state = states.get(scope)
+            if state is not None and state.watermark and state.watermark >= close_time:
+                continue
+            save_sync_state(self.session, SALES_STATE_ENTITY, scope, watermark=close_time)
+        self.session.commit()
+        self.stats["watermarks"] = {scope: close_time.isoformat() for scope, close_time in self._watermarks.items()}
+    
+    def _add_to_batch(self, batch, sale_data):
+        """
+        Добавление продажи в батч с дедупликацией по ключу unique_sale_item
+        
+        Ключ unique_sale_item объявлен NULLS NOT DISTINCT (миграция 018), поэтому строки
+        с пустыми полями ключа дедуплицируются так же, как остальные.
+        
+        :param batch: Батч {ключ: данные продажи}
+        :param sale_data: Данные продажи из API
+        """
+        # Проверяем, не является ли чек отмененным
+        if sale_data.get("storned"):
+            logger.debug(f"Skipping storned sale: order_num={sale_data.get('order_num')}")
+            self.stats["skipped"] += 1
+            return
+        
+        # Без времени закрытия строку некуда записать: это ключ партиций
+        if sale_data.get("close_time") is None:
+            logger.debug(f"Skipping sale without close_time: order_num={sale_data.get('order_num')}")
+            self.stats["skipped"] += 1
+            self.stats["without_close_time"] = self.stats.get("without_close_time", 0) + 1
+            return
+        
+        if sale_data.get("order_id") is not None:
+            self._closings.setdefault(sale_data["order_id"], set()).add(sale_data["close_time"])
+        
+        key = (
+            sale_data.get("order_num") or 0,
+            sale_data.get("fiscal_cheque_number"),
+            sale_data.get("dish_code"),
+            sale_data.get("cash_register_number"),
+            sale_data.get("close_time")
+        )
+        
+        if key in batch:
+            # Повтор позиции в ответе: в одном INSERT ... ON CONFLICT строка не может
+            # обновляться дважды, поэтому оставляем последнюю версию
+            self.stats["duplicates"] = self.stats.get("duplicates", 0) + 1
+        
+        batch[key] = sale_data
+    
+    def _flush_sales_batch(self, batch):
+        """
+        Запись батча продаж через COPY + слияние и фиксация транзакции
+        
+        При ошибке батч откатывается целиком и учитывается в stats["errors"].
+        """
+        try:
+            with self.session.no_autoflush:
+                loaded = self._upsert_sales_batch(list(batch.values()))
+            self.session.commit()
+            self.stats["created"] += loaded['inserted']
+            self.stats["updated"] += loaded['updated']
+            self.stats["unchanged"] = self.stats.get("unchanged", 0) + loaded['unchanged']
+        except Exception as e:
+            logger.error(f"Error upserting batch of {len(batch)} sales: {e}")
+            logger.error(traceback.format_exc())
+            self.session.rollback()
+            # Партиции, созданные в откаченной транзакции, тоже откатились
+            self.partitions.reset()
+            self.stats["errors"] += len(batch)
+        finally:
+            batch.clear()
+    
+    def _upsert_sales_batch(self, sales_data):
+        """
+        Upsert батча продаж: COPY во временную таблицу и одно слияние по ключу unique_sale_item
+        
+        :param sales_data: Данные продаж без повторов ключа unique_sale_item
+        :return: Счетчики загрузки {'staged', 'inserted', 'updated', 'unchanged'}
+        """
+        rows = [self._prepare_sale_data(sale_data) for sale_data in sales_data]
+        self.partitions.ensure_for_rows(self.session, rows)
+        # Строки с прежним отпечатком не переписываются
+        loader = BulkLoader(self.session, Sale, conflict_columns=SALE_KEY_COLUMNS, hash_column='content_hash')
+        return loader.load(rows)
+    
+    def _reconcile_reclosed(self, errors_before):
+        """
+        Удаление прежних закрытий повторно закрытых чеков после загрузки
+        
+        close_time входит в ключ unique_sale_item, поэтому повторно закрытый чек не совпадает
+        с сохраненным и вставился бы второй продажей. OLAP фильтрует по дате открытия заказа,
+        поэтому загрузка получает все текущие закрытия каждого своего заказа: сохраненные строки
+        тех же заказов (UniqOrderId.Id) с другим временем закрытия - прежние закрытия.
+        Строки без ID заказа (загруженные до миграции 021) не сверяются. Если при загрузке
+        были ошибки записи, сверка пропускается: новые закрытия могли не записаться.
+        
+        :param errors_before: Значение stats["errors"] до загрузки
+        """
+        closings, self._closings = self._closings, {}
+        if not closings:
+            return
+        if self.stats["errors"] > errors_before:
+            logger.warning("Re-closed cheques are not reconciled because of write errors")
+            return
+        
+        order_ids = list(closings)
+        removed = 0
+        for start in range(0, len(order_ids), self.RECLOSE_QUERY_SIZE):
+            chunk = order_ids[start:start + self.RECLOSE_QUERY_SIZE]
+            query = self.session.query(Sale.id, Sale.order_id, Sale.close_time).filter(
+                Sale.order_id.in_(chunk)
+            )
+            stale = [(sale_id, close_time) for sale_id, order_id, close_time in query
+                     if close_time not in closings[order_id]]
+            if stale:
+                removed += self.session.query(Sale).filter(
+                    tuple_(Sale.id, Sale.close_time).in_(stale)
+                ).delete(synchronize_session=False)
+        self.session.commit()
+        
+        if removed:
+            logger.info(f"Removed {removed} rows of re-closed cheques")
+            self.stats["reclosed"] = self.stats.get("reclosed", 0) + removed
+    
+    def _prepare_sale_data(self, sale_data):
+        """
+        Подготавливает данные продажи в формате словаря для upsert
+        
+        :param sale_data: Запись продажи из API (уже приведенная к колонкам модели Sale)
+        :return: Словарь с данными для вставки/обновления
+        """
+        # Получаем связанный склад по имени, если есть
+        store_name = sale_data.get("store_name")
+        store_id = self.references.store_id_by_name(store_name, self.session)
+        
+        now = datetime.utcnow()
+        sale_dict = dict(sale_data)
+        sale_dict.update({
+            'id': uuid.uuid4(),  # Это будет использоваться только при INSERT
+            'order_num': sale_data.get("order_num") or 0,
+            'deleted_with_writeoff': sale_data.get("deleted_with_writeoff") or "NOT_DELETED",
+            'order_increase_type': sale_data.get("order_increase_type") or "",
+            'store_id': store_id,
+            'storned': bool(sale_data.get("storned")),
+            'created_at': now,
+            'updated_at': now,
+            'synced_at': now
+        })
+        sale_dict['content_hash'] = content_hash(sale_dict, SALE_HASH_COLUMNS)
+        return sale_dict
     
     def _clear_existing_sales(self, start_date, end_date):
         """
@@ -478,29 +688,38 @@ class SalesSynchronizer:
                 logger.error(f"Invalid date format: {e}")
                 return False
             
-            # Строим запрос на удаление продаж в указанном диапазоне дат
-            query = self.session.query(Sale).filter(
-                and_(
-                    Sale.close_time >= from_date,
-                    Sale.close_time < to_date
-                )
-            )
-            
-            # Получаем количество записей для удаления
-            count_to_delete = query.count()
-            logger.info(f"Found {count_to_delete} sales to delete for period from {start_date} to {end_date}")
+            # Полные месяцы периода очищаются TRUNCATE партиции, края периода - одним DELETE
+            # без предварительного COUNT (по диапазону close_time отсекаются лишние партиции)
+            deleted = 0
+            truncated = []
+            ranges = []
+            month = month_start(from_date)
+            while month < to_date.date():
+                month_from = max(from_date, datetime.combine(month, datetime.min.time()))
+                month_to = min(to_date, datetime.combine(next_month(month), datetime.min.time()))
+                if month_from.date() == month and month_to.date() == next_month(month):
+                    self.partitions.truncate(self.session, month)
+                    truncated.append(f"{month:%Y-%m}")
+                else:
+                    ranges.append((month_from, month_to))
+                month = next_month(month)
             
-            # Выполняем удаление
-            if count_to_delete > 0:
-                query.delete(synchronize_session=False)
-                self.session.commit()
-                logger.info(f"Deleted {count_to_delete} sales from database")
-                return True
+            for range_from, range_to in ranges:
+                deleted += self.session.query(Sale).filter(
+                    and_(
+                        Sale.close_time >= range_from,
+                        Sale.close_time < range_to
+                    )
+                ).delete(synchronize_session=False)
             
-            return False
+            self.session.commit()
+            logger.info(f"Cleared sales from {start_date} to {end_date}: {deleted} rows deleted"
+                        + (f", truncated months: {', '.join(truncated)}" if truncated else ""))
+            return bool(deleted or truncated)
             
         except Exception as e:
             self.session.rollback()
+            self.partitions.reset()
             logger.error(f"Error clearing existing sales: {str(e)}")
             logger.error(traceback.format_exc())
             raise
@@ -520,7 +739,11 @@ class SalesSynchronizer:
                 records_count=records_count,
                 status=status,
                 error_message=error_message,
-                details=self.stats
+                details=dict(self.stats,
+                             diff={'new': self.stats["created"], 'changed': self.stats["updated"],
+                                   'unchanged': self.stats.get("unchanged", 0)},
+                             api_rate_limit=self.api_client.rate_limit_stats(),
+                             references=self.references.stats(since=self._references_before))
             )
             self.session.add(sync_log)
             self.session.commit()
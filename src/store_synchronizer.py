@@ -1,11 +1,14 @@
 import sys
 sys.path.append('/Users/rus/Projects/iiko-data-sync')
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, literal_column, or_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 from src.models import Base, Store, SyncLog, StoreType
 from src.api_client import IikoApiClient
+from src.sync_state import get_sync_state, save_sync_state
+from src.reference_resolver import get_reference_resolver
 from config.config import DATABASE_CONFIG
 import logging
 
@@ -27,32 +30,32 @@ class StoreSynchronizer:
         self.counters = {
             'created': 0,
             'updated': 0,
+            'unchanged': 0,
+            'deleted': 0,
             'errors': 0,
             'skipped': 0
         }
     
-    def sync_stores(self):
-        """Синхронизация складов из API в БД"""
+    def sync_stores(self, full_refresh=False):
+        """Синхронизация складов из API в БД
+        
+        Запрашиваются только склады, измененные после последней сохраненной ревизии,
+        и изменения сливаются с таблицей на месте (таблица не очищается). Удаленные
+        склады помечаются deleted: по признаку из ленты изменений, а при полной
+        загрузке - все склады, которых нет в ответе.
+        
+        :param full_refresh: Игнорировать сохраненную ревизию и запросить все склады
+        """
         try:
             logger.info("Начинаем синхронизацию складов...")
-            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0}
+            self.counters = {'created': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0, 'errors': 0, 'skipped': 0}
             
-            # Очистка таблицы складов перед синхронизацией
-            try:
-                logger.info("Очистка таблицы складов перед синхронизацией...")
-                store_count = self.session.query(Store).count()
-                logger.info(f"Текущее количество складов в БД: {store_count}")
-                self.session.query(Store).delete()
-                self.session.commit()
-                logger.info("Таблица складов успешно очищена")
-            except Exception as e:
-                self.session.rollback()
-                logger.error(f"Ошибка при очистке таблицы складов: {e}")
-                raise
+            state = None if full_refresh else get_sync_state(self.session, 'stores')
+            revision_from = state.revision if state and state.revision is not None else -1
             
-            # Получаем данные из API
-            stores_data = self.api_client.get_stores()
-            logger.info(f"Получено {len(stores_data)} складов из API")
+            # Получаем данные из API (только изменения после сохраненной ревизии)
+            stores_data, revision = self.api_client.get_stores_since(revision_from)
+            logger.info(f"Получено {len(stores_data)} складов из API (revisionFrom={revision_from})")
             
             # Добавляем отладочную информацию о первых и последних складах
             if stores_data:
@@ -66,17 +69,20 @@ class StoreSynchronizer:
                 logger.info("Последние 5 складов из API:")
                 for i, s in enumerate(last_stores):
                     logger.info(f"  {i+1}. ID: {s.get('id')}, Название: {s.get('name')}, Тип: {s.get('type')}")
-            else:
+            elif revision_from == -1:
                 logger.warning("Получен пустой список складов из API!")
+            else:
+                logger.info("Изменений в складах нет")
             
-            # Процесс обработки каждого склада из API
-            for store_data in stores_data:
-                try:
-                    self._sync_single_store(store_data)
-                except Exception as e:
-                    logger.error(f"Ошибка при синхронизации склада {store_data.get('id')}: {e}")
-                    self.counters['errors'] += 1
-                    self.session.rollback()
+            # Сливаем изменения с таблицей складов одним upsert
+            if stores_data:
+                self._merge_stores(stores_data)
+                if revision_from == -1:
+                    self._mark_missing_stores(stores_data)
+            
+            # Запоминаем ревизию для следующего запуска
+            if revision is not None:
+                save_sync_state(self.session, 'stores', revision=revision)
             
             # Записываем в лог
             sync_log = SyncLog(
@@ -87,15 +93,22 @@ class StoreSynchronizer:
                 details={
                     'created': self.counters['created'],
                     'updated': self.counters['updated'],
+                    'unchanged': self.counters['unchanged'],
+                    'deleted': self.counters['deleted'],
                     'errors': self.counters['errors'],
-                    'skipped': self.counters['skipped']
+                    'skipped': self.counters['skipped'],
+                    'revision_from': revision_from,
+                    'revision': revision
                 }
             )
             self.session.add(sync_log)
             self.session.commit()
+            get_reference_resolver().invalidate('stores')
             
             logger.info(f"Синхронизация складов завершена. Создано: {self.counters['created']}, "
                        f"Обновлено: {self.counters['updated']}, "
+                       f"Без изменений: {self.counters['unchanged']}, "
+                       f"Удалено: {self.counters['deleted']}, "
                        f"Пропущено: {self.counters['skipped']}, "
                        f"Ошибок: {self.counters['errors']}")
             return True
@@ -120,39 +133,90 @@ class StoreSynchronizer:
             logger.error(f"Ошибка синхронизации складов: {e}")
             return False
     
-    def _sync_single_store(self, store_data):
-        """Синхронизация одного склада"""
-        try:
+    def _merge_stores(self, stores_data):
+        """Слияние складов с таблицей одним INSERT ... ON CONFLICT DO UPDATE"""
+        existing_ids = {str(row[0]) for row in self.session.query(Store.id).all()}
+        incoming_ids = {s.get('id') for s in stores_data if s.get('id')}
+        now = datetime.utcnow()
+        
+        rows = {}
+        for store_data in stores_data:
             store_id = store_data.get('id')
-            store_type_str = store_data.get('type', 'STORE')
-            parent_id = store_data.get('parentId')
+            if not store_id:
+                self.counters['skipped'] += 1
+                continue
             
-            # Проверяем, существует ли родительский склад
-            if parent_id and not self.session.query(Store).filter(Store.id == parent_id).first():
+            # Родитель должен быть в БД или в этой же порции изменений
+            parent_id = store_data.get('parentId') or None
+            if parent_id and parent_id not in existing_ids and parent_id not in incoming_ids:
                 logger.warning(f"Родительский склад {parent_id} еще не существует, сбрасываем связь")
                 parent_id = None
             
             # Определяем enum-тип склада
+            store_type_str = store_data.get('type') or 'STORE'
             try:
                 store_type = StoreType[store_type_str]
             except (KeyError, ValueError):
                 logger.warning(f"Неизвестный тип склада: {store_type_str}, используем тип STORE")
                 store_type = StoreType.STORE
             
-            # Создаем экземпляр склада
-            store = Store(
-                id=store_id,
-                parent_id=parent_id,
-                code=store_data.get('code') or None,
-                name=store_data.get('name', ''),
-                type=store_type,
-                synced_at=datetime.utcnow()
-            )
-            
-            self.session.add(store)
-            self.counters['created'] += 1
-            
-            # Коммитим транзакцию
+            rows[store_id] = {
+                'id': store_id,
+                'parent_id': parent_id,
+                'code': store_data.get('code') or None,
+                'name': store_data.get('name') or '',
+                'type': store_type,
+                'deleted': bool(store_data.get('deleted')),
+                'created_at': now,
+                'updated_at': now,
+                'synced_at': now
+            }
+        
+        if not rows:
+            return
+        
+        stmt = insert(Store).values(list(rows.values()))
+        compared = ['parent_id', 'code', 'name', 'type', 'deleted']
+        upsert_stmt = stmt.on_conflict_do_update(
+            index_elements=['id'],
+            set_={
+                'parent_id': stmt.excluded.parent_id,
+                'code': stmt.excluded.code,
+                'name': stmt.excluded.name,
+                'type': stmt.excluded.type,
+                'deleted': stmt.excluded.deleted,
+                'updated_at': stmt.excluded.updated_at,
+                'synced_at': stmt.excluded.synced_at
+            },
+            # Склады без изменений не переписываются (и не меняют updated_at)
+            where=or_(*[Store.__table__.c[name].is_distinct_from(stmt.excluded[name]) for name in compared])
+        ).returning(literal_column('(xmax = 0)'))
+        
+        written = 0
+        for (inserted,) in self.session.execute(upsert_stmt):
+            written += 1
+            if inserted:
+                self.counters['created'] += 1
+            else:
+                self.counters['updated'] += 1
+        self.counters['unchanged'] += len(rows) - written
+    
+    def _mark_missing_stores(self, stores_data):
+        """Пометка удаленными складов, которых нет в ответе полной загрузки"""
+        incoming_ids = [s.get('id') for s in stores_data if s.get('id')]
+        now = datetime.utcnow()
+        deleted = self.session.query(Store).filter(
+            Store.id.notin_(incoming_ids),
+            Store.deleted.is_(False)
+        ).update({'deleted': True, 'updated_at': now, 'synced_at': now}, synchronize_session=False)
+        if deleted:
+            logger.info(f"Помечено удаленными складов, отсутствующих в IIKO: {deleted}")
+        self.counters['deleted'] += deleted
+    
+    def _sync_single_store(self, store_data):
+        """Синхронизация одного склада (upsert одной записи)"""
+        try:
+            self._merge_stores([store_data])
             self.session.commit()
             return True
                 
@@ -0,0 +1,87 @@
+import logging
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+from src.models import SyncCheckpoint, SyncState
+
+logger = logging.getLogger(__name__)
+
+
+def get_sync_state(session, entity_type: str, scope: str = '') -> Optional[SyncState]:
+    """Сохраненное состояние инкрементальной синхронизации сущности"""
+    return session.query(SyncState).filter_by(entity_type=entity_type, scope=scope or '').first()
+
+
+def get_sync_states(session, entity_type: str) -> Dict[str, SyncState]:
+    """Все состояния сущности по областям (scope -> состояние)"""
+    return {state.scope: state for state in session.query(SyncState).filter_by(entity_type=entity_type).all()}
+
+
+def save_sync_state(session, entity_type: str, scope: str = '', **values) -> SyncState:
+    """Создание или обновление состояния (фиксация транзакции - на вызывающей стороне)
+
+    :param values: Поля SyncState для обновления (revision, watermark, details)
+    """
+    state = get_sync_state(session, entity_type, scope)
+    if state is None:
+        state = SyncState(entity_type=entity_type, scope=scope or '')
+        session.add(state)
+
+    for key, value in values.items():
+        setattr(state, key, value)
+    state.updated_at = datetime.utcnow()
+
+    logger.debug(f"Состояние синхронизации {entity_type}/{scope or '*'}: {values}")
+    return state
+
+
+def plan_checkpoints(session, job_id: str, entity_type: str, windows: List[Tuple[date, date]],
+                     resume: bool = False) -> List[SyncCheckpoint]:
+    """Окна загрузки истории с сохраненным состоянием (фиксация транзакции - на вызывающей стороне)
+
+    Без resume все окна загрузки переводятся в pending и выполняются заново; с resume
+    завершенные окна сохраняют статус done, а прерванные (running) и упавшие (failed)
+    ставятся в очередь снова.
+
+    :param windows: Окна (начало включительно, конец не включается)
+    :return: Чекпоинты окон в порядке дат
+    """
+    existing = {checkpoint.window_start: checkpoint
+                for checkpoint in session.query(SyncCheckpoint).filter_by(job_id=job_id).all()}
+
+    checkpoints = []
+    for window_start, window_end in windows:
+        checkpoint = existing.get(window_start)
+        if checkpoint is None:
+            checkpoint = SyncCheckpoint(job_id=job_id, entity_type=entity_type,
+                                        window_start=window_start, window_end=window_end, status='pending')
+            session.add(checkpoint)
+        elif not resume or checkpoint.status != 'done' or checkpoint.window_end != window_end:
+            checkpoint.window_end = window_end
+            checkpoint.status = 'pending'
+            checkpoint.error_message = None
+        checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def mark_checkpoint(checkpoint: SyncCheckpoint, status: str, rows_count: Optional[int] = None,
+                    error_message: Optional[str] = None) -> SyncCheckpoint:
+    """Смена статуса окна загрузки; длительность считается от перевода в running"""
+    now = datetime.utcnow()
+    checkpoint.status = status
+    if status == 'running':
+        checkpoint.started_at = now
+        checkpoint.finished_at = None
+        checkpoint.rows_count = None
+        checkpoint.duration_seconds = None
+        checkpoint.error_message = None
+    else:
+        checkpoint.finished_at = now
+        if checkpoint.started_at:
+            checkpoint.duration_seconds = (now - checkpoint.started_at).total_seconds()
+        if rows_count is not None:
+            checkpoint.rows_count = rows_count
+        if error_message is not None:
+            checkpoint.error_message = error_message
+    checkpoint.updated_at = now
+    return checkpoint
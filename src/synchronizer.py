@@ -4,15 +4,39 @@ sys.path.append('/Users/rus/Projects/iiko-data-sync')
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import json
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 from src.models import Base, Product, ProductModifier, Category, SyncLog, Account, WriteoffDocument, WriteoffItem, WriteoffDocumentStatus
 from src.api_client import IikoApiClient
-from config.config import DATABASE_CONFIG
+from src.bulk_loader import BulkLoader
+from src.fingerprint import content_hash, load_hashes, classify, NEW, UNCHANGED
+from src.pipeline import Pipeline, chunked, merge_stats
+from src.reference_resolver import get_reference_resolver
+from src.sync_state import get_sync_state, save_sync_state, plan_checkpoints, mark_checkpoint
+from config.config import (DATABASE_CONFIG, WRITEOFF_SYNC_CORRECTION_HOURS, WRITEOFF_SYNC_INITIAL_DAYS,
+                           WRITEOFF_SYNC_WINDOW_DAYS)
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Колонки отпечатков (content_hash): значения из API, которые записываются в строку
+PRODUCT_HASH_COLUMNS = ('deleted', 'name', 'description', 'num', 'code', 'parent',
+                        'taxCategory', 'category', 'accountingCategory')
+ACCOUNT_HASH_COLUMNS = ('deleted', 'code', 'name', 'accountParentId', 'parentCorporateId', 'type',
+                        'system', 'customTransactionsAllowed')
+WRITEOFF_HASH_COLUMNS = ('date_incoming', 'document_number', 'status', 'conception_id', 'comment',
+                         'store_id', 'account_id')
+
+# Состояние инкрементальной синхронизации списаний (один водяной знак, scope='')
+WRITEOFF_STATE_ENTITY = 'writeoff_documents'
+
+
 class DataSynchronizer:
+    # Строк продуктов в одной загрузке COPY
+    PRODUCTS_LOAD_CHUNK = 10000
+    # Документов списания в одной записи (и одной транзакции)
+    WRITEOFF_BATCH_SIZE = 500
+    
     def __init__(self):
         # Создаем подключение к БД
         db_url = f"postgresql://{DATABASE_CONFIG['user']}:{DATABASE_CONFIG['password']}@{DATABASE_CONFIG['host']}:{DATABASE_CONFIG['port']}/{DATABASE_CONFIG['database']}"
@@ -24,101 +48,83 @@ class DataSynchronizer:
         # Клиент API
         self.api_client = IikoApiClient()
         
+        # Общий справочник продуктов для проверки ссылок в документах
+        self.references = get_reference_resolver()
+        
         # Счетчики для отчетности
         self.counters = {
             'created': 0,
             'updated': 0,
-            'errors': 0
+            'errors': 0,
+            'skipped': 0,
+            'unchanged': 0
+        }
+        # Дата последнего записанного документа списания
+        self._writeoff_last_date = None
+    
+    def _diff(self):
+        """Разбивка строк текущей синхронизации по отпечаткам: новые, измененные, без изменений"""
+        return {
+            'new': self.counters['created'],
+            'changed': self.counters['updated'],
+            'unchanged': self.counters.get('unchanged', 0)
         }
     
+    @staticmethod
+    def _product_hash(product_data):
+        """Отпечаток продукта: базовые поля, связи и модификаторы из API"""
+        return content_hash(product_data, PRODUCT_HASH_COLUMNS, extra=product_data.get('modifiers') or [])
+    
     def sync_products(self):
-        """Синхронизация продуктов из API в БД с использованием upsert логики"""
+        """Синхронизация продуктов из API в БД массовым upsert всего каталога"""
         try:
             logger.info("Начинаем синхронизацию продуктов...")
-            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0}
+            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0, 'unchanged': 0}
             
-            # Получаем текущее количество продуктов в БД
-            product_count = self.session.query(Product).count()
-            logger.info(f"Текущее количество продуктов в БД: {product_count}")
-            logger.info("Используем upsert логику для обновления продуктов...")
+            # Добавляем отладочную информацию о первых и последних продуктах
+            last_products = deque(maxlen=5)
             
-            # Получаем данные из API
-            products_data = self.api_client.get_products()
-            logger.info(f"Получено {len(products_data)} продуктов из API")
+            def logged(products):
+                for position, product_data in enumerate(products):
+                    if position < 5:
+                        if position == 0:
+                            logger.info("Первые 5 продуктов из API:")
+                        logger.info(f"  {position+1}. ID: {product_data.get('id')}, Название: {product_data.get('name')}, Код: {product_data.get('code')}")
+                    last_products.append(product_data)
+                    yield product_data
             
-            # Добавляем отладочную информацию о первых и последних продуктах
-            if products_data:
-                first_products = products_data[:5]
-                last_products = products_data[-5:]
-                
-                logger.info("Первые 5 продуктов из API:")
-                for i, p in enumerate(first_products):
-                    logger.info(f"  {i+1}. ID: {p.get('id')}, Название: {p.get('name')}, Код: {p.get('code')}")
-                    
+            processed_count = self.upsert_products(logged(self.api_client.iter_products()))
+            
+            if processed_count:
+                logger.info(f"Получено {processed_count} продуктов из API")
                 logger.info("Последние 5 продуктов из API:")
                 for i, p in enumerate(last_products):
                     logger.info(f"  {i+1}. ID: {p.get('id')}, Название: {p.get('name')}, Код: {p.get('code')}")
             else:
                 logger.warning("Получен пустой список продуктов из API!")
             
-            # Получаем список уже имеющихся id продуктов в БД для оптимизации
-            existing_product_ids = set()
-            try:
-                for row in self.session.query(Product.id).all():
-                    existing_product_ids.add(str(row[0]))
-                logger.info(f"В базе данных уже есть {len(existing_product_ids)} продуктов")
-            except Exception as e:
-                logger.error(f"Ошибка при получении существующих ID продуктов: {e}")
-                existing_product_ids = set()
-            
-            # Сначала синхронизируем категории
-            try:
-                self._extract_and_sync_categories(products_data)
-                self.session.commit()
-                logger.info("Категории успешно синхронизированы")
-            except Exception as e:
-                self.session.rollback()
-                logger.error(f"Ошибка синхронизации категорий: {e}")
-                raise
-            
-            # Процесс обработки каждого продукта из API
-            processed_count = 0
-            batch_size = 500
-            current_batch = []
-            
-            for product_data in products_data:
-                current_batch.append(product_data)
-                processed_count += 1
-                
-                # Обрабатываем пакетами для оптимизации
-                if len(current_batch) >= batch_size:
-                    self._process_products_batch(current_batch, existing_product_ids)
-                    logger.info(f"Обработано {processed_count} продуктов из {len(products_data)}")
-                    current_batch = []
-            
-            # Обрабатываем оставшиеся продукты
-            if current_batch:
-                self._process_products_batch(current_batch, existing_product_ids)
-                logger.info(f"Обработано {processed_count} продуктов из {len(products_data)}")
-            
             # Записываем в лог
             sync_log = SyncLog(
                 entity_type='products',
-                records_count=len(products_data),
+                records_count=processed_count,
                 status='success',
                 sync_date=datetime.utcnow(),
                 details={
                     'created': self.counters['created'],
                     'updated': self.counters['updated'],
                     'errors': self.counters['errors'],
-                    'skipped': self.counters['skipped']
+                    'skipped': self.counters['skipped'],
+                    'diff': self._diff(),
+                    'modifiers': self.counters.get('modifiers')
                 }
             )
             self.session.add(sync_log)
             self.session.commit()
+            self.references.invalidate('products')
             
             logger.info(f"Синхронизация завершена. Создано: {self.counters['created']}, "
                        f"Обновлено: {self.counters['updated']}, "
+                       f"Без изменений: {self.counters['unchanged']}, "
                        f"Пропущено: {self.counters['skipped']}, "
                        f"Ошибок: {self.counters['errors']}")
             return True
@@ -142,425 +148,294 @@ class DataSynchronizer:
             
             logger.error(f"Ошибка синхронизации: {e}")
             return False
-            
-    def _process_products_batch(self, products_batch, existing_product_ids):
-        """Обработка пакета продуктов с применением оптимизаций и устойчивой обработкой ошибок"""
-        # Создаем меньшие подпакеты для более устойчивой обработки
-        sub_batch_size = 50
-        total_processed = 0
-        success_count = 0
-        
-        # Разбиваем большой пакет на более мелкие для устойчивости
-        for i in range(0, len(products_batch), sub_batch_size):
-            sub_batch = products_batch[i:i+sub_batch_size]
-            success = self._process_small_products_batch(sub_batch, existing_product_ids)
-            
-            total_processed += len(sub_batch)
-            if success:
-                success_count += len(sub_batch)
-                
-        return (success_count > 0)
     
-    def _process_small_products_batch(self, products_batch, existing_product_ids):
-        """Обработка небольшого пакета продуктов с применением оптимизаций"""
-        # Этап 1: Создаем записи с базовой информацией (без родительских ссылок)
-        products_to_create = []
-        products_to_update = []
+    def upsert_products(self, products):
+        """Массовый upsert каталога продуктов в одной транзакции
         
-        for product_data in products_batch:
-            try:
-                product_id = product_data.get('id')
-                # Проверяем существование по ID
-                if product_id in existing_product_ids:
-                    # Продукт уже существует, добавляем в список на обновление
-                    products_to_update.append(product_data)
-                else:
-                    # Создаем новый продукт
-                    products_to_create.append(product_data)
-            except Exception as e:
-                self.counters['errors'] += 1
-                logger.error(f"Ошибка при предварительной обработке продукта {product_data.get('id')}: {e}")
-        
-        # Создаем новые продукты
-        for product_data in products_to_create:
-            try:
-                product_id = product_data.get('id')
-                # Создаем новый продукт с базовой информацией
-                success = self._create_product_basic(product_data)
-                # Если успешно создан, добавляем ID в множество существующих для будущих проверок
-                if success:
-                    existing_product_ids.add(product_id)
-            except Exception as e:
-                self.counters['errors'] += 1
-                logger.error(f"Ошибка создания продукта {product_data.get('id')}: {e}")
-                self.session.rollback()
-                
-        # Обновляем существующие продукты
-        for product_data in products_to_update:
-            try:
-                product_id = product_data.get('id')
-                # Обновляем существующий продукт
-                self._update_product_basic_by_id(product_id, product_data)
-            except Exception as e:
-                self.counters['errors'] += 1
-                logger.error(f"Ошибка обновления продукта {product_data.get('id')}: {e}")
-                self.session.rollback()
+        Каталог записывается несколькими set-based запросами вместо запросов на
+        каждый продукт:
         
-        try:
-            # Коммитим первый этап
-            self.session.commit()
-        except Exception as e:
-            self.session.rollback()
-            logger.error(f"Ошибка коммита базовых записей: {e}")
-            return False
+        1. Отпечатки всех продуктов БД читаются одним запросом, неизмененные
+           продукты отбрасываются сразу при чтении потока из API.
+        2. Недостающие категории добавляются одной загрузкой.
+        3. Родители и модификаторы проверяются по множеству ID в памяти (БД +
+           каталог), продукты сортируются так, что родитель загружается раньше
+           потомков, и пишутся порциями через COPY + INSERT ... ON CONFLICT.
+        4. Модификаторы измененных продуктов сравниваются с БД, записываются только
+           добавленные, удаленные и переставленные связи.
+        
+        :param products: Итерируемые данные продуктов из API
+        :return: Количество полученных продуктов
+        """
+        stored_hashes = load_hashes(self.session, Product)
+        logger.info(f"В базе данных уже есть {len(stored_hashes)} продуктов")
         
-        # Этап 2: Обновляем связи и модификаторы
-        for product_data in products_batch:
+        now = datetime.utcnow()
+        rows = []
+        modifiers = {}
+        catalogue_ids = set()
+        received = 0
+        
+        for product_data in products:
+            received += 1
             product_id = product_data.get('id')
-            try:
-                # Обновляем связи
-                self._update_product_relations(product_data)
-                
-                # Обновляем модификаторы, если они есть
-                if product_data.get('modifiers'):
-                    self._sync_modifiers(product_id, product_data.get('modifiers', []))
-            except Exception as e:
-                self.counters['errors'] += 1
-                logger.error(f"Ошибка обновления связей/модификаторов продукта {product_id}: {e}")
-                self.session.rollback()
+            if not product_id:
+                self.counters['skipped'] += 1
+                continue
+            catalogue_ids.add(str(product_id).lower())
+            
+            row = self._product_row(product_data, now)
+            if classify(stored_hashes, product_id, row['content_hash']) == UNCHANGED:
+                # Данные продукта не изменились - строку не переписываем
+                self.counters['unchanged'] += 1
+                continue
+            rows.append(row)
+            # Набор модификаторов сверяется у каждого измененного продукта (пустой - удаление прежних)
+            modifiers[product_id] = product_data.get('modifiers') or []
+            
+            if received % 5000 == 0:
+                logger.info(f"Получено {received} продуктов, к записи {len(rows)}")
         
-        try:
-            # Коммитим второй этап
-            self.session.commit()
-            return True
-        except Exception as e:
-            self.session.rollback()
-            logger.error(f"Ошибка коммита связей и модификаторов: {e}")
-            return False
-    
-    def _extract_and_sync_categories(self, products_data):
-        """Извлекает и синхронизирует категории из продуктов"""
-        category_ids = set()
+        if not rows:
+            return received
         
-        for product in products_data:
-            if product.get('taxCategory'):
-                category_ids.add((product['taxCategory'], 'tax'))
-            if product.get('category'):
-                category_ids.add((product['category'], 'product'))
-            if product.get('accountingCategory'):
-                category_ids.add((product['accountingCategory'], 'accounting'))
-        
-        for category_id, category_type in category_ids:
-            if not self.session.query(Category).filter_by(id=category_id).first():
-                category = Category(
-                    id=category_id,
-                    category_type=category_type,
-                    name=f"{category_type}_category_{category_id[:8]}"  # Временное имя
-                )
-                self.session.add(category)
+        # Категории измененных продуктов должны существовать до загрузки продуктов
+        self._ensure_categories(self._product_categories(rows))
+        
+        known_ids = set(stored_hashes) | catalogue_ids
+        ordered = self._order_by_hierarchy(rows, known_ids)
+        modifier_rows = self._modifier_rows(modifiers, known_ids, {row['id']: row for row in rows})
+        
+        with self.session.no_autoflush:
+            loader = BulkLoader(self.session, Product, conflict_columns=['id'], hash_column='content_hash')
+            for start in range(0, len(ordered), self.PRODUCTS_LOAD_CHUNK):
+                loaded = loader.load(ordered[start:start + self.PRODUCTS_LOAD_CHUNK])
+                self.counters['created'] += loaded['inserted']
+                self.counters['updated'] += loaded['updated']
+                self.counters['unchanged'] += loaded['unchanged']
+                logger.info(f"Записано {min(start + self.PRODUCTS_LOAD_CHUNK, len(ordered))} из {len(ordered)} продуктов")
+            
+            self._apply_modifier_diff(list(modifiers), modifier_rows)
         
         self.session.commit()
+        return received
     
-    def _sync_single_product(self, product_data):
-        """Синхронизация одного продукта (метод для обратной совместимости)"""
-        try:
-            product_id = product_data.get('id')
-            
-            # Получаем код и проверяем, что он не пустой
-            code = product_data.get('code')
-            if code == '':
-                code = None  # Convert empty string to NULL for database
-                
-            # Проверяем, существует ли продукт
-            existing_product = self.session.query(Product).filter_by(id=product_id).first()
-            
-            if existing_product:
-                # Обновляем существующий продукт
-                existing_product.deleted = product_data.get('deleted', False)
-                existing_product.name = product_data.get('name', existing_product.name)
-                existing_product.description = product_data.get('description')
-                existing_product.num = product_data.get('num')
-                existing_product.code = code
-                existing_product.parent_id = product_data.get('parent')
-                existing_product.tax_category_id = product_data.get('taxCategory')
-                existing_product.category_id = product_data.get('category')
-                existing_product.accounting_category_id = product_data.get('accountingCategory')
-                existing_product.updated_at = datetime.utcnow()
-                existing_product.synced_at = datetime.utcnow()
-                self.counters['updated'] += 1
-            else:
-                # Создаем новый продукт
-                product = Product(
-                    id=product_id,
-                    deleted=product_data.get('deleted', False),
-                    name=product_data.get('name', ''),
-                    description=product_data.get('description'),
-                    num=product_data.get('num'),
-                    code=code,
-                    parent_id=product_data.get('parent'),
-                    tax_category_id=product_data.get('taxCategory'),
-                    category_id=product_data.get('category'),
-                    accounting_category_id=product_data.get('accountingCategory'),
-                    synced_at=datetime.utcnow()
-                )
-                self.session.add(product)
-                self.counters['created'] += 1
-            
-            # Синхронизируем модификаторы, если они есть
-            if product_data.get('modifiers'):
-                self._sync_modifiers(product_id, product_data.get('modifiers', []))
-                
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка при синхронизации продукта {product_data.get('id')}: {e}")
-            self.counters['errors'] += 1
-            self.session.rollback()
-            raise
+    @classmethod
+    def _product_row(cls, product_data, now):
+        """Колонки строки products из данных API"""
+        return {
+            'id': product_data.get('id'),
+            'deleted': bool(product_data.get('deleted', False)),
+            'name': product_data.get('name') or '',
+            'description': product_data.get('description'),
+            'num': product_data.get('num'),
+            'code': product_data.get('code') or None,  # Пустой код хранится как NULL
+            'parent_id': product_data.get('parent'),
+            'tax_category_id': product_data.get('taxCategory'),
+            'category_id': product_data.get('category'),
+            'accounting_category_id': product_data.get('accountingCategory'),
+            'content_hash': cls._product_hash(product_data),
+            'created_at': now,
+            'updated_at': now,
+            'synced_at': now
+        }
     
-    def _update_product_basic_by_id(self, product_id, product_data):
-        """Обновление базовой информации о продукте по ID (без родительских ссылок)"""
-        try:
-            # Получаем продукт по ID
-            existing_product = self.session.query(Product).filter_by(id=product_id).first()
-            
-            if not existing_product:
-                logger.warning(f"Продукт с ID {product_id} не найден в базе для обновления")
-                self.counters['skipped'] += 1
-                return False
-                
-            # Получаем код и проверяем, что он не пустой
-            code = product_data.get('code')
-            if code == '':
-                code = None  # Convert empty string to NULL for database
-            
-            # Обновляем базовую информацию
-            existing_product.deleted = product_data.get('deleted', False)
-            existing_product.name = product_data.get('name', existing_product.name)
-            existing_product.description = product_data.get('description')
-            existing_product.num = product_data.get('num')
-            existing_product.code = code
-            existing_product.updated_at = datetime.utcnow()
-            existing_product.synced_at = datetime.utcnow()
-            
-            self.counters['updated'] += 1
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении продукта {product_id}: {e}")
-            self.session.rollback()
-            raise
+    @staticmethod
+    def _order_by_hierarchy(rows, known_ids, parent_column='parent_id', table='products'):
+        """Строки справочника в порядке иерархии: родитель раньше потомков
         
-    def _create_product_basic(self, product_data):
-        """Создание базовой информации о продукте (без родительских ссылок)"""
-        try:
-            product_id = product_data.get('id')
-            
-            # Получаем код и проверяем, что он не пустой
-            code = product_data.get('code')
-            if code == '':
-                code = None  # Convert empty string to NULL for database
-            
-            # Разрешаем продукты с дублирующимися кодами (уникальность по ID)
-            
-            # Создаем новый продукт с базовой информацией, без родительских ссылок
-            product = Product(
-                id=product_id,
-                deleted=product_data.get('deleted', False),
-                name=product_data.get('name', ''),
-                description=product_data.get('description'),
-                num=product_data.get('num'),
-                code=code,
-                synced_at=datetime.utcnow()
-            )
-            self.session.add(product)
-            self.counters['created'] += 1
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка при создании продукта {product_data.get('id')}: {e}")
-            self.session.rollback()
-            raise
-    
-    def _update_product_relations(self, product_data):
-        """Обновление связей продукта (родительские и категории)"""
-        try:
-            product_id = product_data.get('id')
-            product = self.session.query(Product).filter_by(id=product_id).first()
-            
-            if not product:
-                logger.warning(f"Продукт {product_id} не найден для обновления связей")
-                return
-            
-            # Проверяем существование родительского продукта
-            parent_id = product_data.get('parent')
-            if parent_id:
-                parent_exists = self.session.query(Product).filter_by(id=parent_id).first() is not None
-                if not parent_exists:
-                    logger.warning(f"Родительский продукт {parent_id} для продукта {product_id} не найден. Пропускаем установку связи.")
-                    parent_id = None  # Обнуляем parent_id, если родитель не существует
-            
-            # Обновляем родительские и категорийные ссылки
-            product.parent_id = parent_id
-            product.tax_category_id = product_data.get('taxCategory')
-            product.category_id = product_data.get('category')
-            product.accounting_category_id = product_data.get('accountingCategory')
-            product.updated_at = datetime.utcnow()
-            product.synced_at = datetime.utcnow()
-            
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении связей продукта {product_data.get('id')}: {e}")
-            self.session.rollback()
-            raise
+        Ссылка на родителя, которого нет ни в БД, ни в загружаемом справочнике, обнуляется,
+        а отпечаток не сохраняется, чтобы связь установилась при следующей синхронизации.
+        Записи из циклических ссылок загружаются без родителя.
+        
+        :param known_ids: ID (в нижнем регистре), на которые можно ссылаться
+        :param parent_column: Колонка ссылки на родителя
+        :param table: Таблица (для сообщений в логе)
+        """
+        by_id = {str(row['id']).lower(): row for row in rows}
+        children = {}
+        queue = deque()
+        for key, row in by_id.items():
+            parent_key = str(row[parent_column]).lower() if row[parent_column] else None
+            if parent_key and parent_key not in known_ids:
+                logger.warning(f"Родитель {row[parent_column]} записи {row['id']} ({table}) не найден. "
+                               f"Пропускаем установку связи.")
+                row[parent_column] = None
+                row['content_hash'] = None
+                parent_key = None
+            if parent_key in by_id and parent_key != key:
+                children.setdefault(parent_key, []).append(row)
+            else:
+                queue.append(row)
+        
+        ordered = []
+        while queue:
+            row = queue.popleft()
+            ordered.append(row)
+            queue.extend(children.pop(str(row['id']).lower(), []))
         
-    def _create_product(self, product_data):
-        """Устаревший метод создания продукта (для обратной совместимости)"""
-        self._create_product_basic(product_data)
-        self._update_product_relations(product_data)
+        for cycle_rows in children.values():
+            for row in cycle_rows:
+                logger.warning(f"Циклическая ссылка на родителя у записи {row['id']} ({table}), связь не устанавливается")
+                row[parent_column] = None
+                row['content_hash'] = None
+                ordered.append(row)
+        return ordered
     
-    def _update_product(self, product, product_data):
-        """Устаревший метод обновления продукта (для обратной совместимости)"""
-        product.deleted = product_data.get('deleted', False)
-        product.name = product_data.get('name', product.name)
-        product.description = product_data.get('description')
-        product.num = product_data.get('num')
-        product.code = product_data.get('code')
-        product.parent_id = product_data.get('parent')
-        product.tax_category_id = product_data.get('taxCategory')
-        product.category_id = product_data.get('category')
-        product.accounting_category_id = product_data.get('accountingCategory')
-        product.updated_at = datetime.utcnow()
-        product.synced_at = datetime.utcnow()
+    @staticmethod
+    def _product_categories(products_data):
+        """Пары (ID категории, тип) из данных продуктов API или строк products"""
+        category_ids = set()
+        for product in products_data:
+            for api_key, column, category_type in (('taxCategory', 'tax_category_id', 'tax'),
+                                                   ('category', 'category_id', 'product'),
+                                                   ('accountingCategory', 'accounting_category_id', 'accounting')):
+                category_id = product.get(api_key) or product.get(column)
+                if category_id:
+                    category_ids.add((str(category_id), category_type))
+        return category_ids
     
-    def _sync_modifiers(self, product_id, modifiers_data):
-        """Синхронизация модификаторов продукта"""
-        try:
-            # Удаляем старые связи
-            self.session.query(ProductModifier).filter_by(product_id=product_id).delete()
-            
-            # Добавляем новые
+    def _ensure_categories(self, category_ids):
+        """Добавление недостающих категорий одной загрузкой (без фиксации)"""
+        existing = {str(category_id).lower() for (category_id,) in self.session.query(Category.id)}
+        now = datetime.utcnow()
+        rows = [{
+            'id': category_id,
+            'category_type': category_type,
+            'name': f"{category_type}_category_{category_id[:8]}",  # Временное имя
+            'deleted': False,
+            'created_at': now,
+            'updated_at': now
+        } for category_id, category_type in category_ids if category_id.lower() not in existing]
+        if rows:
+            BulkLoader(self.session, Category, conflict_columns=['id'], update_columns=[]).load(rows)
+            logger.info(f"Добавлено категорий: {len(rows)}")
+    
+    @staticmethod
+    def _modifier_id(modifier_data):
+        """ID модификатора из элемента списка modifiers продукта (None - неизвестный формат)"""
+        # Проверяем формат данных модификатора
+        if isinstance(modifier_data, dict) and 'modifier' in modifier_data:
+            # Формат: {'modifier': 'id', ...другие данные...}
+            return modifier_data['modifier']
+        if isinstance(modifier_data, dict):
+            # Неизвестный формат словаря
+            logger.warning(f"Пропуск модификатора в неизвестном формате: {modifier_data}")
+            return None
+        # Простой формат: строка с ID модификатора
+        return modifier_data
+    
+    def _modifier_rows(self, modifiers, known_ids, rows_by_id):
+        """Строки product_modifiers для загрузки; ссылки на неизвестные продукты отбрасываются
+        
+        :param modifiers: {ID продукта: список модификаторов из API}
+        :param rows_by_id: Строки продуктов к записи (у продукта с отброшенным модификатором
+            отпечаток не сохраняется, чтобы модификатор добавился при следующей синхронизации)
+        """
+        modifier_rows = []
+        for product_id, modifiers_data in modifiers.items():
             for position, modifier_data in enumerate(modifiers_data):
-                # Проверяем формат данных модификатора
-                if isinstance(modifier_data, dict) and 'modifier' in modifier_data:
-                    # Формат: {'modifier': 'id', ...другие данные...}
-                    modifier_id = modifier_data['modifier']
-                elif isinstance(modifier_data, dict):
-                    # Неизвестный формат словаря
-                    logger.warning(f"Пропуск модификатора в неизвестном формате: {modifier_data}")
+                modifier_id = self._modifier_id(modifier_data)
+                if not modifier_id:
                     continue
-                else:
-                    # Простой формат: строка с ID модификатора
-                    modifier_id = modifier_data
-                
-                # Создаем связь
-                product_modifier = ProductModifier(
-                    product_id=product_id,
-                    modifier_id=modifier_id,
-                    position=position
-                )
-                self.session.add(product_modifier)
-                
-        except Exception as e:
-            logger.error(f"Ошибка при синхронизации модификаторов для продукта {product_id}: {e}")
-            self.session.rollback()
-            raise
+                if str(modifier_id).lower() not in known_ids:
+                    logger.warning(f"Модификатор {modifier_id} продукта {product_id} не найден, пропускаем")
+                    if product_id in rows_by_id:
+                        rows_by_id[product_id]['content_hash'] = None
+                    continue
+                modifier_rows.append({'product_id': product_id, 'modifier_id': modifier_id, 'position': position})
+        return modifier_rows
+    
+    def _apply_modifier_diff(self, product_ids, modifier_rows):
+        """Приведение модификаторов продуктов к новым наборам с записью только отличий
+        
+        Текущие связи продуктов читаются одним запросом на порцию, удаленные связи
+        удаляются одним DELETE, добавленные и переставленные записываются одной загрузкой.
+        
+        :param product_ids: Продукты, наборы модификаторов которых сверяются
+        :param modifier_rows: Новые связи {'product_id', 'modifier_id', 'position'} этих продуктов
+        :return: Счетчики {'added', 'removed', 'reordered', 'unchanged'}
+        """
+        desired = {}
+        for row in modifier_rows:
+            desired[(str(row['product_id']).lower(), str(row['modifier_id']).lower())] = row
+        
+        existing = {}
+        for start in range(0, len(product_ids), self.PRODUCTS_LOAD_CHUNK):
+            chunk = product_ids[start:start + self.PRODUCTS_LOAD_CHUNK]
+            query = self.session.query(
+                ProductModifier.id, ProductModifier.product_id, ProductModifier.modifier_id, ProductModifier.position
+            ).filter(ProductModifier.product_id.in_(chunk))
+            for link_id, product_id, modifier_id, position in query:
+                existing[(str(product_id).lower(), str(modifier_id).lower())] = (link_id, position)
+        
+        removed = [link_id for key, (link_id, _) in existing.items() if key not in desired]
+        added = [row for key, row in desired.items() if key not in existing]
+        reordered = [row for key, row in desired.items() if key in existing and existing[key][1] != row['position']]
+        
+        for start in range(0, len(removed), self.PRODUCTS_LOAD_CHUNK):
+            self.session.query(ProductModifier).filter(
+                ProductModifier.id.in_(removed[start:start + self.PRODUCTS_LOAD_CHUNK])
+            ).delete(synchronize_session=False)
+        if added or reordered:
+            BulkLoader(self.session, ProductModifier, conflict_columns=['product_id', 'modifier_id'],
+                       update_columns=['position']).load(added + reordered)
+        
+        counts = {
+            'added': len(added),
+            'removed': len(removed),
+            'reordered': len(reordered),
+            'unchanged': len(desired) - len(added) - len(reordered)
+        }
+        total = self.counters.setdefault('modifiers', {key: 0 for key in counts})
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+        return counts
     
     def sync_accounts(self):
-        """Синхронизация счетов из API в БД с учетом иерархии"""
+        """Синхронизация счетов из API в БД массовым upsert с учетом иерархии
+        
+        План счетов сортируется в памяти (родитель раньше потомков) и записывается
+        одной загрузкой COPY + INSERT ... ON CONFLICT в одной транзакции. ID новых и
+        измененных счетов сохраняются в sync_state (entity_type='accounts'), чтобы
+        зависящие от счетов отчеты (списания по статьям) пересчитывали только их.
+        """
         try:
             logger.info("Начинаем синхронизацию счетов...")
-            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0}
+            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0, 'unchanged': 0}
             
             # Получаем данные из API
             accounts_data = self.api_client.get_accounts()
             logger.info(f"Получено {len(accounts_data)} счетов из API")
             
-            # Получаем список уже имеющихся id счетов в БД для оптимизации
-            existing_account_ids = set()
-            try:
-                for row in self.session.query(Account.id).all():
-                    existing_account_ids.add(str(row[0]))
-                logger.info(f"В базе данных уже есть {len(existing_account_ids)} счетов")
-            except Exception as e:
-                logger.error(f"Ошибка при получении существующих ID счетов: {e}")
-                existing_account_ids = set()
-            
-            # Сортируем счета для правильного порядка создания (сначала родительские)
-            # Создаем словарь для быстрого поиска
-            accounts_dict = {acc['id']: acc for acc in accounts_data}
-            
-            # Определяем порядок обработки (сначала корневые счета, потом дочерние)
-            processed_accounts = set()
-            accounts_to_process = []
-            
-            def add_account_hierarchy(account_data):
-                if account_data['id'] in processed_accounts:
-                    return
+            # Отпечатки и коды имеющихся счетов - одним запросом
+            stored_hashes = {}
+            code_owners = {}
+            for account_id, code, stored_hash in self.session.query(Account.id, Account.code, Account.content_hash):
+                stored_hashes[str(account_id).lower()] = stored_hash
+                if code:
+                    code_owners[code] = str(account_id).lower()
+            logger.info(f"В базе данных уже есть {len(stored_hashes)} счетов")
+            
+            rows = self._account_rows(accounts_data, stored_hashes, code_owners)
+            changed_ids = [str(row['id']) for row in rows]
+            
+            if rows:
+                known_ids = set(stored_hashes) | {str(row['id']).lower() for row in rows}
+                ordered = self._order_by_hierarchy(rows, known_ids, parent_column='account_parent_id', table='accounts')
+                logger.info(f"Запись {len(ordered)} новых и измененных счетов в иерархическом порядке...")
                 
-                parent_id = account_data.get('accountParentId')
-                if parent_id and parent_id in accounts_dict and parent_id not in processed_accounts:
-                    # Сначала обрабатываем родительский счет
-                    add_account_hierarchy(accounts_dict[parent_id])
+                with self.session.no_autoflush:
+                    loaded = BulkLoader(self.session, Account, conflict_columns=['id'],
+                                        hash_column='content_hash').load(ordered)
+                self.counters['created'] += loaded['inserted']
+                self.counters['updated'] += loaded['updated']
+                self.counters['unchanged'] += loaded['unchanged']
                 
-                accounts_to_process.append(account_data)
-                processed_accounts.add(account_data['id'])
-            
-            # Добавляем все счета в правильном порядке
-            for account_data in accounts_data:
-                add_account_hierarchy(account_data)
-            
-            logger.info(f"Обработка {len(accounts_to_process)} счетов в иерархическом порядке...")
-            
-            # Процесс обработки каждого счета из API в правильном порядке
-            for account_data in accounts_to_process:
-                try:
-                    account_id = account_data.get('id')
-                    
-                    # Обрабатываем код - преобразуем пустую строку в NULL
-                    code = account_data.get('code')
-                    if code == '':
-                        code = None
-                    
-                    # Проверяем, существует ли счет
-                    existing_account = self.session.query(Account).filter_by(id=account_id).first()
-                    
-                    if existing_account:
-                        # Обновляем существующий счет
-                        existing_account.deleted = account_data.get('deleted', False)
-                        existing_account.code = code
-                        existing_account.name = account_data.get('name', existing_account.name)
-                        existing_account.account_parent_id = account_data.get('accountParentId')
-                        existing_account.parent_corporate_id = account_data.get('parentCorporateId')
-                        existing_account.type = account_data.get('type')
-                        existing_account.system = account_data.get('system', False)
-                        existing_account.custom_transactions_allowed = account_data.get('customTransactionsAllowed', True)
-                        existing_account.updated_at = datetime.utcnow()
-                        existing_account.synced_at = datetime.utcnow()
-                        self.counters['updated'] += 1
-                    else:
-                        # Создаем новый счет
-                        account = Account(
-                            id=account_id,
-                            deleted=account_data.get('deleted', False),
-                            code=code,
-                            name=account_data.get('name', ''),
-                            account_parent_id=account_data.get('accountParentId'),
-                            parent_corporate_id=account_data.get('parentCorporateId'),
-                            type=account_data.get('type'),
-                            system=account_data.get('system', False),
-                            custom_transactions_allowed=account_data.get('customTransactionsAllowed', True),
-                            synced_at=datetime.utcnow()
-                        )
-                        self.session.add(account)
-                        self.counters['created'] += 1
-                    
-                    # Коммитим каждую запись для предотвращения конфликтов
-                    self.session.commit()
-                        
-                except Exception as e:
-                    self.counters['errors'] += 1
-                    logger.error(f"Ошибка при синхронизации счета {account_data.get('id')}: {e}")
-                    self.session.rollback()
+                save_sync_state(self.session, 'accounts', details={
+                    'changed_ids': changed_ids,
+                    'changed_at': datetime.utcnow().isoformat()
+                })
             
             # Записываем в лог
             sync_log = SyncLog(
@@ -572,7 +447,9 @@ class DataSynchronizer:
                     'created': self.counters['created'],
                     'updated': self.counters['updated'],
                     'errors': self.counters['errors'],
-                    'skipped': self.counters['skipped']
+                    'skipped': self.counters['skipped'],
+                    'diff': self._diff(),
+                    'changed_ids': changed_ids
                 }
             )
             self.session.add(sync_log)
@@ -580,6 +457,7 @@ class DataSynchronizer:
             
             logger.info(f"Синхронизация счетов завершена. Создано: {self.counters['created']}, "
                        f"Обновлено: {self.counters['updated']}, "
+                       f"Без изменений: {self.counters['unchanged']}, "
                        f"Пропущено: {self.counters['skipped']}, "
                        f"Ошибок: {self.counters['errors']}")
             return True
@@ -604,154 +482,239 @@ class DataSynchronizer:
             logger.error(f"Ошибка синхронизации счетов: {e}")
             return False
     
-    def sync_writeoff_documents(self, date_from=None, date_to=None):
-        """Синхронизация документов списания из API в БД"""
+    def _account_rows(self, accounts_data, stored_hashes, code_owners):
+        """Строки новых и измененных счетов
+        
+        Код счета уникален: счет с кодом, уже занятым другим счетом (в ответе API
+        или в БД), не записывается и считается ошибкой, как при построчной вставке.
+        
+        :param code_owners: {код: ID счета в БД}; дополняется счетами из API
+        """
+        api_ids = {str(account_data.get('id')).lower() for account_data in accounts_data}
+        # Коды счетов, которые есть в ответе API, переходят к счетам из ответа
+        code_owners = {code: owner for code, owner in code_owners.items() if owner not in api_ids}
+        
+        now = datetime.utcnow()
+        rows = []
+        for account_data in accounts_data:
+            account_id = account_data.get('id')
+            if not account_id:
+                self.counters['skipped'] += 1
+                continue
+            key = str(account_id).lower()
+            
+            # Обрабатываем код - преобразуем пустую строку в NULL
+            code = account_data.get('code') or None
+            if code:
+                owner = code_owners.setdefault(code, key)
+                if owner != key:
+                    logger.error(f"Код {code} счета {account_id} уже занят счетом {owner}, пропускаем")
+                    self.counters['errors'] += 1
+                    continue
+            
+            account_hash = content_hash(account_data, ACCOUNT_HASH_COLUMNS)
+            if classify(stored_hashes, account_id, account_hash) == UNCHANGED:
+                # Неизмененный счет не переписываем
+                self.counters['unchanged'] += 1
+                continue
+            
+            rows.append({
+                'id': account_id,
+                'deleted': bool(account_data.get('deleted', False)),
+                'code': code,
+                'name': account_data.get('name') or '',
+                'account_parent_id': account_data.get('accountParentId'),
+                'parent_corporate_id': account_data.get('parentCorporateId'),
+                'type': account_data.get('type'),
+                'system': bool(account_data.get('system', False)),
+                'custom_transactions_allowed': bool(account_data.get('customTransactionsAllowed', True)),
+                'content_hash': account_hash,
+                'created_at': now,
+                'updated_at': now,
+                'synced_at': now
+            })
+        return rows
+    
+    def sync_writeoff_documents(self, date_from=None, date_to=None, resume=False):
+        """Синхронизация документов списания за период
+        
+        Период запрашивается у API окнами по WRITEOFF_SYNC_WINDOW_DAYS дней, состояние
+        окон хранится в sync_checkpoints под идентификатором writeoffs:<начало>:<конец>.
+        Загрузка останавливается на первом окне с ошибками; повторный запуск с
+        resume=True продолжает с первого незавершенного окна.
+        
+        :param date_from: Начальная дата (YYYY-MM-DD, по умолчанию вчера)
+        :param date_to: Конечная дата включительно (YYYY-MM-DD, по умолчанию сегодня)
+        :param resume: Продолжить прерванную загрузку того же периода
+        :return: True, если все окна загружены
+        """
+        today = datetime.now().date()
+        range_start = self._parse_writeoff_date(date_from) or today - timedelta(days=1)
+        range_end = (self._parse_writeoff_date(date_to) or today) + timedelta(days=1)
+        if range_end <= range_start:
+            range_end = range_start + timedelta(days=1)
+        
+        job_id = f"writeoffs:{range_start.isoformat()}:{range_end.isoformat()}"
+        return self._sync_writeoff_windows('range', self._writeoff_windows(range_start, range_end),
+                                           job_id=job_id, resume=resume)
+    
+    def sync_writeoff_documents_incremental(self, correction_hours=None):
+        """Инкрементальная синхронизация документов списания по водяному знаку
+        
+        API не фильтрует списания по складу и возвращает документы всех складов,
+        поэтому хранится один водяной знак - момент, до которого загружены документы
+        (sync_state, entity_type='writeoff_documents', scope=''), и дата последнего
+        загруженного документа (details.last_date_incoming). Запрашивается период от
+        водяного знака минус окно исправлений до сегодняшнего дня, первая загрузка -
+        за WRITEOFF_SYNC_INITIAL_DAYS дней. Водяной знак сохраняется после каждого
+        успешного окна, так что прерванный запуск продолжается со следующего.
+        Неизмененные документы пропускаются по отпечаткам, поэтому частый запуск
+        (раз в несколько минут) почти не пишет в БД.
+        
+        :param correction_hours: Окно исправлений в часах (по умолчанию WRITEOFF_SYNC_CORRECTION_HOURS)
+        :return: True, если все окна загружены
+        """
+        correction = timedelta(hours=WRITEOFF_SYNC_CORRECTION_HOURS if correction_hours is None
+                               else correction_hours)
+        return self._sync_writeoff_windows('incremental', correction=correction)
+    
+    @staticmethod
+    def _parse_writeoff_date(value):
+        if not value:
+            return None
+        # Дата может прийти с временем ("2025-05-19 00:00:00" или "2025-05-19T00:00")
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+    
+    @staticmethod
+    def _writeoff_windows(range_start, range_end):
+        """Окна запроса документов списания (начало включительно, конец не включается)"""
+        windows = []
+        window_start = range_start
+        while window_start < range_end:
+            window_end = min(window_start + timedelta(days=WRITEOFF_SYNC_WINDOW_DAYS), range_end)
+            windows.append((window_start, window_end))
+            window_start = window_end
+        return windows
+    
+    def _plan_writeoff_windows(self, correction, started_at):
+        """Окна инкрементальной загрузки от водяного знака минус окно исправлений"""
+        state = get_sync_state(self.session, WRITEOFF_STATE_ENTITY)
+        if state is not None and state.watermark:
+            range_start = (state.watermark - correction).date()
+        else:
+            range_start = (started_at - timedelta(days=WRITEOFF_SYNC_INITIAL_DAYS)).date()
+        return self._writeoff_windows(range_start, started_at.date() + timedelta(days=1))
+    
+    def _sync_writeoff_windows(self, mode, windows=None, job_id=None, resume=False, correction=None):
+        """Загрузка документов списания по окнам с записью результата в SyncLog
+        
+        :param mode: incremental - окна от водяного знака, range - заданные окна
+        :param windows: Окна периода (для range)
+        :param job_id: Идентификатор загрузки для чекпоинтов окон (для range)
+        """
+        started_at = datetime.now()
         try:
-            logger.info("Начинаем синхронизацию документов списания...")
-            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'items_created': 0, 'items_updated': 0, 'skipped': 0}
+            logger.info(f"Начинаем синхронизацию документов списания (режим {mode})...")
+            self.counters = {'created': 0, 'updated': 0, 'errors': 0, 'items_created': 0, 'items_updated': 0,
+                             'items_deleted': 0, 'skipped': 0, 'unchanged': 0}
+            self._writeoff_last_date = None
             
-            # Получаем данные из API
-            documents_data = self.api_client.get_writeoff_documents(date_from, date_to)
-            logger.info(f"Получено {len(documents_data)} документов списания из API")
+            self.references.refresh_if_changed(self.session, ['products', 'stores'])
+            references_before = self.references.stats()
             
-            # Получаем список уже имеющихся id документов в БД
-            existing_document_ids = set()
-            try:
-                for row in self.session.query(WriteoffDocument.id).all():
-                    existing_document_ids.add(str(row[0]))
-                logger.info(f"В базе данных уже есть {len(existing_document_ids)} документов списания")
-            except Exception as e:
-                logger.error(f"Ошибка при получении существующих ID документов: {e}")
-                existing_document_ids = set()
-            
-            # Обрабатываем каждый документ
-            for doc_data in documents_data:
-                try:
-                    document_id = doc_data.get('id')
-                    
-                    # Проверяем, существует ли документ
-                    existing_document = self.session.query(WriteoffDocument).filter_by(id=document_id).first()
-                    
-                    # Парсим дату
-                    date_incoming_str = doc_data.get('dateIncoming')
-                    date_incoming = None
-                    if date_incoming_str:
-                        try:
-                            # Формат: "2025-02-20T23:00"
-                            date_incoming = datetime.strptime(date_incoming_str, '%Y-%m-%dT%H:%M')
-                        except ValueError:
-                            logger.warning(f"Не удалось разобрать дату {date_incoming_str} для документа {document_id}")
-                            date_incoming = datetime.utcnow()
-                    
-                    # Парсим статус
-                    status_str = doc_data.get('status')
-                    try:
-                        status = WriteoffDocumentStatus(status_str) if status_str else WriteoffDocumentStatus.NEW
-                    except ValueError:
-                        logger.warning(f"Неизвестный статус документа: {status_str}, используем NEW")
-                        status = WriteoffDocumentStatus.NEW
-                    
-                    if existing_document:
-                        # Обновляем существующий документ
-                        existing_document.date_incoming = date_incoming
-                        existing_document.document_number = doc_data.get('documentNumber')
-                        existing_document.status = status
-                        existing_document.conception_id = doc_data.get('conceptionId')
-                        existing_document.comment = doc_data.get('comment')
-                        existing_document.store_id = doc_data.get('storeId')
-                        existing_document.account_id = doc_data.get('accountId')
-                        existing_document.updated_at = datetime.utcnow()
-                        existing_document.synced_at = datetime.utcnow()
-                        self.counters['updated'] += 1
-                        
-                        # Удаляем старые позиции и создаем новые
-                        self.session.query(WriteoffItem).filter_by(document_id=document_id).delete()
-                        
-                    else:
-                        # Создаем новый документ
-                        document = WriteoffDocument(
-                            id=document_id,
-                            date_incoming=date_incoming,
-                            document_number=doc_data.get('documentNumber'),
-                            status=status,
-                            conception_id=doc_data.get('conceptionId'),
-                            comment=doc_data.get('comment'),
-                            store_id=doc_data.get('storeId'),
-                            account_id=doc_data.get('accountId'),
-                            synced_at=datetime.utcnow()
-                        )
-                        self.session.add(document)
-                        self.counters['created'] += 1
-                    
-                    # Синхронизируем позиции документа
-                    items_data = doc_data.get('items', [])
-                    for item_data in items_data:
-                        try:
-                            product_id = item_data.get('productId')
-                            
-                            # Проверяем существование товара
-                            if product_id:
-                                product_exists = self.session.query(Product).filter_by(id=product_id).first() is not None
-                                if not product_exists:
-                                    logger.warning(f"Товар {product_id} не найден в БД, пропускаем позицию {item_data.get('num')} документа {document_id}")
-                                    self.counters['skipped'] += 1
-                                    continue
-                            
-                            item = WriteoffItem(
-                                document_id=document_id,
-                                num=item_data.get('num'),
-                                product_id=product_id,
-                                product_size_id=item_data.get('productSizeId'),
-                                amount_factor=item_data.get('amountFactor', 1),
-                                amount=item_data.get('amount'),
-                                measure_unit_id=item_data.get('measureUnitId'),
-                                container_id=item_data.get('containerId'),
-                                cost=item_data.get('cost')
-                            )
-                            self.session.add(item)
-                            if existing_document:
-                                self.counters['items_updated'] += 1
-                            else:
-                                self.counters['items_created'] += 1
-                                
-                        except Exception as e:
-                            logger.error(f"Ошибка при создании позиции документа {document_id}: {e}")
-                            self.counters['errors'] += 1
-                            continue
-                    
-                    # Коммитим документ с позициями
+            checkpoints = None
+            if mode == 'incremental':
+                windows = self._plan_writeoff_windows(correction, started_at)
+            else:
+                checkpoints = plan_checkpoints(self.session, job_id, WRITEOFF_STATE_ENTITY, windows, resume=resume)
+                self.session.commit()
+            
+            documents_count = 0
+            pipeline_stats = None
+            windows_done = 0
+            for index, (window_start, window_end) in enumerate(windows):
+                checkpoint = checkpoints[index] if checkpoints else None
+                if checkpoint is not None:
+                    if checkpoint.status == 'done':
+                        logger.info(f"Окно {window_start} - {window_end} уже загружено, пропускаем")
+                        windows_done += 1
+                        continue
+                    mark_checkpoint(checkpoint, 'running')
                     self.session.commit()
-                    
+                
+                errors_before = self.counters['errors']
+                try:
+                    count, stats = self._sync_writeoff_window(window_start, window_end)
                 except Exception as e:
-                    self.counters['errors'] += 1
-                    logger.error(f"Ошибка при синхронизации документа {doc_data.get('id')}: {e}")
                     self.session.rollback()
+                    if checkpoint is not None:
+                        mark_checkpoint(checkpoint, 'failed', error_message=str(e))
+                        self.session.commit()
+                    raise
+                documents_count += count
+                pipeline_stats = merge_stats(pipeline_stats, stats)
+                
+                failed = self.counters['errors'] - errors_before
+                if failed:
+                    # Водяной знак не сдвигается за окно с ошибками: следующий запуск повторит его
+                    logger.warning(f"Окно {window_start} - {window_end}: ошибок записи {failed}, "
+                                   f"следующие окна не загружаются")
+                    if checkpoint is not None:
+                        mark_checkpoint(checkpoint, 'failed', rows_count=count,
+                                        error_message=f"Не записано документов: {failed}")
+                        self.session.commit()
+                    break
+                
+                if checkpoint is not None:
+                    mark_checkpoint(checkpoint, 'done', rows_count=count)
+                if mode == 'incremental':
+                    synced_through = min(datetime.combine(window_end, datetime.min.time()), started_at)
+                    self._save_writeoff_watermark(synced_through)
+                self.session.commit()
+                windows_done += 1
+            
+            logger.info(f"Получено {documents_count} документов списания из API")
+            
+            details = {
+                'mode': mode,
+                'created': self.counters['created'],
+                'updated': self.counters['updated'],
+                'errors': self.counters['errors'],
+                'items_created': self.counters['items_created'],
+                'items_updated': self.counters['items_updated'],
+                'items_deleted': self.counters['items_deleted'],
+                'skipped': self.counters['skipped'],
+                'diff': self._diff(),
+                'references': self.references.stats(since=references_before),
+                'pipeline': pipeline_stats,
+                'date_from': windows[0][0].isoformat() if windows else None,
+                'date_to': (windows[-1][1] - timedelta(days=1)).isoformat() if windows else None,
+                'windows': {'total': len(windows), 'done': windows_done}
+            }
+            if job_id:
+                details['job_id'] = job_id
+            if mode == 'incremental' and self._writeoff_last_date:
+                details['last_date_incoming'] = self._writeoff_last_date.isoformat()
             
             # Записываем в лог
             sync_log = SyncLog(
                 entity_type='writeoff_documents',
-                records_count=len(documents_data),
+                records_count=documents_count,
                 status='success',
                 sync_date=datetime.utcnow(),
-                details={
-                    'created': self.counters['created'],
-                    'updated': self.counters['updated'],
-                    'errors': self.counters['errors'],
-                    'items_created': self.counters['items_created'],
-                    'items_updated': self.counters['items_updated'],
-                    'skipped': self.counters['skipped'],
-                    'date_from': date_from,
-                    'date_to': date_to
-                }
+                details=details
             )
             self.session.add(sync_log)
             self.session.commit()
             
             logger.info(f"Синхронизация документов списания завершена. "
+                       f"Окон: {windows_done} из {len(windows)}, "
                        f"Документов - Создано: {self.counters['created']}, Обновлено: {self.counters['updated']}, "
+                       f"Без изменений: {self.counters['unchanged']}, "
                        f"Позиций - Создано: {self.counters['items_created']}, Обновлено: {self.counters['items_updated']}, "
+                       f"Удалено: {self.counters['items_deleted']}, "
                        f"Пропущено: {self.counters['skipped']}, Ошибок: {self.counters['errors']}")
-            return True
+            return windows_done == len(windows)
             
         except Exception as e:
             self.session.rollback()
@@ -772,6 +735,230 @@ class DataSynchronizer:
             
             logger.error(f"Ошибка синхронизации документов списания: {e}")
             return False
+    
+    def _sync_writeoff_window(self, window_start, window_end):
+        """Загрузка окна документов списания конвейером (src/pipeline.py)
+        
+        Загрузка документов из API, их разбор и запись в БД идут одновременно:
+        порция документов записывается set-based запросами, пока следующие еще загружаются.
+        
+        :return: (документов из API, статистика конвейера)
+        """
+        # Ошибки разбора считаются в потоке стадии отдельно от счетчиков записи
+        parse_errors = []
+        
+        def normalize(documents):
+            for doc_data in documents:
+                try:
+                    yield self._normalize_writeoff_document(doc_data)
+                except Exception as e:
+                    parse_errors.append(doc_data.get('id'))
+                    logger.error(f"Ошибка разбора документа списания {doc_data.get('id')}: {e}")
+        
+        # dateTo в API включается в период
+        date_from = window_start.strftime('%Y-%m-%d')
+        date_to = (window_end - timedelta(days=1)).strftime('%Y-%m-%d')
+        pipeline = (Pipeline('writeoffs')
+                    .add_stage('normalize', normalize)
+                    .add_stage('batch', lambda documents: chunked(documents, self.WRITEOFF_BATCH_SIZE)))
+        pipeline_stats = pipeline.run(self.api_client.iter_writeoff_documents(date_from, date_to),
+                                      self._write_writeoff_batch)
+        self.counters['errors'] += len(parse_errors)
+        return pipeline_stats['fetch']['items'], pipeline_stats
+    
+    def _save_writeoff_watermark(self, synced_through):
+        """Сдвиг водяного знака после успешного окна (фиксация - на вызывающей стороне)
+        
+        API возвращает документы всех складов, поэтому после окна без ошибок все
+        документы загружены до его конца. Водяной знак только растет.
+        """
+        state = get_sync_state(self.session, WRITEOFF_STATE_ENTITY)
+        watermark = synced_through
+        details = {}
+        if state is not None:
+            if state.watermark and state.watermark > watermark:
+                watermark = state.watermark
+            details = dict(state.details or {})
+        
+        last_date = self._writeoff_last_date
+        stored_date = details.get('last_date_incoming')
+        if last_date and (not stored_date or datetime.fromisoformat(stored_date) < last_date):
+            details['last_date_incoming'] = last_date.isoformat()
+        save_sync_state(self.session, WRITEOFF_STATE_ENTITY, watermark=watermark, details=details)
+    
+    @staticmethod
+    def _normalize_writeoff_document(doc_data):
+        """Приведение документа списания из API к колонкам моделей (без обращения к БД)
+        
+        :return: {'document': колонки WriteoffDocument, 'items': позиции с колонками WriteoffItem,
+                  'content_hash': отпечаток документа вместе с позициями}
+        """
+        document_id = doc_data.get('id')
+        
+        # Парсим дату
+        date_incoming_str = doc_data.get('dateIncoming')
+        date_incoming = None
+        if date_incoming_str:
+            try:
+                # Формат: "2025-02-20T23:00" (иногда с секундами)
+                date_incoming = datetime.fromisoformat(date_incoming_str)
+            except ValueError:
+                logger.warning(f"Не удалось разобрать дату {date_incoming_str} для документа {document_id}")
+                date_incoming = datetime.utcnow()
+        
+        # Парсим статус
+        status_str = doc_data.get('status')
+        try:
+            status = WriteoffDocumentStatus(status_str) if status_str else WriteoffDocumentStatus.NEW
+        except ValueError:
+            logger.warning(f"Неизвестный статус документа: {status_str}, используем NEW")
+            status = WriteoffDocumentStatus.NEW
+        
+        items = []
+        for item_data in doc_data.get('items', []):
+            items.append({
+                'document_id': document_id,
+                'num': item_data.get('num'),
+                'product_id': item_data.get('productId'),
+                'product_size_id': item_data.get('productSizeId'),
+                'amount_factor': item_data.get('amountFactor', 1),
+                'amount': item_data.get('amount'),
+                'measure_unit_id': item_data.get('measureUnitId'),
+                'container_id': item_data.get('containerId'),
+                'cost': item_data.get('cost')
+            })
+        
+        document = {
+            'id': document_id,
+            'date_incoming': date_incoming,
+            'document_number': doc_data.get('documentNumber'),
+            'status': status,
+            'conception_id': doc_data.get('conceptionId'),
+            'comment': doc_data.get('comment'),
+            'store_id': doc_data.get('storeId'),
+            'account_id': doc_data.get('accountId')
+        }
+        return {
+            'document': document,
+            'items': items,
+            'content_hash': content_hash(document, WRITEOFF_HASH_COLUMNS, extra=items)
+        }
+    
+    def _write_writeoff_batch(self, batch):
+        """Запись порции документов списания и фиксация транзакции
+        
+        При ошибке порция откатывается и записывается по одному документу, чтобы
+        ошибка одного документа (например, ссылка на неизвестный склад или счет)
+        не отменяла запись остальных.
+        """
+        try:
+            with self.session.no_autoflush:
+                counts = self._upsert_writeoff_batch(batch)
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            if len(batch) > 1:
+                logger.warning(f"Ошибка записи порции из {len(batch)} документов списания, записываем по одному: {e}")
+                for normalized in batch:
+                    self._write_writeoff_batch([normalized])
+                return
+            self.counters['errors'] += 1
+            logger.error(f"Ошибка при синхронизации документа {batch[0]['document']['id']}: {e}")
+            return
+        
+        # Счетчики учитываются только после фиксации, чтобы повтор порции не считался дважды
+        for key, value in counts.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        
+        # Дата последнего записанного документа (для состояния синхронизации)
+        for normalized in batch:
+            date_incoming = normalized['document']['date_incoming']
+            if date_incoming and (self._writeoff_last_date is None or date_incoming > self._writeoff_last_date):
+                self._writeoff_last_date = date_incoming
+    
+    def _upsert_writeoff_batch(self, batch):
+        """Set-based запись порции документов списания (без фиксации)
+        
+        1. Отпечатки документов порции читаются одним запросом, неизмененные документы
+           пропускаются вместе с позициями.
+        2. Существование товаров проверяется по справочнику в памяти.
+        3. Шапки документов пишутся одной загрузкой COPY + INSERT ... ON CONFLICT.
+        4. Позиции измененных документов сверяются с БД по (document_id, num):
+           исчезнувшие удаляются одним DELETE, остальные пишутся одной загрузкой,
+           строки без изменений не переписываются.
+        
+        :return: Счетчики порции
+        """
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0,
+                  'items_created': 0, 'items_updated': 0, 'items_deleted': 0}
+        
+        # Повтор документа в ответе: в одном INSERT ... ON CONFLICT строка не может
+        # обновляться дважды, поэтому оставляем последнюю версию
+        documents = {str(normalized['document']['id']).lower(): normalized for normalized in batch}
+        stored_hashes = load_hashes(self.session, WriteoffDocument, keys=documents)
+        
+        now = datetime.utcnow()
+        document_rows = []
+        item_rows = []
+        changed_ids = []
+        for key, normalized in documents.items():
+            document_id = normalized['document']['id']
+            change = classify(stored_hashes, key, normalized['content_hash'])
+            if change == UNCHANGED:
+                # Документ и его позиции не изменились - не переписываем
+                counts['unchanged'] += 1
+                continue
+            if change == NEW:
+                counts['created'] += 1
+            else:
+                counts['updated'] += 1
+                changed_ids.append(document_id)
+            
+            items_skipped = False
+            for item_row in normalized['items']:
+                product_id = item_row['product_id']
+                
+                # Проверяем существование товара
+                if product_id and not self.references.has_product(product_id, self.session):
+                    logger.warning(f"Товар {product_id} не найден в БД, пропускаем позицию {item_row['num']} документа {document_id}")
+                    counts['skipped'] += 1
+                    items_skipped = True
+                    continue
+                item_rows.append(dict(item_row, updated_at=now))
+            
+            # С пропущенными позициями отпечаток не сохраняется: документ перезапишется,
+            # когда товары появятся в справочнике
+            document_rows.append(dict(
+                normalized['document'],
+                content_hash=None if items_skipped else normalized['content_hash'],
+                created_at=now,
+                updated_at=now,
+                synced_at=now
+            ))
+        
+        if not document_rows:
+            return counts
+        
+        # Шапки документов должны попасть в БД раньше позиций, которые на них ссылаются
+        BulkLoader(self.session, WriteoffDocument, conflict_columns=['id'], hash_column='content_hash').load(document_rows)
+        
+        # Позиции, которых больше нет в измененных документах
+        wanted = {(str(row['document_id']).lower(), row['num']) for row in item_rows}
+        stale_ids = []
+        if changed_ids:
+            query = self.session.query(WriteoffItem.id, WriteoffItem.document_id, WriteoffItem.num).filter(
+                WriteoffItem.document_id.in_(changed_ids)
+            )
+            stale_ids = [item_id for item_id, document_id, num in query
+                         if (str(document_id).lower(), num) not in wanted]
+        if stale_ids:
+            self.session.query(WriteoffItem).filter(WriteoffItem.id.in_(stale_ids)).delete(synchronize_session=False)
+        
+        loaded = BulkLoader(self.session, WriteoffItem, conflict_columns=['document_id', 'num']).load(item_rows)
+        counts['items_created'] = loaded['inserted']
+        counts['items_updated'] = loaded['updated']
+        counts['items_deleted'] = len(stale_ids)
+        return counts
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
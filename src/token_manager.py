@@ -0,0 +1,206 @@
+"""
+Жизненный цикл токена авторизации IIKO API.
+
+Токен кэшируется на уровне процесса и переиспользуется всеми клиентами с теми же
+адресом сервера и логином. При указании IIKO_TOKEN_CACHE_FILE токен разделяется
+между процессами через локальный файл. При завершении процесса токен
+освобождается через /logout, если им больше не пользуется ни один процесс.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка файла недоступна
+    fcntl = None
+
+from config.config import IIKO_TOKEN_CACHE_FILE, IIKO_TOKEN_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_managers: Dict[Tuple[str, str], 'TokenManager'] = {}
+_managers_lock = threading.Lock()
+
+
+class TokenManager:
+    """Процессный кэш токена с обновлением и освобождением лицензии"""
+
+    def __init__(self, login_func: Callable[[], str], logout_func: Callable[[str], None],
+                 cache_file: Optional[str] = None, ttl: Optional[float] = None):
+        self._login_func = login_func
+        self._logout_func = logout_func
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.token = None
+        self.obtained_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str:
+        """Текущий токен: из памяти, из общего файла или новый вход"""
+        with self._lock:
+            if self.token and not self._expired():
+                return self.token
+            return self._acquire(stale_token=self.token)
+
+    def refresh(self, stale_token: Optional[str] = None) -> str:
+        """Замена отвергнутого сервером токена (после 401/403)
+
+        Если токен уже обновил другой поток или процесс, возвращается его токен,
+        повторный вход не выполняется.
+        """
+        with self._lock:
+            if self.token and self.token != stale_token and not self._expired():
+                return self.token
+            return self._acquire(stale_token=stale_token or self.token, rejected=True)
+
+    def logout(self):
+        """Освобождение токена через /logout, если им не пользуются другие процессы"""
+        with self._lock:
+            if not self.token:
+                return
+            token = self.token
+            self.token = None
+
+            with self._shared_state() as state:
+                if state is not None:
+                    holders = [pid for pid in state.get('holders', []) if pid != os.getpid() and _pid_alive(pid)]
+                    if state.get('token') == token and holders:
+                        # Токеном еще пользуются другие процессы
+                        state['holders'] = holders
+                        return
+                    state.clear()
+
+            self._safe_logout(token)
+
+    def _expired(self) -> bool:
+        return bool(self.ttl) and time.time() - self.obtained_at > self.ttl
+
+    def _acquire(self, stale_token: Optional[str], rejected: bool = False) -> str:
+        """Получение действующего токена (вызывается под self._lock)"""
+        with self._shared_state() as state:
+            if state is not None:
+                shared_token = state.get('token')
+                shared_fresh = not self.ttl or time.time() - state.get('obtained_at', 0) <= self.ttl
+                if shared_token and shared_token != stale_token and shared_fresh:
+                    # Другой процесс уже получил актуальный токен
+                    self.token = shared_token
+                    self.obtained_at = state.get('obtained_at', time.time())
+                    state['holders'] = _add_holder(state.get('holders', []))
+                    return self.token
+
+            # Устаревший по времени токен освобождаем, если им не пользуются другие процессы
+            # (иначе он истечет сам), отвергнутый сервером - уже недействителен
+            if stale_token and not rejected and self._sole_holder(state, stale_token):
+                self._safe_logout(stale_token)
+
+            logger.info("Получение нового токена IIKO API")
+            self.token = self._login_func()
+            self.obtained_at = time.time()
+
+            if state is not None:
+                state.clear()
+                state.update({
+                    'token': self.token,
+                    'obtained_at': self.obtained_at,
+                    'holders': [os.getpid()]
+                })
+            return self.token
+
+    @staticmethod
+    def _sole_holder(state: Optional[dict], token: str) -> bool:
+        """Пользуется ли токеном только текущий процесс"""
+        if state is None:
+            return True
+        if state.get('token') != token:
+            # Токен уже заменен в общем файле: кто еще его держит, неизвестно
+            return False
+        return not [pid for pid in state.get('holders', []) if pid != os.getpid() and _pid_alive(pid)]
+
+    def _safe_logout(self, token: str):
+        try:
+            self._logout_func(token)
+            logger.info("Токен IIKO API освобожден")
+        except Exception as e:
+            logger.warning(f"Не удалось выполнить logout для токена IIKO API: {e}")
+
+    @contextmanager
+    def _shared_state(self):
+        """Состояние общего файла под межпроцессной блокировкой (None без файла)"""
+        if not self.cache_file:
+            yield None
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        with open(self.cache_file, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                try:
+                    state = json.loads(content) if content.strip() else {}
+                except ValueError:
+                    state = {}
+                original = dict(state)
+
+                yield state
+
+                if state != original:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _add_holder(holders: list) -> list:
+    holders = [pid for pid in holders if _pid_alive(pid)]
+    if os.getpid() not in holders:
+        holders.append(os.getpid())
+    return holders
+
+
+def get_token_manager(base_url: str, login: str, login_func: Callable[[], str],
+                      logout_func: Callable[[str], None]) -> TokenManager:
+    """Общий для процесса менеджер токена для пары (сервер, логин)"""
+    key = (base_url, login)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = TokenManager(
+                login_func,
+                logout_func,
+                cache_file=IIKO_TOKEN_CACHE_FILE or None,
+                ttl=IIKO_TOKEN_TTL_SECONDS or None
+            )
+            _managers[key] = manager
+        return manager
+
+
+@atexit.register
+def logout_all():
+    """Освобождение всех токенов процесса при завершении"""
+    with _managers_lock:
+        managers = list(_managers.values())
+    for manager in managers:
+        manager.logout()
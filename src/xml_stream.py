@@ -0,0 +1,75 @@
+"""
+Потоковый разбор XML-ответов IIKO API.
+
+Элементы разбираются по мере чтения ответа из сокета, каждое поле извлекается
+за один проход по дочерним узлам, а обработанный элемент сразу освобождается.
+"""
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+
+def iter_xml_elements(chunks: Iterable[bytes], tag: str,
+                      root_attrib: Optional[dict] = None) -> Iterator[ET.Element]:
+    """Потоковый перебор элементов с указанным тегом
+
+    Элемент действителен только до следующей итерации: после возврата управления
+    он очищается и удаляется из родителя, чтобы дерево не росло в памяти.
+
+    :param chunks: Порции ответа (например, response.iter_content())
+    :param tag: Тег элементов верхнего уровня вложенности (вложенные одноименные не отдаются)
+    :param root_attrib: Словарь, в который копируются атрибуты корневого элемента
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    stack = []
+    depth = 0  # Количество открытых элементов с искомым тегом
+
+    def drain():
+        nonlocal depth
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if not stack and root_attrib is not None:
+                    root_attrib.update(elem.attrib)
+                stack.append(elem)
+                if elem.tag == tag:
+                    depth += 1
+                continue
+
+            stack.pop()
+            if elem.tag != tag:
+                continue
+            depth -= 1
+            if depth:
+                continue
+
+            yield elem
+
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+
+    for chunk in chunks:
+        if chunk:
+            parser.feed(chunk)
+            yield from drain()
+
+    parser.close()
+    yield from drain()
+
+
+def element_fields(elem: ET.Element) -> Dict[str, Optional[str]]:
+    """Тексты всех дочерних узлов элемента за один проход"""
+    return {child.tag: child.text for child in elem}
+
+
+def iter_xml_records(chunks: Iterable[bytes], tag: str,
+                     where: Optional[Callable[[Dict[str, Optional[str]]], bool]] = None,
+                     root_attrib: Optional[dict] = None) -> Iterator[Dict[str, Optional[str]]]:
+    """Потоковый перебор плоских записей (тег дочернего узла -> текст)
+
+    :param where: Фильтр записей; неподходящие записи отбрасываются сразу при разборе
+    :param root_attrib: Словарь, в который копируются атрибуты корневого элемента
+    """
+    for elem in iter_xml_elements(chunks, tag, root_attrib):
+        fields = element_fields(elem)
+        if where is None or where(fields):
+            yield fields
@@ -49,10 +49,10 @@ def test_check_uniqueness():
         api_unique_keys = set()
         
         for item in sales_data:
-            order_num = item.get("OrderNum")
-            fiscal_cheque_number = item.get("FiscalChequeNumber")
-            dish_code = item.get("DishCode")
-            cash_register_number = item.get("CashRegisterName.Number")
+            order_num = item.get("order_num")
+            fiscal_cheque_number = item.get("fiscal_cheque_number")
+            dish_code = item.get("dish_code")
+            cash_register_number = item.get("cash_register_number")
             
             # Считаем количество позиций по чекам
             check_key = f"{order_num}_{fiscal_cheque_number}"
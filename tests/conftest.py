@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули проекта импортируются как src.*, config.* (как в main.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
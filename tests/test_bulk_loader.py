@@ -0,0 +1,223 @@
+import enum
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import JSON, Column, DateTime, Integer, String, UniqueConstraint
+from sqlalchemy.orm import declarative_base
+
+from src.bulk_loader import BulkLoader, _CopyStream, _csv_value
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'items'
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String(50), nullable=False)
+    size = Column(String(50), nullable=True)
+    name = Column(String(255))
+    payload = Column(JSON)
+    content_hash = Column(String(32))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    kind = Column(String(10), default='BASE')
+
+
+class SizedItem(Base):
+    __tablename__ = 'sized_items'
+    __table_args__ = (
+        UniqueConstraint('code', 'size', name='unique_sized_item', postgresql_nulls_not_distinct=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String(50), nullable=False)
+    size = Column(String(50), nullable=True)
+    name = Column(String(255))
+
+
+class Color(enum.Enum):
+    RED = 'red'
+
+
+class FakeCursor:
+    def __init__(self, merged=(0, 0)):
+        self.merged = merged
+        self.statements = []
+        self.copied = ''
+        self.closed = False
+
+    def execute(self, sql):
+        self.statements.append(sql)
+
+    def copy_expert(self, sql, stream):
+        self.statements.append(sql)
+        while True:
+            chunk = stream.read(7)
+            if not chunk:
+                break
+            self.copied += chunk.decode('utf-8')
+
+    def fetchone(self):
+        return self.merged
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def connection(self):
+        session = self
+
+        class Connection:
+            class connection:
+                @staticmethod
+                def cursor():
+                    return session._cursor
+
+        return Connection
+
+
+def _load(rows, merged=(0, 0), **options):
+    cursor = FakeCursor(merged)
+    result = BulkLoader(FakeSession(cursor), Item, **options).load(rows)
+    return result, cursor
+
+
+def test_csv_value_encoding():
+    assert _csv_value(None) == ''
+    assert _csv_value(True) == 't' and _csv_value(False) == 'f'
+    assert _csv_value(5) == '5' and _csv_value(2.5) == '2.5'
+    assert _csv_value(Decimal('1.50')) == '"1.50"'
+    assert _csv_value('') == '""'
+    assert _csv_value('a "b", c\nd') == '"a ""b"", c\nd"'
+    assert _csv_value(Color.RED) == '"RED"'
+    assert _csv_value(datetime(2025, 1, 2, 3, 4, 5)) == '"2025-01-02T03:04:05"'
+    assert _csv_value(date(2025, 1, 2)) == '"2025-01-02"'
+    assert _csv_value({'a': 'б'}) == '"{""a"": ""б""}"'
+    value = uuid.uuid4()
+    assert _csv_value(value) == f'"{value}"'
+
+
+def test_copy_stream_reads_across_lines():
+    stream = _CopyStream(iter(['ab\n', 'вг\n', 'e\n']))
+    data = b''
+    while True:
+        chunk = stream.read(2)
+        if not chunk:
+            break
+        assert len(chunk) <= 2
+        data += chunk
+    assert data.decode('utf-8') == 'ab\nвг\ne\n'
+    assert _CopyStream(iter(['x\n', 'y\n'])).read() == b'x\ny\n'
+
+
+def test_load_without_rows_does_not_touch_database():
+    result, cursor = _load([])
+    assert result == {'staged': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+    assert cursor.statements == []
+
+
+def test_load_stages_rows_and_counts_result():
+    rows = [{'id': 1, 'code': 'a', 'name': 'A'}, {'id': 2, 'code': 'b', 'name': None},
+            {'id': 3, 'code': 'c', 'name': 'C'}]
+    result, cursor = _load(rows, merged=(1, 1), conflict_columns=['id'])
+    assert result == {'staged': 3, 'inserted': 1, 'updated': 1, 'unchanged': 1}
+    assert cursor.closed
+
+    lines = cursor.copied.splitlines()
+    assert len(lines) == 3
+    # Python-умолчания колонок, которых нет в строках, подставляются в COPY
+    fields = lines[1].split(',')
+    assert fields[:3] == ['2', '"b"', '']
+    assert fields[-1] == '"BASE"'
+    assert any(statement.startswith('DROP TABLE') for statement in cursor.statements)
+
+
+def test_merge_insert_only():
+    _, cursor = _load([{'id': 1, 'code': 'a'}])
+    merge = cursor.statements[-2]
+    assert 'ON CONFLICT' not in merge
+    assert 'ORDER BY _bulk_row' in merge
+
+
+def test_merge_updates_changed_rows_only():
+    _, cursor = _load([{'id': 1, 'code': 'a', 'name': 'A', 'payload': {'x': 1}, 'updated_at': None}],
+                      conflict_columns=['code'])
+    merge = cursor.statements[-2]
+    assert 'ON CONFLICT ("code") DO UPDATE SET' in merge
+    assert '"name" = EXCLUDED."name"' in merge
+    # Ключ конфликта, id и created_at не обновляются
+    assert '"code" = EXCLUDED' not in merge and '"id" = EXCLUDED' not in merge
+    assert '"created_at" = EXCLUDED' not in merge
+    # Служебные колонки не участвуют в сравнении, json сравнивается как текст
+    where = merge[merge.index('WHERE'):]
+    assert '"updated_at"' not in where
+    assert 't."payload"::text' in where
+    assert 'DISTINCT ON ("code"' in merge
+
+
+def test_merge_compares_hash_only():
+    _, cursor = _load([{'id': 1, 'code': 'a', 'name': 'A', 'content_hash': 'h'}],
+                      conflict_columns=['code'], hash_column='content_hash')
+    where = cursor.statements[-2].split('WHERE', 1)[1]
+    assert '(t."content_hash") IS DISTINCT FROM (EXCLUDED."content_hash")' in where
+    assert 'OR EXCLUDED."content_hash" IS NULL' in where
+    assert '"name"' not in where
+
+
+def test_merge_without_skip_unchanged_always_updates():
+    _, cursor = _load([{'id': 1, 'code': 'a', 'name': 'A'}], conflict_columns=['code'], skip_unchanged=False)
+    assert 'IS DISTINCT FROM' not in cursor.statements[-2]
+
+
+def test_merge_do_nothing_without_update_columns():
+    _, cursor = _load([{'id': 1, 'code': 'a'}], conflict_columns=['code'], update_columns=[])
+    assert 'DO NOTHING' in cursor.statements[-2]
+
+
+def test_duplicate_keys_collapse_to_last_row():
+    _, cursor = _load([{'id': 1, 'code': 'a', 'name': 'old'}, {'id': 1, 'code': 'a', 'name': 'new'}],
+                      conflict_columns=['code'])
+    merge = cursor.statements[-2]
+    # При повторе ключа побеждает последняя строка
+    assert 'DISTINCT ON ("code")' in merge
+    assert 'ORDER BY "code", _bulk_row DESC' in merge
+
+
+def test_nullable_key_requires_nulls_not_distinct():
+    # Обычный UNIQUE не считает NULL равными: ON CONFLICT не сработает и строки задвоятся
+    with pytest.raises(ValueError, match='size'):
+        BulkLoader(FakeSession(FakeCursor()), Item, conflict_columns=['code', 'size'])
+
+
+def test_null_keys_collapse_with_nulls_not_distinct():
+    cursor = FakeCursor()
+    loader = BulkLoader(FakeSession(cursor), SizedItem, conflict_columns=['code', 'size'])
+    loader.load([{'id': 1, 'code': 'a', 'size': None, 'name': 'old'},
+                 {'id': 2, 'code': 'a', 'size': None, 'name': 'new'}])
+    merge = cursor.statements[-2]
+    assert 'DISTINCT ON ("code", "size")' in merge
+    assert 'ON CONFLICT ("code", "size")' in merge
+
+
+def test_table_name_override():
+    _, cursor = _load([{'id': 1, 'code': 'a'}], table_name='items_reload')
+    assert '"items_reload"' in cursor.statements[0]
+
+
+def test_failed_copy_closes_cursor():
+    cursor = FakeCursor()
+
+    def copy_expert(sql, stream):
+        raise RuntimeError('copy failed')
+
+    cursor.copy_expert = copy_expert
+    with pytest.raises(RuntimeError):
+        BulkLoader(FakeSession(cursor), Item, conflict_columns=['code']).load([{'id': 1, 'code': 'a'}])
+    assert cursor.closed
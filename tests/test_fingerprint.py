@@ -0,0 +1,115 @@
+import enum
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from src import fingerprint as module
+from src.fingerprint import (
+    CHANGED, NEW, UNCHANGED, classify, content_hash, diff_from_load, empty_diff, load_hashes
+)
+
+ID = uuid.UUID('6f1c6a3e-3b1e-4d6b-9f0a-2c4e1c7b8a90')
+
+
+class Kind(enum.Enum):
+    BASE = 'base'
+
+
+class Column:
+    """Колонка модели: in_() запоминает порцию ключей запроса"""
+
+    def __init__(self, name, queries=None):
+        self.name = name
+        self.queries = queries
+
+    def in_(self, values):
+        self.queries.append(list(values))
+        return values
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, keys):
+        return FakeQuery([row for row in self.rows if str(row[0]).lower() in keys])
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def query(self, *columns):
+        return FakeQuery(self.rows)
+
+
+class Model:
+    queries = []
+    id = Column('id', queries)
+    content_hash = Column('content_hash')
+
+
+def test_hash_ignores_number_representation_and_uuid_case():
+    columns = ['id', 'amount', 'price']
+    first = content_hash({'id': ID, 'amount': 1, 'price': Decimal('10.50')}, columns)
+    second = content_hash({'id': str(ID), 'amount': 1.0, 'price': Decimal('10.5')}, columns)
+
+    assert first == second
+    assert len(first) == 32
+
+
+def test_hash_depends_on_values_column_order_and_extra():
+    row = {'code': 'A', 'name': 'Товар', 'kind': Kind.BASE, 'date': date(2025, 1, 1)}
+    base = content_hash(row, ['code', 'name', 'kind', 'date'])
+
+    assert content_hash(dict(row, name='Другой'), ['code', 'name', 'kind', 'date']) != base
+    assert content_hash(row, ['name', 'code', 'kind', 'date']) != base
+    assert content_hash(row, ['code', 'name', 'kind', 'date'], extra=[{'amount': 1}]) != base
+    # Отсутствующая колонка равна None
+    assert content_hash(row, ['code', 'missing']) == content_hash(dict(row, missing=None), ['code', 'missing'])
+
+
+def test_canonical_values():
+    assert module._canonical(Decimal('1.00')) == '1'
+    assert module._canonical(2.50) == '2.5'
+    assert module._canonical(True) is True
+    assert module._canonical(Kind.BASE) == 'BASE'
+    assert module._canonical(datetime(2025, 1, 2, 3, 4)) == '2025-01-02T03:04:00'
+    assert module._canonical({1: [ID, None]}) == {'1': [str(ID), None]}
+
+
+def test_classify():
+    stored = {str(ID): 'abc', 'other': None}
+
+    assert classify(stored, ID, 'abc') == UNCHANGED
+    assert classify(stored, str(ID).upper(), 'abc') == UNCHANGED
+    assert classify(stored, ID, 'def') == CHANGED
+    # Строка без отпечатка (до миграции 016) считается измененной
+    assert classify(stored, 'other', 'abc') == CHANGED
+    assert classify(stored, 'missing', 'abc') == NEW
+
+
+def test_load_hashes_for_keys_in_chunks(monkeypatch):
+    monkeypatch.setattr(module, '_LOAD_CHUNK_SIZE', 2)
+    Model.queries.clear()
+    session = FakeSession([(ID, 'abc'), ('B', 'def'), ('c', None), ('D', 'zzz')])
+
+    hashes = load_hashes(session, Model, [str(ID).upper(), 'b', 'C', None, 'b'])
+
+    assert hashes == {str(ID): 'abc', 'b': 'def', 'c': None}
+    assert sorted(len(chunk) for chunk in Model.queries) == [1, 2]
+
+
+def test_load_all_hashes():
+    session = FakeSession([(ID, 'abc'), ('B', None)])
+
+    assert load_hashes(session, Model) == {str(ID): 'abc', 'b': None}
+
+
+def test_diff_helpers():
+    assert empty_diff() == {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+    assert diff_from_load({'staged': 6, 'inserted': 1, 'updated': 2, 'unchanged': 3}) == \
+        {NEW: 1, CHANGED: 2, UNCHANGED: 3}
@@ -0,0 +1,58 @@
+import asyncio
+from unittest import mock
+
+from src import incoming_invoice_synchronizer as module
+from src.incoming_invoice_synchronizer import IncomingInvoiceSynchronizer
+
+
+class _AsyncClient:
+    """Асинхронный клиент: поставщик 'slow' отвечает последним, 'broken' - ошибкой"""
+
+    def __init__(self, api_client):
+        self.events = api_client
+
+    async def ensure_token(self):
+        return 'token'
+
+    async def get_incoming_invoices(self, from_date, to_date, supplier_id):
+        if supplier_id == 'slow':
+            await asyncio.sleep(0.05)
+        if supplier_id == 'broken':
+            raise RuntimeError('API error')
+        self.events.append(('fetched', supplier_id))
+        return [{'supplier': supplier_id, 'document_number': f'{supplier_id}-{n}'} for n in range(3)]
+
+
+def _synchronizer(events):
+    synchronizer = IncomingInvoiceSynchronizer.__new__(IncomingInvoiceSynchronizer)
+    synchronizer.api_client = events
+    synchronizer.counters = {'errors': 0}
+    synchronizer._invoice_fields = lambda invoice_data: {'document_number': invoice_data['document_number']}
+    synchronizer._write_invoice_batch = lambda batch: events.append(('written', batch[0][0]['supplier'], len(batch)))
+    return synchronizer
+
+
+def test_each_supplier_is_written_as_soon_as_it_is_loaded():
+    events = []
+    synchronizer = _synchronizer(events)
+    failed = []
+
+    with mock.patch.object(module, 'AsyncIikoApiClient', _AsyncClient):
+        total = asyncio.run(synchronizer._sync_suppliers('2025-01-01', '2025-01-31', ['slow', 'fast', 'broken'], failed))
+
+    assert total == 6
+    assert failed == ['broken']
+    assert synchronizer.counters['errors'] == 1
+    # Быстрый поставщик записан до того, как загрузился медленный
+    assert events.index(('written', 'fast', 3)) < events.index(('fetched', 'slow'))
+    assert events[-1] == ('written', 'slow', 3)
+
+
+def test_supplier_invoices_are_written_in_commit_slices():
+    events = []
+    synchronizer = _synchronizer(events)
+    synchronizer.COMMIT_EVERY = 2
+
+    synchronizer._write_supplier_invoices([{'supplier': 's', 'document_number': str(n)} for n in range(5)])
+
+    assert events == [('written', 's', 2), ('written', 's', 2), ('written', 's', 1)]
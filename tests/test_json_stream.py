@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from src.json_stream import iter_json_array
+
+ARRAY = '[7.5, -12, 1e3, 0.25E-2, "строка, с запятой ]", true, false, null, {"a": [1, {"b": "}"}]}, []]'
+WRAPPED = '{"summary": {"rows": 3.5}, "note": "[x]", "response": [{"id": 1, "sum": 10.75}, {"id": 2, "sum": -3}]}'
+
+
+def _split(data: bytes, *offsets):
+    bounds = [0, *offsets, len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+@pytest.mark.parametrize('offset', range(len(ARRAY.encode('utf-8')) + 1))
+def test_array_split_at_every_offset(offset):
+    data = ARRAY.encode('utf-8')
+    assert list(iter_json_array(_split(data, offset))) == json.loads(ARRAY)
+
+
+@pytest.mark.parametrize('offset', range(len(WRAPPED.encode('utf-8')) + 1))
+def test_wrapped_array_split_at_every_offset(offset):
+    data = WRAPPED.encode('utf-8')
+    assert list(iter_json_array(_split(data, offset), key='response')) == json.loads(WRAPPED)['response']
+
+
+def test_one_byte_chunks():
+    data = ARRAY.encode('utf-8')
+    assert list(iter_json_array([data[i:i + 1] for i in range(len(data))])) == json.loads(ARRAY)
+
+
+def test_number_cut_at_chunk_boundary():
+    assert list(iter_json_array([b'[7.', b'5]'])) == [7.5]
+    assert list(iter_json_array([b'[1', b'2', b'3, 4', b'5]'])) == [123, 45]
+    assert list(iter_json_array([b'[-', b'1e', b'2]'])) == [-100.0]
+
+
+def test_text_chunks_and_empty_chunks():
+    assert list(iter_json_array(['', '[1,', '', ' 2]', ''])) == [1, 2]
+
+
+def test_missing_key_yields_nothing():
+    assert list(iter_json_array([b'{"result": "SUCCESS"}'], key='response')) == []
+
+
+def test_truncated_response_raises():
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[1, 2']))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[{"id": 1']))
+
+
+def test_not_array_or_object_raises():
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'"text"']))
@@ -0,0 +1,73 @@
+import uuid
+from datetime import datetime
+
+from src.olap_fields import (SALES_FIELDS, OlapRowNormalizer, to_datetime, to_flag, to_int, to_str,
+                             to_uuid)
+
+
+def test_converters_empty_values():
+    assert to_str('') is None and to_str(None) is None
+    assert to_int('') is None and to_int(None) is None
+    assert to_uuid('') is None and to_uuid(None) is None
+    assert to_datetime('') is None and to_datetime(None) is None
+    assert to_flag(None) is False
+
+
+def test_converters_values():
+    assert to_str(12) == '12'
+    assert to_int('7') == 7
+    assert to_int('12.0') == 12
+    assert to_int(3.9) == 3
+    assert to_int('abc') is None
+    value = uuid.uuid4()
+    assert to_uuid(str(value).upper()) == value
+    assert to_uuid('not-a-uuid') is None
+    assert to_flag('TRUE') is True and to_flag('false') is False and to_flag(True) is True
+
+
+def test_to_datetime_formats():
+    assert to_datetime('2025-02-20T23:00') == datetime(2025, 2, 20, 23, 0)
+    assert to_datetime('2025-02-20T23:00:05.123') == datetime(2025, 2, 20, 23, 0, 5, 123000)
+    assert to_datetime('20.02.2025 23:00:05') == datetime(2025, 2, 20, 23, 0, 5)
+    assert to_datetime('вчера') is None
+
+
+def test_normalizer_maps_keys_and_fills_missing_columns():
+    normalizer = OlapRowNormalizer(SALES_FIELDS)
+    department_id = uuid.uuid4()
+    row = normalizer({
+        'OrderNum': '15',
+        'Department.Id': str(department_id),
+        'DishSumInt': '250.0',
+        'Storned': 'FALSE',
+        'UnknownColumn': 'x',
+    })
+    assert set(row) == {column for column, _ in SALES_FIELDS.values()}
+    assert row['order_num'] == 15
+    assert row['department_id'] == department_id
+    assert row['dish_sum'] == 250
+    assert row['storned'] is False
+    assert row['dish_name'] is None
+    assert 'UnknownColumn' not in row
+
+
+def test_normalizer_matches_prefixed_keys_by_longest_suffix():
+    normalizer = OlapRowNormalizer(SALES_FIELDS)
+    row = normalizer({'1.CashRegisterName': 'Касса', '2.CashRegisterName.Number': '3'})
+    assert row['cash_register_name'] == 'Касса'
+    assert row['cash_register_number'] == 3
+
+
+def test_normalizer_compiles_plan_once_per_key_set():
+    calls = []
+
+    def converter(value):
+        calls.append(value)
+        return value
+
+    normalizer = OlapRowNormalizer({'A': ('a', converter)})
+    assert normalizer({'A': 1}) == {'a': 1}
+    assert normalizer({'A': 2}) == {'a': 2}
+    assert normalizer({'B': 3}) == {'a': None}
+    assert len(normalizer._compiled) == 2
+    assert calls == [1, 2, None]
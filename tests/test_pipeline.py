@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+
+from src.pipeline import Pipeline, chunked, merge_stats
+
+
+class _Source:
+    """Источник, запоминающий количество выданных элементов и закрытие"""
+
+    def __init__(self, count, fail_at=None):
+        self.count = count
+        self.fail_at = fail_at
+        self.produced = 0
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for value in range(self.count):
+                if value == self.fail_at:
+                    raise RuntimeError('source failed')
+                self.produced += 1
+                yield value
+        finally:
+            self.closed = True
+
+
+def test_items_pass_through_stages_in_order():
+    written = []
+    pipeline = (Pipeline('test', queue_size=2)
+                .add_stage('double', lambda items: (item * 2 for item in items))
+                .add_stage('batch', lambda items: chunked(items, 3)))
+    stats = pipeline.run(range(10), written.append)
+
+    assert written == [[0, 2, 4], [6, 8, 10], [12, 14, 16], [18]]
+    assert list(stats) == ['fetch', 'double', 'batch', 'write']
+    assert stats['fetch']['items'] == 10
+    assert stats['batch']['items'] == 4
+    assert stats['write']['items'] == 4
+
+
+def test_sink_runs_in_caller_thread():
+    threads = set()
+    Pipeline('test').run(range(5), lambda item: threads.add(threading.get_ident()))
+    assert threads == {threading.get_ident()}
+
+
+def test_empty_source():
+    written = []
+    stats = Pipeline('test').add_stage('batch', lambda items: chunked(items, 2)).run([], written.append)
+    assert written == []
+    assert stats['write']['items'] == 0
+
+
+def test_source_error_is_raised_and_closes_source():
+    source = _Source(100, fail_at=5)
+    with pytest.raises(RuntimeError, match='source failed'):
+        Pipeline('test').run(source, lambda item: None)
+    assert source.closed
+
+
+def test_stage_error_stops_source():
+    source = _Source(10000)
+
+    def failing(items):
+        for item in items:
+            if item == 3:
+                raise ValueError('stage failed')
+            yield item
+
+    with pytest.raises(ValueError, match='stage failed'):
+        Pipeline('test', queue_size=1).add_stage('fail', failing).run(source, lambda item: None)
+    assert source.closed
+    assert source.produced < 100
+
+
+def test_sink_error_stops_and_closes_source():
+    source = _Source(10000)
+
+    def sink(item):
+        if item == 2:
+            raise KeyError('sink failed')
+
+    with pytest.raises(KeyError):
+        Pipeline('test', queue_size=1).run(source, sink)
+    assert source.closed
+    # Ограниченная очередь не дает источнику уйти далеко вперед записи
+    assert source.produced < 100
+
+
+def test_back_pressure_limits_read_ahead():
+    source = _Source(1000)
+    ahead = []
+
+    def sink(item):
+        ahead.append(source.produced - item)
+
+    Pipeline('test', queue_size=2).run(source, sink)
+    # Очередь на 2 элемента + элемент, ожидающий места в очереди, + элемент в записи
+    assert max(ahead) <= 4
+
+
+def test_pipeline_can_be_reused():
+    pipeline = Pipeline('test')
+    first, second = [], []
+    pipeline.run(range(3), first.append)
+    pipeline.run(range(2), second.append)
+    assert first == [0, 1, 2] and second == [0, 1]
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
+    assert list(chunked(range(4), 2)) == [[0, 1], [2, 3]]
+
+
+def test_merge_stats():
+    first = {'fetch': {'items': 2, 'seconds': 0.5}}
+    total = merge_stats(None, first)
+    total = merge_stats(total, {'fetch': {'items': 3, 'seconds': 0.25}, 'write': {'items': 1}})
+    assert total == {'fetch': {'items': 5, 'seconds': 0.75}, 'write': {'items': 1}}
+    # Исходная статистика не изменяется
+    assert first == {'fetch': {'items': 2, 'seconds': 0.5}}
@@ -0,0 +1,122 @@
+import uuid
+from datetime import date
+from unittest import mock
+
+import pytest
+
+from src import price_synchronizer as module
+from src.price_synchronizer import PRICE_HASH_COLUMNS, PriceSynchronizer
+from src.fingerprint import content_hash
+
+DEPARTMENT = uuid.UUID('11111111-1111-1111-1111-111111111111')
+PRODUCT = uuid.UUID('22222222-2222-2222-2222-222222222222')
+UNKNOWN_PRODUCT = uuid.UUID('33333333-3333-3333-3333-333333333333')
+
+
+class FakeLoader:
+    """BulkLoader, запоминающий строки по ключу слияния"""
+
+    loads = []
+
+    def __init__(self, session, model, conflict_columns, hash_column=None):
+        self.conflict_columns = conflict_columns
+
+    def load(self, rows):
+        rows = list(rows)
+        self.loads.append((self.conflict_columns, rows))
+        return {'staged': len(rows), 'inserted': len(rows), 'updated': len(rows), 'unchanged': 0}
+
+
+@pytest.fixture
+def synchronizer():
+    FakeLoader.loads = []
+    synchronizer = PriceSynchronizer.__new__(PriceSynchronizer)
+    synchronizer.session = mock.Mock()
+    synchronizer.references = mock.Mock()
+    synchronizer.references.has_product.side_effect = lambda product_id, session: product_id == PRODUCT
+    with mock.patch.object(module, 'BulkLoader', FakeLoader):
+        yield synchronizer
+
+
+def _api_price(date_from, date_to, price, product=PRODUCT):
+    return {
+        'departmentId': str(DEPARTMENT),
+        'productId': str(product),
+        'prices': [{'dateFrom': date_from, 'dateTo': date_to, 'price': price}],
+    }
+
+
+def _key(date_from, date_to):
+    return (DEPARTMENT, PRODUCT, None, 'BASE', date_from, date_to)
+
+
+def _stored_hash(synchronizer, date_from, date_to, price):
+    rows, _ = synchronizer._price_rows([_api_price(date_from, date_to, price)], 'BASE')
+    return rows[0]['content_hash']
+
+
+def _loaded(conflict_columns):
+    return [rows for columns, rows in FakeLoader.loads if columns == conflict_columns][0]
+
+
+def test_price_rows_skip_unknown_products_and_hash_api_columns(synchronizer):
+    rows, skipped = synchronizer._price_rows([
+        _api_price('2025-03-01', '2025-03-10', 100),
+        _api_price('2025-03-01', '2025-03-10', 50, product=UNKNOWN_PRODUCT),
+        {'departmentId': str(DEPARTMENT), 'productId': str(PRODUCT), 'prices': [{'dateFrom': 'bad'}]},
+    ], 'BASE')
+
+    assert skipped == 2
+    assert len(rows) == 1
+    assert rows[0]['date_from'] == date(2025, 3, 1)
+    # synced_at не входит в отпечаток: повторная загрузка тех же данных дает тот же отпечаток
+    assert rows[0]['content_hash'] == content_hash(dict(rows[0], synced_at=None), PRICE_HASH_COLUMNS)
+
+
+def test_write_inserts_new_updates_changed_by_id_and_keeps_unchanged(synchronizer):
+    changed_id, unchanged_id = uuid.uuid4(), uuid.uuid4()
+    stored = {
+        _key(date(2025, 3, 1), date(2025, 3, 5)): (changed_id, _stored_hash(synchronizer, '2025-03-01', '2025-03-05', 90)),
+        _key(date(2025, 3, 5), date(2025, 3, 10)): (unchanged_id, _stored_hash(synchronizer, '2025-03-05', '2025-03-10', 100)),
+    }
+    synchronizer._stored_prices = mock.Mock(return_value=stored)
+
+    counts = synchronizer._write_department_prices(str(DEPARTMENT), '2025-03-01', '2025-03-31', 'BASE', [
+        _api_price('2025-03-01', '2025-03-05', 95),
+        _api_price('2025-03-05', '2025-03-10', 100),
+        _api_price('2025-03-10', '2025-03-31', 110),
+    ])
+
+    assert counts == {'rows': 3, 'created': 1, 'updated': 1, 'unchanged': 1, 'deleted': 0, 'skipped': 0}
+    assert [row['date_from'] for row in _loaded(module.PRICE_KEY_COLUMNS)] == [date(2025, 3, 10)]
+    updated = _loaded(['id'])
+    assert [(row['id'], row['price']) for row in updated] == [(changed_id, 95)]
+    synchronizer.session.query.assert_not_called()
+    synchronizer.session.commit.assert_called_once()
+
+
+def test_write_deletes_only_missing_intervals_inside_period(synchronizer):
+    inside_id, outside_id = uuid.uuid4(), uuid.uuid4()
+    synchronizer._stored_prices = mock.Mock(return_value={
+        _key(date(2025, 3, 1), date(2025, 3, 10)): (inside_id, 'old'),
+        # Интервал, выходящий за период, API возвращает не для каждого запроса
+        _key(date(2025, 2, 20), date(2025, 3, 10)): (outside_id, 'old'),
+    })
+
+    counts = synchronizer._write_department_prices(str(DEPARTMENT), '2025-03-01', '2025-03-31', 'BASE', [])
+
+    assert counts['deleted'] == 1
+    criterion = synchronizer.session.query.return_value.filter.call_args.args[0]
+    assert criterion.right.value == [inside_id]
+
+
+def test_repeated_key_in_response_keeps_last_row(synchronizer):
+    synchronizer._stored_prices = mock.Mock(return_value={})
+
+    counts = synchronizer._write_department_prices(str(DEPARTMENT), '2025-03-01', '2025-03-31', 'BASE', [
+        _api_price('2025-03-01', '2025-03-31', 100),
+        _api_price('2025-03-01', '2025-03-31', 120),
+    ])
+
+    assert counts['rows'] == 1
+    assert [row['price'] for row in _loaded(module.PRICE_KEY_COLUMNS)] == [120]
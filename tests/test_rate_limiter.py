@@ -0,0 +1,151 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from src import rate_limiter as module
+from src.rate_limiter import RateLimiter, TokenBucket, endpoint_class
+
+
+class _Clock:
+    """Управляемые time.monotonic и time.sleep: сон только сдвигает часы"""
+
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    clock = _Clock()
+    with mock.patch.object(module.time, 'monotonic', clock.monotonic), \
+            mock.patch.object(module.time, 'sleep', clock.sleep):
+        yield clock
+
+
+def _limiter(limits=None, max_in_flight=0, max_retries=3):
+    return RateLimiter(limits or {'reference': 2, 'olap': 0.5}, max_in_flight=max_in_flight,
+                       max_retries=max_retries, backoff_base=1.0, backoff_max=8.0)
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://host/resto/api/v2/reports/olap', 'olap'),
+    ('https://host/resto/api/v2/price', 'prices'),
+    ('https://host/resto/api/documents/export/incomingInvoice', 'documents'),
+    ('https://host/resto/api/auth', 'auth'),
+    ('https://host/resto/api/logout', 'auth'),
+    ('https://host/resto/api/corporation/stores', 'reference'),
+])
+def test_endpoint_class(url, expected):
+    assert endpoint_class(url) == expected
+
+
+def test_bucket_allows_burst_then_waits_for_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    # Третий запрос ждет полтокена при 2 токенах в секунду
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+    clock.now += 10
+    assert bucket.reserve() == 0.0
+    # Накопление ограничено capacity
+    assert bucket.tokens == pytest.approx(1.0)
+
+
+def test_bucket_slow_down_is_bounded_and_recovers_gradually(clock):
+    bucket = TokenBucket(rate=10)
+
+    for _ in range(10):
+        bucket.slow_down()
+    assert bucket.rate == pytest.approx(10 * module._MIN_RATE_FACTOR)
+
+    bucket.recover()
+    assert bucket.rate == pytest.approx(10 * (module._MIN_RATE_FACTOR + module._RECOVERY_STEP))
+    for _ in range(100):
+        bucket.recover()
+    assert bucket.rate == pytest.approx(10)
+
+
+def test_acquire_sleeps_for_rate_and_counts_waits(clock):
+    limiter = _limiter({'reference': 1})
+
+    limiter.acquire('reference')
+    limiter.acquire('reference')
+
+    assert clock.slept == [pytest.approx(1.0)]
+    stats = limiter.stats()['reference']
+    assert stats['requests'] == 2
+    assert stats['rate_wait_seconds'] == pytest.approx(1.0)
+    assert stats['current_rate'] == 1
+
+
+def test_unknown_class_uses_reference_budget_and_zero_rate_is_unlimited(clock):
+    limiter = _limiter({'reference': 1, 'olap': 0})
+
+    limiter.acquire('prices')
+    limiter.acquire('prices')
+    for _ in range(5):
+        limiter.acquire('olap')
+
+    assert clock.slept == [pytest.approx(1.0)]
+    assert limiter.stats()['olap']['current_rate'] is None
+
+
+def test_in_flight_slots_block_until_release():
+    limiter = _limiter({'reference': 0}, max_in_flight=1)
+    limiter.acquire('reference')
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire('reference'), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    limiter.release()
+    assert acquired.wait(1)
+    thread.join()
+    limiter.release()
+
+
+def test_should_retry_only_throttle_statuses_within_limit():
+    limiter = _limiter(max_retries=2)
+
+    assert limiter.should_retry(429, 0)
+    assert limiter.should_retry(503, 1)
+    assert not limiter.should_retry(503, 2)
+    assert not limiter.should_retry(404, 0)
+
+
+def test_backoff_slows_class_and_respects_retry_after(clock):
+    limiter = _limiter({'reference': 4})
+
+    with mock.patch.object(module.random, 'uniform', return_value=0.5):
+        assert limiter.backoff('reference', attempt=0) == 0.5
+        # Retry-After - нижняя граница, но не больше backoff_max
+        assert limiter.backoff('reference', attempt=0, retry_after='3') == 3.0
+        assert limiter.backoff('reference', attempt=0, retry_after='60') == 8.0
+        assert limiter.backoff('reference', attempt=0, retry_after='soon') == 0.5
+
+    assert clock.slept == [0.5, 3.0, 8.0, 0.5]
+    stats = limiter.stats()['reference']
+    assert stats['throttled'] == 4
+    assert stats['backoff_seconds'] == pytest.approx(12.0)
+    assert stats['current_rate'] == pytest.approx(4 * module._MIN_RATE_FACTOR)
+
+
+def test_backoff_delay_grows_exponentially_up_to_max(clock):
+    limiter = _limiter()
+
+    with mock.patch.object(module.random, 'uniform', side_effect=lambda low, high: high):
+        delays = [limiter.backoff('reference', attempt) for attempt in range(5)]
+
+    assert delays == [1.0, 2.0, 4.0, 8.0, 8.0]
@@ -0,0 +1,115 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from src.reference_resolver import ReferenceResolver
+
+STORE = uuid.UUID('11111111-1111-1111-1111-111111111111')
+SECOND_STORE = uuid.UUID('22222222-2222-2222-2222-222222222222')
+DEPARTMENT = uuid.UUID('33333333-3333-3333-3333-333333333333')
+PRODUCT = uuid.UUID('44444444-4444-4444-4444-444444444444')
+
+TABLES = {'Store': 'stores', 'Department': 'departments', 'Product': 'products'}
+
+
+class FakeResult(list):
+    def one(self):
+        return self[0]
+
+
+class FakeSession:
+    """Таблицы справочников в памяти; отпечаток таблицы - (количество строк, версия)"""
+
+    def __init__(self):
+        self.rows = {
+            'stores': [(STORE, 'Склад 1'), (SECOND_STORE, 'Склад 1')],
+            'departments': [(DEPARTMENT,)],
+            'products': [(PRODUCT, 'P-1'), (uuid.uuid4(), None)],
+        }
+        self.versions = {name: datetime(2025, 1, 1) for name in self.rows}
+        self.loads = {name: 0 for name in self.rows}
+
+    def query(self, *entities):
+        entity = str(entities[0])
+        if entity.startswith('count('):
+            table = entity[len('count('):entity.index('.')]
+            return FakeResult([(len(self.rows[table]), self.versions[table])])
+        table = TABLES[entity.split('.')[0]]
+        self.loads[table] += 1
+        return FakeResult(self.rows[table])
+
+
+@pytest.fixture
+def session():
+    return FakeSession()
+
+
+def test_lookups_after_refresh(session):
+    resolver = ReferenceResolver()
+    resolver.refresh_if_changed(session)
+
+    # При одинаковых названиях берется первый склад
+    assert resolver.store_id_by_name('Склад 1') == STORE
+    assert resolver.store_id_by_name('Нет такого') is None
+    assert resolver.store_id_by_name('') is None
+    assert resolver.has_store(str(SECOND_STORE).upper())
+    assert resolver.has_department(DEPARTMENT)
+    assert not resolver.has_department(None)
+    assert resolver.department_ids() == {str(DEPARTMENT)}
+    assert resolver.has_product(PRODUCT)
+    assert resolver.product_id_by_code('P-1') == PRODUCT
+    assert resolver.product_id_by_code(None) is None
+
+
+def test_refresh_reloads_only_changed_tables(session):
+    resolver = ReferenceResolver()
+    resolver.refresh_if_changed(session)
+    resolver.refresh_if_changed(session)
+    assert session.loads == {'stores': 1, 'departments': 1, 'products': 1}
+
+    session.rows['stores'].append((uuid.uuid4(), 'Склад 2'))
+    session.versions['departments'] = datetime(2025, 1, 2)
+    resolver.refresh_if_changed(session, ['stores', 'departments'])
+
+    assert session.loads == {'stores': 2, 'departments': 2, 'products': 1}
+    assert resolver.store_id_by_name('Склад 2') is not None
+
+
+def test_lookup_without_loaded_data_needs_session(session):
+    resolver = ReferenceResolver()
+
+    with pytest.raises(RuntimeError):
+        resolver.has_store(STORE)
+
+    assert resolver.has_store(STORE, session)
+    assert session.loads['stores'] == 1
+
+
+def test_invalidate_reloads_on_next_lookup(session):
+    resolver = ReferenceResolver()
+    resolver.refresh_if_changed(session)
+
+    resolver.invalidate('products')
+    assert resolver.has_store(STORE)
+    assert resolver.has_product(PRODUCT, session)
+
+    assert session.loads == {'stores': 1, 'departments': 1, 'products': 2}
+
+
+def test_stats_count_hits_and_misses_since_snapshot(session):
+    resolver = ReferenceResolver()
+    resolver.refresh_if_changed(session)
+    resolver.has_store(STORE)
+    before = resolver.stats()
+
+    resolver.has_store(STORE)
+    resolver.store_id_by_name('Нет такого')
+    resolver.has_product(uuid.uuid4())
+
+    assert before['stores'] == {'hits': 1, 'misses': 0}
+    assert resolver.stats(since=before) == {
+        'stores': {'hits': 1, 'misses': 1},
+        'departments': {'hits': 0, 'misses': 0},
+        'products': {'hits': 0, 'misses': 1},
+    }
@@ -0,0 +1,147 @@
+from datetime import date, datetime
+
+import pytest
+
+from src.sales_partitions import SalesPartitions, is_full_month, month_start, next_month, partition_name
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+
+class FakeSession:
+    """Сессия, запоминающая SQL; партиции и индексы B-tree задаются списками"""
+
+    def __init__(self, partitions=(), btree_indexes=()):
+        self.partitions = list(partitions)
+        self.btree_indexes = set(btree_indexes)
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        if 'FROM pg_inherits' in sql:
+            return FakeResult([(name,) for name in self.partitions])
+        if 'FROM pg_indexes' in sql:
+            return FakeResult([(1,)] if params['index'] in self.btree_indexes else [])
+        self.statements.append(sql)
+        return FakeResult([])
+
+
+def test_month_helpers():
+    assert month_start(datetime(2025, 3, 17, 10, 30)) == date(2025, 3, 1)
+    assert next_month(date(2025, 12, 1)) == date(2026, 1, 1)
+    assert partition_name(date(2025, 3, 1)) == 'sales_2025_03'
+    assert is_full_month(date(2025, 2, 1), date(2025, 3, 1))
+    assert not is_full_month(date(2025, 2, 2), date(2025, 3, 1))
+    assert not is_full_month(date(2025, 2, 1), date(2025, 4, 1))
+
+
+def test_ensure_creates_only_missing_partitions_and_caches_them():
+    session = FakeSession(partitions=['sales_2025_01', 'sales_legacy'])
+    partitions = SalesPartitions()
+
+    created = partitions.ensure_for_rows(session, [
+        {'close_time': datetime(2025, 1, 5)},
+        {'close_time': datetime(2025, 2, 5)},
+        {'close_time': datetime(2025, 2, 28, 23, 59)},
+        {'close_time': None},
+    ])
+
+    assert created == ['sales_2025_02']
+    assert session.statements[0] == (
+        "CREATE TABLE IF NOT EXISTS \"sales_2025_02\" PARTITION OF sales "
+        "FOR VALUES FROM ('2025-02-01') TO ('2025-03-01')"
+    )
+    assert 'CREATE INDEX IF NOT EXISTS "sales_2025_02_close_time_idx"' in session.statements[1]
+
+    # Повторная запись в тот же месяц не обращается к БД
+    assert partitions.ensure(session, [date(2025, 2, 1)]) == []
+    assert len(session.statements) == 2
+
+
+def test_reset_reloads_partitions_after_rollback():
+    partitions = SalesPartitions()
+    partitions.ensure(FakeSession(), [date(2025, 2, 1)])
+
+    # Транзакция с CREATE TABLE откатилась: партиции в БД нет
+    partitions.reset()
+    session = FakeSession()
+    assert partitions.ensure(session, [date(2025, 2, 1)]) == ['sales_2025_02']
+
+
+def test_compact_old_moves_old_btree_partitions_to_brin():
+    session = FakeSession(
+        partitions=['sales_2024_10', 'sales_2024_11', 'sales_2024_12', 'sales_2025_01', 'sales_2025_02'],
+        btree_indexes={'sales_2024_10_close_time_idx', 'sales_2024_12_close_time_idx',
+                       'sales_2025_01_close_time_idx', 'sales_2025_02_close_time_idx'}
+    )
+    partitions = SalesPartitions(btree_months=2)
+
+    compacted = partitions.compact_old(session, today=date(2025, 2, 10))
+
+    # B-tree остается у текущего и предыдущего месяца; у 2024_11 его уже нет
+    assert compacted == ['sales_2024_10', 'sales_2024_12']
+    assert session.statements == [
+        'CREATE INDEX IF NOT EXISTS "sales_2024_10_close_time_brin" ON "sales_2024_10" USING brin (close_time)',
+        'DROP INDEX IF EXISTS "sales_2024_10_close_time_idx"',
+        'CREATE INDEX IF NOT EXISTS "sales_2024_12_close_time_brin" ON "sales_2024_12" USING brin (close_time)',
+        'DROP INDEX IF EXISTS "sales_2024_12_close_time_idx"',
+    ]
+
+
+def test_truncate_ensures_partition_first():
+    session = FakeSession()
+
+    SalesPartitions().truncate(session, date(2025, 3, 1))
+
+    assert session.statements[-1] == 'TRUNCATE TABLE "sales_2025_03"'
+    assert session.statements[0].startswith('CREATE TABLE IF NOT EXISTS "sales_2025_03"')
+
+
+def test_staging_table_is_checked_against_month_bounds():
+    session = FakeSession()
+
+    staging = SalesPartitions().create_staging(session, date(2025, 3, 1))
+
+    assert staging.startswith('sales_2025_03_reload_')
+    assert session.statements[0] == (
+        f'CREATE TABLE "{staging}" (LIKE sales INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+    )
+    constraints = session.statements[1]
+    assert f'"{staging}_pkey" PRIMARY KEY (id, close_time)' in constraints
+    assert 'UNIQUE NULLS NOT DISTINCT (order_num, fiscal_cheque_number, dish_code, cash_register_number, close_time)' \
+        in constraints
+    assert "CHECK (close_time >= '2025-03-01' AND close_time < '2025-04-01')" in constraints
+
+
+def test_swap_replaces_partition_and_takes_its_names():
+    session = FakeSession(partitions=['sales_2025_03'])
+    staging = 'sales_2025_03_reload_20250410120000'
+
+    SalesPartitions().swap(session, date(2025, 3, 1), staging)
+
+    assert session.statements == [
+        'ALTER TABLE sales DETACH PARTITION "sales_2025_03"',
+        f'CREATE INDEX "{staging}_close_time_idx" ON "{staging}" (close_time)',
+        f'ALTER TABLE sales ATTACH PARTITION "{staging}" FOR VALUES FROM (\'2025-03-01\') TO (\'2025-04-01\')',
+        f'ALTER TABLE "{staging}" DROP CONSTRAINT "{staging}_month"',
+        'DROP TABLE "sales_2025_03"',
+        f'ALTER TABLE "{staging}" RENAME TO "sales_2025_03"',
+        f'ALTER INDEX "{staging}_close_time_idx" RENAME TO "sales_2025_03_close_time_idx"',
+    ]
+
+
+def test_swap_creates_missing_partition_before_detach():
+    session = FakeSession()
+
+    SalesPartitions().swap(session, date(2025, 3, 1), 'sales_2025_03_reload_1')
+
+    assert session.statements[0].startswith('CREATE TABLE IF NOT EXISTS "sales_2025_03"')
+    assert 'DETACH PARTITION "sales_2025_03"' in session.statements[2]
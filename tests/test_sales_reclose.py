@@ -0,0 +1,120 @@
+import uuid
+from datetime import datetime
+from unittest import mock
+
+from src.sales_synchronizer import SalesSynchronizer
+
+ORDER = uuid.uuid4()
+OTHER_ORDER = uuid.uuid4()
+FIRST_CLOSE = datetime(2025, 3, 1, 12, 0)
+RECLOSE = datetime(2025, 3, 1, 12, 40)
+
+
+class FakeQuery:
+    def __init__(self, session, rows):
+        self.session = session
+        self.rows = rows
+
+    def filter(self, *criteria):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def delete(self, synchronize_session=None):
+        self.session.deleted_calls += 1
+        return self.session.delete_count
+
+
+class FakeSession:
+    """Хранимые строки продаж (id, order_id, close_time) для запросов сверки"""
+
+    def __init__(self, stored, delete_count=1):
+        self.stored = stored
+        self.delete_count = delete_count
+        self.deleted_calls = 0
+        self.commits = 0
+
+    def query(self, *entities):
+        return FakeQuery(self, self.stored)
+
+    def commit(self):
+        self.commits += 1
+
+
+def _synchronizer(session):
+    synchronizer = SalesSynchronizer.__new__(SalesSynchronizer)
+    synchronizer.session = session
+    synchronizer.stats = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0, 'duplicates': 0}
+    synchronizer._closings = {}
+    return synchronizer
+
+
+def _sale(order_id, close_time, **values):
+    return dict({'order_id': order_id, 'close_time': close_time, 'order_num': 1,
+                 'fiscal_cheque_number': '10', 'dish_code': 'A', 'cash_register_number': 1}, **values)
+
+
+def test_closings_are_tracked_only_for_written_rows():
+    synchronizer = _synchronizer(FakeSession([]))
+    batch = {}
+
+    synchronizer._add_to_batch(batch, _sale(ORDER, RECLOSE))
+    synchronizer._add_to_batch(batch, _sale(ORDER, RECLOSE, dish_code='B'))
+    synchronizer._add_to_batch(batch, _sale(OTHER_ORDER, None))
+    synchronizer._add_to_batch(batch, _sale(OTHER_ORDER, FIRST_CLOSE, storned=True))
+    synchronizer._add_to_batch(batch, _sale(None, FIRST_CLOSE))
+
+    assert synchronizer._closings == {ORDER: {RECLOSE}}
+    assert len(batch) == 3
+
+
+def test_previous_closing_of_loaded_order_is_deleted():
+    session = FakeSession([(uuid.uuid4(), ORDER, FIRST_CLOSE), (uuid.uuid4(), ORDER, RECLOSE)])
+    synchronizer = _synchronizer(session)
+    synchronizer._closings = {ORDER: {RECLOSE}}
+
+    with mock.patch('src.sales_synchronizer.tuple_') as tuple_:
+        synchronizer._reconcile_reclosed(errors_before=0)
+
+    stale = tuple_.return_value.in_.call_args[0][0]
+    assert stale == [(session.stored[0][0], FIRST_CLOSE)]
+    assert synchronizer.stats['reclosed'] == 1
+    assert session.commits == 1
+    assert synchronizer._closings == {}
+
+
+def test_orders_with_current_closings_only_are_kept():
+    session = FakeSession([(uuid.uuid4(), ORDER, RECLOSE)])
+    synchronizer = _synchronizer(session)
+    synchronizer._closings = {ORDER: {RECLOSE}}
+
+    synchronizer._reconcile_reclosed(errors_before=0)
+
+    assert session.deleted_calls == 0
+    assert 'reclosed' not in synchronizer.stats
+
+
+def test_reconcile_is_skipped_after_write_errors():
+    session = FakeSession([(uuid.uuid4(), ORDER, FIRST_CLOSE)])
+    synchronizer = _synchronizer(session)
+    synchronizer._closings = {ORDER: {RECLOSE}}
+    synchronizer.stats['errors'] = 5
+
+    synchronizer._reconcile_reclosed(errors_before=2)
+
+    assert session.deleted_calls == 0
+    assert session.commits == 0
+    assert synchronizer._closings == {}
+
+
+def test_orders_are_queried_in_chunks():
+    session = FakeSession([])
+    synchronizer = _synchronizer(session)
+    synchronizer.RECLOSE_QUERY_SIZE = 2
+    synchronizer._closings = {uuid.uuid4(): {RECLOSE} for _ in range(5)}
+
+    with mock.patch.object(session, 'query', wraps=session.query) as query:
+        synchronizer._reconcile_reclosed(errors_before=0)
+
+    assert query.call_count == 3
@@ -0,0 +1,132 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from src import sales_synchronizer as module
+from src.sales_synchronizer import SalesSynchronizer
+
+NOW = datetime(2025, 3, 10, 15, 0)
+DEPT_A = 'aaaaaaaa-0000-0000-0000-000000000000'
+DEPT_B = 'bbbbbbbb-0000-0000-0000-000000000000'
+DEPT_C = 'cccccccc-0000-0000-0000-000000000000'
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+def _state(watermark):
+    return SimpleNamespace(watermark=watermark)
+
+
+@pytest.fixture
+def synchronizer():
+    synchronizer = SalesSynchronizer.__new__(SalesSynchronizer)
+    synchronizer.session = mock.Mock()
+    synchronizer.api_client = mock.Mock()
+    synchronizer.references = mock.Mock()
+    synchronizer.references.department_ids.return_value = {DEPT_A, DEPT_B, DEPT_C}
+    synchronizer.stats = {'created': 0, 'updated': 0, 'errors': 0, 'skipped': 0, 'duplicates': 0}
+    synchronizer._watermarks = {}
+    synchronizer._closings = {}
+    synchronizer._compact_partitions = mock.Mock()
+    synchronizer._log_sync_result = mock.Mock()
+    return synchronizer
+
+
+def _run(synchronizer, states, loaded=None, **kwargs):
+    """Инкрементальный запуск; loaded - время последнего чека по подразделениям"""
+    def load_sales(stream):
+        synchronizer._watermarks.update(loaded or {})
+        return len(loaded or {})
+
+    synchronizer._load_sales = mock.Mock(side_effect=load_sales)
+    with mock.patch.object(module, 'datetime', FixedDatetime), \
+            mock.patch.object(module, 'get_sync_states', return_value=states), \
+            mock.patch.object(module, 'save_sync_state') as save, \
+            mock.patch.object(module, 'SALES_SYNC_INITIAL_DAYS', 7):
+        assert synchronizer.sync_sales_incremental(overlap_hours=6, **kwargs)
+    saved = {call.args[2]: call.kwargs['watermark'] for call in save.call_args_list}
+    return synchronizer.api_client.iter_sales.call_args_list, saved
+
+
+def test_departments_are_grouped_by_window_start(synchronizer):
+    states = {
+        DEPT_A: _state(datetime(2025, 3, 9, 3, 0)),
+        DEPT_B: _state(datetime(2025, 3, 9, 20, 0)),
+    }
+
+    calls, _ = _run(synchronizer, states)
+
+    # Водяной знак минус перекрытие; подразделение без водяного знака - за SALES_SYNC_INITIAL_DAYS
+    assert [call.args for call in calls] == [
+        ('2025-03-03', '2025-03-11', [DEPT_C]),
+        ('2025-03-08', '2025-03-11', [DEPT_A]),
+        ('2025-03-09', '2025-03-11', [DEPT_B]),
+    ]
+    assert all(call.kwargs == {'split_departments': False} for call in calls)
+
+
+def test_common_window_is_requested_without_department_filter(synchronizer):
+    synchronizer.references.department_ids.return_value = {DEPT_A}
+
+    calls, _ = _run(synchronizer, {DEPT_A: _state(datetime(2025, 3, 9, 12, 0))})
+
+    assert [call.args for call in calls] == [('2025-03-09', '2025-03-11', None)]
+
+
+def test_first_run_without_known_departments_loads_everything(synchronizer):
+    synchronizer.references.department_ids.return_value = set()
+
+    calls, _ = _run(synchronizer, {})
+
+    assert [call.args for call in calls] == [('2025-03-03', '2025-03-11', None)]
+
+
+def test_explicit_departments_are_always_filtered(synchronizer):
+    calls, _ = _run(synchronizer, {}, department_ids=[DEPT_B.upper()])
+
+    assert [call.args for call in calls] == [('2025-03-03', '2025-03-11', [DEPT_B])]
+
+
+def test_only_departments_with_sales_advance(synchronizer):
+    states = {
+        DEPT_A: _state(datetime(2025, 3, 9, 12, 0)),
+        DEPT_B: _state(datetime(2025, 3, 9, 12, 0)),
+    }
+    loaded = {DEPT_A: datetime(2025, 3, 10, 14, 0)}
+
+    _, saved = _run(synchronizer, states, loaded)
+
+    # Водяной знак B не сдвигается до чеков A: чеки кассы B могут прийти позже
+    assert saved == {DEPT_A: datetime(2025, 3, 10, 14, 0)}
+
+
+def test_watermarks_never_move_back(synchronizer):
+    states = {DEPT_A: _state(datetime(2025, 3, 10, 14, 0))}
+    loaded = {DEPT_A: datetime(2025, 3, 10, 9, 0), DEPT_B: datetime(2025, 3, 10, 11, 0)}
+
+    _, saved = _run(synchronizer, states, loaded)
+
+    assert saved == {DEPT_B: datetime(2025, 3, 10, 11, 0)}
+
+
+def test_watermarks_are_not_saved_after_write_errors(synchronizer):
+    synchronizer.stats['errors'] = 1
+
+    _, saved = _run(synchronizer, {}, {DEPT_A: datetime(2025, 3, 10, 14, 0)})
+
+    assert saved == {}
+
+
+def test_track_watermark_keeps_latest_close_time_per_department(synchronizer):
+    synchronizer._track_watermark({'department_id': DEPT_A.upper(), 'close_time': datetime(2025, 3, 10, 9, 0)})
+    synchronizer._track_watermark({'department_id': DEPT_A, 'close_time': datetime(2025, 3, 10, 8, 0)})
+    synchronizer._track_watermark({'department_id': DEPT_B, 'close_time': None})
+    synchronizer._track_watermark({'department_id': None, 'close_time': datetime(2025, 3, 10, 9, 0)})
+
+    assert synchronizer._watermarks == {DEPT_A: datetime(2025, 3, 10, 9, 0)}
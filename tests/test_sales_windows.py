@@ -0,0 +1,94 @@
+import threading
+import time
+from datetime import date
+
+import pytest
+
+from src.api_client import IikoApiClient, SalesWindowTooLarge
+
+
+class _Client(IikoApiClient):
+    """Клиент без HTTP: окно отдает строки по числу дней и подразделений"""
+
+    SALES_QUEUE_CHUNK_ROWS = 2
+
+    def __init__(self, rows_per_day=3, too_large_days=None):
+        self.rows_per_day = rows_per_day
+        self.too_large_days = too_large_days
+        self.produced = 0
+        self.closed = 0
+        self.lock = threading.Lock()
+
+    def _iter_sales_window(self, start_date, end_date, department_ids, stats, max_rows=None):
+        days = (date.fromisoformat(end_date) - date.fromisoformat(start_date)).days
+        try:
+            for n in range(days * self.rows_per_day):
+                if self.too_large_days and days >= self.too_large_days and n == 1:
+                    raise SalesWindowTooLarge(f"{start_date} - {end_date}")
+                with self.lock:
+                    self.produced += 1
+                stats['loaded'] += 1
+                yield (start_date, n)
+        finally:
+            with self.lock:
+                self.closed += 1
+
+
+def _windows(days):
+    return [(date(2025, 1, day), date(2025, 1, day + 1), None) for day in range(1, days + 1)]
+
+
+def _stats():
+    return {'loaded': 0, 'skipped_storned': 0, 'skipped_returns': 0}
+
+
+def test_all_window_rows_are_delivered_and_counted():
+    client = _Client()
+    stats = _stats()
+
+    rows = list(client._iter_sales_windows(_windows(5), 2, stats))
+
+    assert sorted(rows) == sorted((f'2025-01-{day:02d}', n) for day in range(1, 6) for n in range(3))
+    assert stats['loaded'] == 15
+
+
+def test_too_large_window_is_split_and_reloaded():
+    client = _Client(too_large_days=2)
+    stats = _stats()
+    window = [(date(2025, 1, 1), date(2025, 1, 5), None)]
+
+    rows = list(client._iter_sales_windows(window, 2, stats))
+
+    # Строка, отданная до ошибки, приходит повторно из частей окна
+    assert set(rows) == {(f'2025-01-0{day}', n) for day in range(1, 5) for n in range(3)}
+    assert stats['loaded'] == 12
+
+
+def test_window_that_cannot_be_split_raises():
+    client = _Client(too_large_days=1)
+
+    with pytest.raises(SalesWindowTooLarge):
+        list(client._iter_sales_windows(_windows(1), 2, _stats()))
+
+
+def test_workers_wait_for_slow_consumer():
+    client = _Client(rows_per_day=1000)
+    stream = client._iter_sales_windows(_windows(4), 2, _stats())
+
+    next(stream)
+    time.sleep(0.3)
+
+    # Очередь на 2 * max_parallel порций, плюс порции, которые потоки собирают и ждут места
+    assert client.produced <= 3 * 2 * client.SALES_QUEUE_CHUNK_ROWS + 2
+    stream.close()
+
+
+def test_closing_stream_stops_workers():
+    client = _Client(rows_per_day=1000)
+    stream = client._iter_sales_windows(_windows(4), 2, _stats())
+
+    next(stream)
+    stream.close()
+
+    assert client.closed == 2
+    assert client.produced < 4000
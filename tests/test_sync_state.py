@@ -0,0 +1,135 @@
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from src import sync_state as module
+from src.models import SyncCheckpoint, SyncState
+from src.sync_state import get_sync_state, get_sync_states, mark_checkpoint, plan_checkpoints, save_sync_state
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter_by(self, **values):
+        return FakeQuery([row for row in self.rows
+                          if all(getattr(row, key) == value for key, value in values.items())])
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+    def all(self):
+        return list(self.rows)
+
+
+class FakeSession:
+    """Сессия поверх списка объектов: add сразу делает объект видимым для запросов"""
+
+    def __init__(self, objects=()):
+        self.objects = list(objects)
+
+    def query(self, model):
+        return FakeQuery([obj for obj in self.objects if isinstance(obj, model)])
+
+    def add(self, obj):
+        self.objects.append(obj)
+
+
+JANUARY = [(date(2025, 1, 1), date(2025, 1, 8)), (date(2025, 1, 8), date(2025, 1, 15)),
+           (date(2025, 1, 15), date(2025, 1, 22))]
+
+
+def _checkpoint(window, status, job_id='sales:test', **values):
+    return SyncCheckpoint(job_id=job_id, entity_type='sales', window_start=window[0], window_end=window[1],
+                          status=status, **values)
+
+
+def test_save_sync_state_creates_and_updates_one_row_per_scope():
+    session = FakeSession()
+    watermark = datetime(2025, 1, 1, 12)
+
+    save_sync_state(session, 'sales', 'dept-1', watermark=watermark)
+    save_sync_state(session, 'sales', 'dept-1', watermark=watermark + timedelta(hours=1))
+    save_sync_state(session, 'sales', None, revision=5)
+
+    assert len(session.objects) == 2
+    assert get_sync_state(session, 'sales', 'dept-1').watermark == watermark + timedelta(hours=1)
+    # Пустой scope - состояние всей сущности
+    assert get_sync_state(session, 'sales').revision == 5
+    assert set(get_sync_states(session, 'sales')) == {'', 'dept-1'}
+    assert get_sync_state(session, 'writeoffs') is None
+
+
+def test_plan_creates_pending_windows_in_order():
+    session = FakeSession()
+
+    checkpoints = plan_checkpoints(session, 'sales:test', 'sales', JANUARY)
+
+    assert [(c.window_start, c.window_end, c.status) for c in checkpoints] == \
+        [(start, end, 'pending') for start, end in JANUARY]
+    assert all(c.entity_type == 'sales' and c.job_id == 'sales:test' for c in checkpoints)
+    assert len(session.objects) == 3
+
+
+def test_resume_keeps_done_windows_and_requeues_the_rest():
+    done = _checkpoint(JANUARY[0], 'done', rows_count=10)
+    running = _checkpoint(JANUARY[1], 'running')
+    failed = _checkpoint(JANUARY[2], 'failed', error_message='timeout')
+    other_job = _checkpoint(JANUARY[0], 'done', job_id='sales:other')
+    session = FakeSession([done, running, failed, other_job])
+
+    checkpoints = plan_checkpoints(session, 'sales:test', 'sales', JANUARY, resume=True)
+
+    assert checkpoints == [done, running, failed]
+    assert [c.status for c in checkpoints] == ['done', 'pending', 'pending']
+    assert failed.error_message is None
+    assert done.rows_count == 10
+    assert len(session.objects) == 4
+
+
+def test_without_resume_all_windows_run_again():
+    done = _checkpoint(JANUARY[0], 'done')
+    session = FakeSession([done])
+
+    checkpoints = plan_checkpoints(session, 'sales:test', 'sales', JANUARY[:1])
+
+    assert checkpoints == [done]
+    assert done.status == 'pending'
+
+
+def test_resume_requeues_done_window_with_different_end():
+    done = _checkpoint((date(2025, 1, 1), date(2025, 1, 5)), 'done')
+    session = FakeSession([done])
+
+    plan_checkpoints(session, 'sales:test', 'sales', JANUARY[:1], resume=True)
+
+    assert done.status == 'pending'
+    assert done.window_end == date(2025, 1, 8)
+
+
+def test_mark_checkpoint_tracks_duration_and_results():
+    checkpoint = _checkpoint(JANUARY[0], 'pending', rows_count=3, error_message='old')
+    started = datetime(2025, 2, 1, 10, 0, 0)
+
+    with mock.patch.object(module, 'datetime') as clock:
+        clock.utcnow.return_value = started
+        mark_checkpoint(checkpoint, 'running')
+        assert (checkpoint.started_at, checkpoint.rows_count, checkpoint.error_message) == (started, None, None)
+
+        clock.utcnow.return_value = started + timedelta(seconds=90)
+        mark_checkpoint(checkpoint, 'failed', rows_count=100, error_message='2 rows failed to save')
+
+    assert checkpoint.status == 'failed'
+    assert checkpoint.finished_at == started + timedelta(seconds=90)
+    assert checkpoint.duration_seconds == 90
+    assert checkpoint.rows_count == 100
+    assert checkpoint.error_message == '2 rows failed to save'
+
+
+def test_mark_checkpoint_keeps_previous_values_when_not_given():
+    checkpoint = _checkpoint(JANUARY[0], 'running', rows_count=7)
+
+    mark_checkpoint(checkpoint, 'done')
+
+    assert checkpoint.status == 'done'
+    assert checkpoint.rows_count == 7
+    assert checkpoint.duration_seconds is None
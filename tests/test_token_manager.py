@@ -0,0 +1,165 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from src import token_manager as module
+from src.token_manager import TokenManager
+
+OTHER_PID = 999999
+
+
+class _Server:
+    """Вход выдает новые токены, выход запоминает освобожденные"""
+
+    def __init__(self):
+        self.issued = 0
+        self.logged_out = []
+
+    def login(self):
+        self.issued += 1
+        return f'token-{self.issued}'
+
+    def logout(self, token):
+        self.logged_out.append(token)
+
+
+@pytest.fixture
+def server():
+    return _Server()
+
+
+@pytest.fixture
+def now():
+    clock = {'value': 1000.0}
+    with mock.patch.object(module.time, 'time', lambda: clock['value']):
+        yield clock
+
+
+@pytest.fixture
+def other_process_alive():
+    with mock.patch.object(module, '_pid_alive', lambda pid: True):
+        yield
+
+
+def _manager(server, cache_file=None, ttl=None):
+    return TokenManager(server.login, server.logout, cache_file=str(cache_file) if cache_file else None, ttl=ttl)
+
+
+def _read(cache_file):
+    return json.loads(cache_file.read_text())
+
+
+def _write(cache_file, **state):
+    cache_file.write_text(json.dumps(state))
+
+
+def test_token_is_reused_until_ttl_expires(server, now):
+    manager = _manager(server, ttl=60)
+
+    assert manager.get_token() == 'token-1'
+    assert manager.get_token() == 'token-1'
+
+    now['value'] += 61
+    assert manager.get_token() == 'token-2'
+    # Устаревший токен без общего файла держит только этот процесс
+    assert server.logged_out == ['token-1']
+
+
+def test_refresh_replaces_rejected_token_without_logout(server, now):
+    manager = _manager(server)
+    manager.get_token()
+
+    assert manager.refresh('token-1') == 'token-2'
+    assert server.logged_out == []
+
+
+def test_refresh_returns_token_already_replaced_by_other_thread(server, now):
+    manager = _manager(server)
+    manager.get_token()
+    manager.refresh('token-1')
+
+    assert manager.refresh('token-1') == 'token-2'
+    assert server.issued == 2
+
+
+def test_token_is_shared_between_processes_through_file(server, now, tmp_path, other_process_alive):
+    cache_file = tmp_path / 'token.json'
+    _write(cache_file, token='shared', obtained_at=now['value'], holders=[OTHER_PID])
+    manager = _manager(server, cache_file, ttl=60)
+
+    assert manager.get_token() == 'shared'
+    assert server.issued == 0
+    assert _read(cache_file)['holders'] == [OTHER_PID, os.getpid()]
+
+
+def test_expired_shared_token_is_not_reused(server, now, tmp_path, other_process_alive):
+    cache_file = tmp_path / 'token.json'
+    _write(cache_file, token='shared', obtained_at=now['value'] - 120, holders=[OTHER_PID])
+    manager = _manager(server, cache_file, ttl=60)
+
+    assert manager.get_token() == 'token-1'
+    state = _read(cache_file)
+    assert state['token'] == 'token-1'
+    assert state['holders'] == [os.getpid()]
+
+
+def test_expired_token_held_by_other_process_is_left_to_lapse(server, now, tmp_path, other_process_alive):
+    cache_file = tmp_path / 'token.json'
+    manager = _manager(server, cache_file, ttl=60)
+    manager.get_token()
+    state = _read(cache_file)
+    state['holders'].append(OTHER_PID)
+    _write(cache_file, **state)
+
+    now['value'] += 61
+    assert manager.get_token() == 'token-2'
+    assert server.logged_out == []
+
+
+def test_expired_token_of_sole_holder_is_logged_out(server, now, tmp_path):
+    cache_file = tmp_path / 'token.json'
+    manager = _manager(server, cache_file, ttl=60)
+    manager.get_token()
+
+    now['value'] += 61
+    assert manager.get_token() == 'token-2'
+    assert server.logged_out == ['token-1']
+
+
+def test_expired_token_already_replaced_in_file_is_not_logged_out(server, now, tmp_path):
+    cache_file = tmp_path / 'token.json'
+    manager = _manager(server, cache_file, ttl=60)
+    manager.get_token()
+    _write(cache_file, token='other', obtained_at=now['value'] - 120, holders=[])
+
+    now['value'] += 61
+    assert manager.get_token() == 'token-2'
+    assert server.logged_out == []
+
+
+def test_logout_keeps_token_used_by_other_process(server, now, tmp_path, other_process_alive):
+    cache_file = tmp_path / 'token.json'
+    manager = _manager(server, cache_file)
+    manager.get_token()
+    state = _read(cache_file)
+    state['holders'].append(OTHER_PID)
+    _write(cache_file, **state)
+
+    manager.logout()
+
+    assert server.logged_out == []
+    assert _read(cache_file)['holders'] == [OTHER_PID]
+
+
+def test_logout_of_last_holder_releases_token_and_clears_file(server, now, tmp_path):
+    cache_file = tmp_path / 'token.json'
+    manager = _manager(server, cache_file)
+    manager.get_token()
+
+    manager.logout()
+
+    assert server.logged_out == ['token-1']
+    assert _read(cache_file) == {}
+    assert manager.token is None
@@ -0,0 +1,124 @@
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from src import synchronizer as module
+from src.synchronizer import DataSynchronizer
+
+STARTED_AT = datetime(2025, 3, 10, 15, 0)
+
+
+@pytest.fixture
+def synchronizer():
+    synchronizer = DataSynchronizer.__new__(DataSynchronizer)
+    synchronizer.session = mock.Mock()
+    synchronizer.api_client = mock.Mock()
+    synchronizer.references = mock.Mock()
+    synchronizer.references.stats.return_value = {}
+    synchronizer._writeoff_last_date = None
+    return synchronizer
+
+
+@pytest.fixture(autouse=True)
+def settings():
+    with mock.patch.object(module, 'WRITEOFF_SYNC_WINDOW_DAYS', 3), \
+            mock.patch.object(module, 'WRITEOFF_SYNC_INITIAL_DAYS', 7):
+        yield
+
+
+def _state(watermark, **details):
+    return SimpleNamespace(watermark=watermark, details=details)
+
+
+def test_windows_split_range_without_gaps():
+    assert DataSynchronizer._writeoff_windows(date(2025, 3, 1), date(2025, 3, 8)) == [
+        (date(2025, 3, 1), date(2025, 3, 4)),
+        (date(2025, 3, 4), date(2025, 3, 7)),
+        (date(2025, 3, 7), date(2025, 3, 8)),
+    ]
+    assert DataSynchronizer._writeoff_windows(date(2025, 3, 8), date(2025, 3, 8)) == []
+
+
+def test_plan_starts_from_watermark_minus_correction(synchronizer):
+    with mock.patch.object(module, 'get_sync_state', return_value=_state(datetime(2025, 3, 9, 6, 0))):
+        windows = synchronizer._plan_writeoff_windows(timedelta(hours=24), STARTED_AT)
+
+    # Последнее окно включает сегодняшний день
+    assert windows == [(date(2025, 3, 8), date(2025, 3, 11))]
+
+
+def test_first_run_loads_initial_days(synchronizer):
+    with mock.patch.object(module, 'get_sync_state', return_value=None):
+        windows = synchronizer._plan_writeoff_windows(timedelta(hours=24), STARTED_AT)
+
+    assert windows[0][0] == date(2025, 3, 3)
+    assert windows[-1][1] == date(2025, 3, 11)
+
+
+def test_watermark_only_grows_and_keeps_last_document_date(synchronizer):
+    stored = _state(datetime(2025, 3, 10, 0, 0), last_date_incoming='2025-03-09T10:00:00')
+    synchronizer._writeoff_last_date = datetime(2025, 3, 8, 12, 0)
+
+    with mock.patch.object(module, 'get_sync_state', return_value=stored), \
+            mock.patch.object(module, 'save_sync_state') as save:
+        synchronizer._save_writeoff_watermark(datetime(2025, 3, 9, 0, 0))
+
+    assert save.call_args.kwargs == {
+        'watermark': datetime(2025, 3, 10, 0, 0),
+        'details': {'last_date_incoming': '2025-03-09T10:00:00'},
+    }
+
+
+def test_watermark_advances_to_window_end(synchronizer):
+    synchronizer._writeoff_last_date = datetime(2025, 3, 9, 12, 0)
+
+    with mock.patch.object(module, 'get_sync_state', return_value=None), \
+            mock.patch.object(module, 'save_sync_state') as save:
+        synchronizer._save_writeoff_watermark(datetime(2025, 3, 10, 0, 0))
+
+    assert save.call_args.args == (synchronizer.session, module.WRITEOFF_STATE_ENTITY)
+    assert save.call_args.kwargs == {
+        'watermark': datetime(2025, 3, 10, 0, 0),
+        'details': {'last_date_incoming': '2025-03-09T12:00:00'},
+    }
+
+
+def _run_incremental(synchronizer, windows, failing_window=None):
+    def sync_window(window_start, window_end):
+        if (window_start, window_end) == failing_window:
+            synchronizer.counters['errors'] += 1
+        return 1, {'fetch': {'items': 1}}
+
+    synchronizer._sync_writeoff_window = mock.Mock(side_effect=sync_window)
+    synchronizer._save_writeoff_watermark = mock.Mock()
+    synchronizer._plan_writeoff_windows = mock.Mock(return_value=windows)
+    with mock.patch.object(module, 'datetime') as clock:
+        clock.now.return_value = STARTED_AT
+        clock.utcnow.return_value = STARTED_AT
+        clock.combine.side_effect = datetime.combine
+        clock.min = datetime.min
+        result = synchronizer.sync_writeoff_documents_incremental(correction_hours=24)
+    return result, [call.args[0] for call in synchronizer._save_writeoff_watermark.call_args_list]
+
+
+def test_watermark_is_saved_after_each_window_and_capped_by_start(synchronizer):
+    windows = [(date(2025, 3, 5), date(2025, 3, 8)), (date(2025, 3, 8), date(2025, 3, 11))]
+
+    result, saved = _run_incremental(synchronizer, windows)
+
+    assert result is True
+    # Конец последнего окна в будущем: водяной знак - момент запуска
+    assert saved == [datetime(2025, 3, 8, 0, 0), STARTED_AT]
+
+
+def test_window_with_write_errors_stops_and_keeps_watermark(synchronizer):
+    windows = [(date(2025, 3, 2), date(2025, 3, 5)), (date(2025, 3, 5), date(2025, 3, 8)),
+               (date(2025, 3, 8), date(2025, 3, 11))]
+
+    result, saved = _run_incremental(synchronizer, windows, failing_window=windows[1])
+
+    assert result is False
+    assert saved == [datetime(2025, 3, 5, 0, 0)]
+    assert synchronizer._sync_writeoff_window.call_count == 2
@@ -0,0 +1,57 @@
+import pytest
+
+from src.xml_stream import iter_xml_elements, iter_xml_records
+
+STORES = ('<?xml version="1.0" encoding="UTF-8"?>'
+          '<corporateItemDtoes revision="42">'
+          '<corporateItemDto><id>1</id><name>Склад &amp; кухня</name><type>STORE</type></corporateItemDto>'
+          '<corporateItemDto><id>2</id><name>Бар</name><type/></corporateItemDto>'
+          '<corporateItemDto><id>3</id><name>Цех</name><type>PRODUCTION</type></corporateItemDto>'
+          '</corporateItemDtoes>')
+
+EXPECTED = [
+    {'id': '1', 'name': 'Склад & кухня', 'type': 'STORE'},
+    {'id': '2', 'name': 'Бар', 'type': None},
+    {'id': '3', 'name': 'Цех', 'type': 'PRODUCTION'},
+]
+
+
+@pytest.mark.parametrize('offset', range(len(STORES.encode('utf-8')) + 1))
+def test_records_split_at_every_offset(offset):
+    data = STORES.encode('utf-8')
+    root_attrib = {}
+    records = list(iter_xml_records([data[:offset], data[offset:]], 'corporateItemDto', root_attrib=root_attrib))
+    assert records == EXPECTED
+    assert root_attrib == {'revision': '42'}
+
+
+def test_where_filter():
+    records = iter_xml_records([STORES.encode('utf-8')], 'corporateItemDto',
+                               where=lambda fields: fields['type'] == 'STORE')
+    assert [record['id'] for record in records] == ['1']
+
+
+def test_nested_elements_with_same_tag_are_not_yielded():
+    data = b'<root><item><id>1</id><item><id>nested</id></item></item><item><id>2</id></item></root>'
+    ids = [elem.find('id').text for elem in iter_xml_elements([data], 'item')]
+    assert ids == ['1', '2']
+
+
+def test_yielded_elements_are_released():
+    data = STORES.encode('utf-8')
+    elements = []
+    for elem in iter_xml_elements([data], 'corporateItemDto'):
+        assert len(elem)
+        elements.append(elem)
+    # После перехода к следующему элементу предыдущий очищается
+    assert all(len(elem) == 0 for elem in elements)
+
+
+def test_empty_chunks_are_skipped():
+    data = STORES.encode('utf-8')
+    assert list(iter_xml_records([b'', data, b''], 'corporateItemDto')) == EXPECTED
+
+
+def test_malformed_xml_raises():
+    with pytest.raises(Exception):
+        list(iter_xml_records([b'<root><item><id>1</id></root>'], 'item'))
@@ -280,7 +280,7 @@ def sync():
             message = 'Синхронизация продуктов завершена успешно'
         elif entity == 'stores':
             store_synchronizer = StoreSynchronizer()
-            store_synchronizer.sync_stores()
+            store_synchronizer.sync_stores(full_refresh=data.get('full_refresh', False))
             message = 'Синхронизация складов завершена успешно'
         elif entity == 'sales':
             # Получаем параметры для синхронизации продаж
@@ -290,7 +290,11 @@ def sync():
             
             try:
                 sales_synchronizer = SalesSynchronizer()
-                result = sales_synchronizer.sync_sales(start_date, end_date, clear_existing)
+                # Без дат - инкрементальная загрузка от водяных знаков подразделений
+                if data.get('mode', 'range' if start_date or end_date else 'incremental') == 'incremental':
+                    result = sales_synchronizer.sync_sales_incremental(overlap_hours=data.get('overlap_hours'))
+                else:
+                    result = sales_synchronizer.sync_sales(start_date, end_date, clear_existing)
                 
                 if result:
                     message = f'Синхронизация продаж завершена успешно. ' \
@@ -335,11 +339,12 @@ def sync():
             start_date = data.get('start_date')
             end_date = data.get('end_date')
             
-            if not start_date or not end_date:
-                return jsonify({'status': 'error', 'message': 'Для синхронизации списаний необходимо указать даты'}), 400
-            
             synchronizer = DataSynchronizer()
-            synchronizer.sync_writeoff_documents(start_date, end_date)
+            if not start_date and not end_date:
+                # Без дат - инкрементально от водяного знака
+                synchronizer.sync_writeoff_documents_incremental()
+            else:
+                synchronizer.sync_writeoff_documents(start_date, end_date)
             message = 'Синхронизация документов списания завершена успешно'
             
             return jsonify({
@@ -468,14 +473,8 @@ def upload():
                 # Используем существующий синхронизатор
                 synchronizer = DataSynchronizer()
                 
-                # Извлекаем и синхронизируем категории
-                synchronizer._extract_and_sync_categories(products_data)
-                
-                # Синхронизируем продукты
-                for product_data in products_data:
-                    synchronizer._sync_single_product(product_data)
-                
-                synchronizer.session.commit()
+                # Категории, иерархия и модификаторы записываются массовым upsert каталога
+                synchronizer.upsert_products(products_data)
                 
                 # Записываем в лог
                 sync_log = SyncLog(
@@ -641,9 +640,13 @@ def sale_detail(sale_id):
             return "Продажа не найдена", 404
         
         # Получаем все позиции в том же чеке
+        # Позиции одного чека закрываются одновременно; ограничение по close_time
+        # оставляет в плане только партицию месяца чека
         related_sales = session.query(Sale).filter(
             Sale.order_num == sale.order_num,
-            Sale.fiscal_cheque_number == sale.fiscal_cheque_number
+            Sale.fiscal_cheque_number == sale.fiscal_cheque_number,
+            Sale.close_time >= sale.close_time - timedelta(days=1),
+            Sale.close_time < sale.close_time + timedelta(days=1)
         ).order_by(Sale.dish_name).all()
         
         # Подсчитываем статистику чека
@@ -675,8 +678,9 @@ def sales_sync():
             start_date = data.get('start_date')
             end_date = data.get('end_date')
             clear_existing = data.get('clear_existing', False)
+            mode = data.get('mode', 'range')
             
-            if not start_date or not end_date:
+            if mode != 'incremental' and (not start_date or not end_date):
                 return jsonify({
                     'status': 'error', 
                     'error': 'Необходимо указать даты начала и окончания'
@@ -684,7 +688,10 @@ def sales_sync():
             
             # Запуск синхронизатора продаж
             sales_synchronizer = SalesSynchronizer()
-            result = sales_synchronizer.sync_sales(start_date, end_date, clear_existing)
+            if mode == 'incremental':
+                result = sales_synchronizer.sync_sales_incremental(overlap_hours=data.get('overlap_hours'))
+            else:
+                result = sales_synchronizer.sync_sales(start_date, end_date, clear_existing)
             
             return jsonify({
                 'status': 'success', 
@@ -862,15 +869,12 @@ def writeoffs_sync():
             start_date = data.get('start_date')
             end_date = data.get('end_date')
             
-            if not start_date or not end_date:
-                return jsonify({
-                    'status': 'error', 
-                    'message': 'Необходимо указать даты начала и окончания'
-                }), 400
-            
-            # Запуск синхронизации документов списания
+            # Запуск синхронизации документов списания (без дат - инкрементально)
             synchronizer = DataSynchronizer()
-            result = synchronizer.sync_writeoff_documents(start_date, end_date)
+            if not start_date and not end_date:
+                result = synchronizer.sync_writeoff_documents_incremental()
+            else:
+                result = synchronizer.sync_writeoff_documents(start_date, end_date)
             
             return jsonify({
                 'status': 'success', 
@@ -1046,7 +1050,8 @@ def sync_departments():
         api_client = IikoApiClient()
         synchronizer = DepartmentSynchronizer(api_client, CONNECTION_STRING)
         
-        result = synchronizer.sync_departments()
+        data = request.get_json(silent=True) or {}
+        result = synchronizer.sync_departments(full_refresh=data.get('full_refresh', False))
         
         return jsonify({
             'status': 'success',
@@ -1139,15 +1144,22 @@ def sync_prices():
         date_to = data.get('date_to')
         price_type = data.get('price_type', 'BASE')
         
-        if not department_id:
-            return jsonify({'status': 'error', 'message': 'Не указано подразделение'}), 400
-        
         if not date_from or not date_to:
             return jsonify({'status': 'error', 'message': 'Не указан период'}), 400
         
         api_client = IikoApiClient()
         synchronizer = PriceSynchronizer(api_client, CONNECTION_STRING)
         
+        if not department_id or department_id == 'all':
+            # Все подразделения параллельно
+            result = synchronizer.sync_all_prices(date_from, date_to, price_type)
+            return jsonify({
+                'status': 'success' if not result['departments_failed'] else 'error',
+                'message': f'Синхронизировано цен для {len(result["departments"])} подразделений: {result["created"]}. '
+                           f'Пропущено: {result["skipped"]}, подразделений с ошибками: {result["departments_failed"]}',
+                'result': result
+            })
+        
         result = synchronizer.sync_prices(department_id, date_from, date_to, price_type)
         
         return jsonify({
@@ -1370,7 +1382,16 @@ def sync_incoming_invoices():
         api_client = IikoApiClient()
         synchronizer = IncomingInvoiceSynchronizer(api_client, CONNECTION_STRING)
         
-        result = synchronizer.sync_incoming_invoices(from_date, to_date, supplier_id)
+        if supplier_id == 'all':
+            # Накладные всех активных поставщиков загружаются параллельно
+            session = Session()
+            try:
+                supplier_ids = [str(row[0]) for row in session.query(Supplier.id).filter(Supplier.deleted == False).all()]
+            finally:
+                session.close()
+            result = synchronizer.sync_incoming_invoices_for_suppliers(from_date, to_date, supplier_ids)
+        else:
+            result = synchronizer.sync_incoming_invoices(from_date, to_date, supplier_id)
         
         return jsonify({
             'status': 'success',